@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Enqueue throughput of the memory-only and journaled queues.
+
+Runs ``--threads`` producers that each put ``--tasks`` frames, against a
+plain ``ShardedQ`` and against ``DurableQ`` with ``fsync='always'``
+(one msync per put) and ``fsync='group'`` (group commit)::
+
+    python benchmarks/journal_throughput.py --threads 8 --tasks 2000
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import threading
+import time
+
+from pasync.journal import DurableQ, FSYNC_ALWAYS, FSYNC_GROUP, FSYNC_NONE
+from pasync.q import Item, ShardedQ
+
+FRAME = json.dumps({
+    'task_id': 0,
+    'task_content': 'add',
+    'task_params': {'a': 1, 'b': 2, 'note': 'x' * 40},
+    'task_priority': 0
+}).encode('utf-8')
+
+
+def run(queue, threads, tasks):
+    def produce():
+        for _ in range(tasks):
+            queue.put(Item(FRAME))
+
+    workers = [threading.Thread(target=produce) for _ in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * tasks / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--tasks', type=int, default=2000,
+                        help="puts per thread")
+    args = parser.parse_args()
+
+    results = {'memory': run(ShardedQ(), args.threads, args.tasks)}
+    for mode in (FSYNC_NONE, FSYNC_ALWAYS, FSYNC_GROUP):
+        directory = tempfile.mkdtemp(prefix='pasync-journal-')
+        try:
+            queue = DurableQ(directory, fsync=mode)
+            results['journal_' + mode] = run(queue, args.threads, args.tasks)
+            queue.close()
+        finally:
+            shutil.rmtree(directory)
+
+    print(json.dumps({
+        'benchmark': 'journal_throughput',
+        'threads': args.threads,
+        'tasks_per_thread': args.tasks,
+        'puts_per_second': dict(
+            (k, round(v)) for k, v in results.items()),
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
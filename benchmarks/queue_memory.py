@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Bytes of heap memory held per queued task.
+
+Compares the old queue entry layout (a ``(-priority, index, Item)`` tuple
+around a ``__dict__``-based Item holding the decoded task dict) with the
+current one (a slotted ``Item`` holding the raw frame, pushed straight
+onto a ``ShardedQ`` heap).
+
+Needs Python 3.4+ for ``tracemalloc``::
+
+    python benchmarks/queue_memory.py --tasks 200000
+"""
+
+import argparse
+import heapq
+import json
+import tracemalloc
+
+from pasync.q import Item, ShardedQ
+
+
+class LegacyItem(object):
+    "The pre-``__slots__`` Item."
+
+    def __init__(self, data, priority=0):
+        self.data = data
+        self.priority = priority
+
+
+def make_frame(i):
+    return json.dumps({
+        'task_id': i,
+        'task_content': 'add',
+        'task_params': {'a': i, 'b': 2, 'note': 'x' * 40},
+        'task_priority': i % 4
+    }).encode('utf-8')
+
+
+def fill_legacy(n):
+    heap = []
+    for index in range(n):
+        frame = make_frame(index)
+        task = json.loads(frame)
+        item = LegacyItem(task, task['task_priority'])
+        heapq.heappush(heap, (-item.priority, index, item))
+    return heap
+
+
+def fill_compact(n):
+    q = ShardedQ()
+    for i in range(n):
+        q.put(Item(make_frame(i), priority=i % 4))
+    return q
+
+
+def measure(fill, n):
+    "Memory still held after queueing ``n`` freshly received frames."
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = fill(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del keep
+    return float(after - before) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=200000)
+    args = parser.parse_args()
+
+    legacy = measure(fill_legacy, args.tasks)
+    compact = measure(fill_compact, args.tasks)
+    print(json.dumps({
+        'benchmark': 'queue_memory',
+        'tasks': args.tasks,
+        'frame_bytes': len(make_frame(0)),
+        'legacy_bytes_per_task': round(legacy, 1),
+        'compact_bytes_per_task': round(compact, 1),
+        'saving': round(1 - compact / legacy, 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""Loopback benchmark suite for the queue, parser, client and server.
+
+Prints one JSON document, so runs from two releases can be diffed::
+
+    python benchmarks/suite.py > before.json
+    python benchmarks/suite.py --only latency saturation --quick
+
+Groups:
+
+* ``queue``: ``Q`` / ``ShardedQ`` put and get rates, one thread.
+* ``parser``: frames per second through ``read_frame`` (server side) and
+  ``PythonParser.read_response`` (client side), for several payload sizes.
+* ``latency``: ``Connection.send`` ack round trips, and send to
+  ``get_result`` task round trips, as p50/p90/p99 in microseconds.
+* ``saturation``: acks per second from several client processes
+  pipelining tasks into one server, per payload size and client count.
+* ``logging``: ``TaskSession.handle_frame`` rate and p99 latency, in
+  process, with task logging off, written synchronously, handed to the
+  log thread, and handed off with sampling.
+* ``compression``: the CPU-vs-bytes trade-off on task-like JSON: ratio
+  and microseconds per message for each compressor, with and without a
+  shared dictionary, per payload size; and the bytes sent and CPU spent
+  on a mix of sizes at each ``--compress-thresholds`` value.
+
+Servers run in a child process with a ``TaskWorker`` executing a no-op
+task, so the client side never shares the GIL with them. With
+``--server-processes N`` that child is a prefork ``Supervisor`` of N
+servers instead.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import threading
+import time
+
+from pasync import QServer, EventQServer, QHandler
+from pasync.compression import available_compressors, encode, get_compressor
+from pasync.log import QueueHandler, task_sampler
+from pasync.prefork import Supervisor
+from pasync.connection import Connection, PythonParser, SocketBuffer
+from pasync.protocol import pack_frame, read_frame
+from pasync.q import Q, Item, ShardedQ
+from pasync.server import TaskSession, get_queue, set_queue
+from pasync.worker import TaskWorker, register_task
+
+clock = getattr(time, 'perf_counter', time.time)
+
+ENGINES = {
+    'threaded': QServer,
+    'event': EventQServer,
+}
+
+GROUPS = ('queue', 'parser', 'latency', 'saturation', 'logging',
+          'compression')
+
+
+@register_task
+def noop(blob=None):
+    return None
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def pick(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    return {
+        'p50_us': round(pick(0.50) * 1e6, 1),
+        'p90_us': round(pick(0.90) * 1e6, 1),
+        'p99_us': round(pick(0.99) * 1e6, 1),
+        'max_us': round(samples[-1] * 1e6, 1),
+    }
+
+
+def bench_queue(args):
+    n = args.queue_items
+    results = {}
+    for name, factory in (('Q', Q), ('ShardedQ', ShardedQ)):
+        queue = factory()
+        items = [Item(b'task', i % 4) for i in range(n)]
+        start = clock()
+        for item in items:
+            queue.put(item)
+        put = clock() - start
+        start = clock()
+        for _ in range(n):
+            queue.get()
+        get = clock() - start
+        results[name] = {
+            'put_per_second': round(n / put),
+            'get_per_second': round(n / get),
+        }
+
+    queue = ShardedQ()
+    batch = 100
+    items = [Item(b'task', i % 4) for i in range(n)]
+    start = clock()
+    for i in range(0, n, batch):
+        queue.put_many(items[i:i + batch])
+    put = clock() - start
+    start = clock()
+    while not queue.empty():
+        queue.get_many(batch)
+    get = clock() - start
+    results['ShardedQ_batch_%d' % batch] = {
+        'put_per_second': round(n / put),
+        'get_per_second': round(n / get),
+    }
+    return results
+
+
+def _parse(reader, payload, count):
+    "Feed ``count`` frames through a socketpair into ``reader``."
+    a, b = socket.socketpair()
+    blob = pack_frame(payload) * count
+    writer = threading.Thread(target=a.sendall, args=(blob,))
+    writer.daemon = True
+    writer.start()
+    read = reader(b)
+    start = clock()
+    for _ in range(count):
+        read()
+    elapsed = clock() - start
+    writer.join()
+    a.close()
+    b.close()
+    return elapsed
+
+
+def _frame_reader(sock):
+    buf = SocketBuffer(sock, 65536)
+    return lambda: read_frame(buf)
+
+
+def _parser_reader(sock):
+    connection = Connection()
+    connection._sock = sock
+    parser = PythonParser(65536)
+    parser.on_connect(connection)
+    return parser.read_response
+
+
+def bench_parser(args):
+    results = {}
+    for size in args.payload_sizes:
+        payload = b'x' * size
+        count = max(100, min(args.parser_frames, 2 ** 28 // (size + 16)))
+        for name, reader in (('read_frame', _frame_reader),
+                             ('read_response', _parser_reader)):
+            elapsed = _parse(reader, payload, count)
+            results['%s_%d' % (name, size)] = {
+                'frames_per_second': round(count / elapsed),
+                'megabytes_per_second': round(
+                    count * size / elapsed / 1e6, 1),
+            }
+    return results
+
+
+def _setup(index=None):
+    get_queue().set_maxsize(0)
+    TaskWorker(queue=get_queue(), concurrency=4).start()
+
+
+def _serve(engine, log_level, processes, ready):
+    logging.getLogger('pasync').setLevel(log_level)
+    server_class = ENGINES[engine]
+    server_class.daemon_threads = True
+    if processes > 1:
+        server = Supervisor(server_class, ('127.0.0.1', 0), QHandler,
+                            processes=processes, setup=_setup)
+        server.start()
+    else:
+        _setup()
+        server = server_class(('127.0.0.1', 0), QHandler)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class Server(object):
+    "A benchmark server in a child process."
+
+    def __init__(self, engine, log_level, processes=1):
+        ready = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(engine, log_level, processes, ready))
+        # A daemonic process may not fork the prefork servers.
+        self.process.daemon = processes == 1
+        self.process.start()
+        self.port = ready.get(timeout=30)
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def bench_latency(args):
+    results = {}
+    for engine in args.engines:
+        server = Server(engine, args.log_level, args.server_processes)
+        try:
+            conn = Connection(port=server.port)
+            conn.connect()
+            for _ in range(100):
+                conn.get_result(conn.send('noop')['task_id'])
+
+            acks = []
+            for _ in range(args.latency_samples):
+                start = clock()
+                conn.send('noop')
+                acks.append(clock() - start)
+            # Let the results of those tasks arrive, then drop them.
+            time.sleep(0.2)
+            while conn.can_read(0):
+                conn.read_message()
+            conn._results.clear()
+
+            tasks = []
+            for _ in range(args.latency_samples):
+                start = clock()
+                conn.get_result(conn.send('noop')['task_id'])
+                tasks.append(clock() - start)
+            conn.disconnect()
+        finally:
+            server.close()
+        results[engine] = {
+            'ack': percentiles(acks),
+            'task': percentiles(tasks),
+        }
+    return results
+
+
+def _client(port, payload, tasks, chunk_size, start_event, report):
+    conn = Connection(port=port)
+    conn.connect()
+    start_event.wait()
+    begin = clock()
+    accepted = 0
+    for i in range(0, tasks, chunk_size):
+        with conn.pipeline(chunk_size) as pipe:
+            for _ in range(min(chunk_size, tasks - i)):
+                pipe.send('noop', blob=payload)
+            accepted += sum(1 for ack in pipe.execute()
+                            if ack and ack.get('task_ack'))
+    report.put((accepted, clock() - begin))
+    conn.disconnect()
+
+
+def bench_saturation(args):
+    results = {}
+    for engine in args.engines:
+        server = Server(engine, args.log_level, args.server_processes)
+        try:
+            for size in args.payload_sizes:
+                payload = 'x' * size
+                for clients in args.clients:
+                    start_event = multiprocessing.Event()
+                    report = multiprocessing.Queue()
+                    procs = [multiprocessing.Process(
+                        target=_client,
+                        args=(server.port, payload, args.saturation_tasks,
+                              args.chunk_size, start_event, report))
+                        for _ in range(clients)]
+                    for p in procs:
+                        p.start()
+                    time.sleep(0.2)
+                    start_event.set()
+                    reports = [report.get(timeout=600) for _ in procs]
+                    for p in procs:
+                        p.join()
+                    accepted = sum(r[0] for r in reports)
+                    elapsed = max(r[1] for r in reports)
+                    results['%s_payload_%d_clients_%d' % (
+                        engine, size, clients)] = {
+                        'tasks': clients * args.saturation_tasks,
+                        'accepted': accepted,
+                        'tasks_per_second': round(
+                            clients * args.saturation_tasks / elapsed),
+                    }
+        finally:
+            server.close()
+    return results
+
+
+def _handle_frames(count):
+    session = TaskSession(('127.0.0.1', 0), write=lambda data: None)
+    payload = json.dumps({'task_id': 1, 'task_content': 'noop',
+                          'task_params': {'blob': 'x' * 64},
+                          'task_priority': 0}).encode()
+    samples = []
+    start = clock()
+    for i in range(count):
+        if not i % 1000:
+            set_queue(ShardedQ())
+        begin = clock()
+        session.handle_frame(payload)
+        samples.append(clock() - begin)
+    elapsed = clock() - start
+    session.close()
+    return {
+        'frames_per_second': round(count / elapsed),
+        'p99_us': percentiles(samples)['p99_us'],
+    }
+
+
+def bench_logging(args):
+    logger = logging.getLogger('pasync')
+    saved = logger.handlers[:], logger.level, task_sampler.max_per_second
+    queue = get_queue()
+    devnull = open(os.devnull, 'w')
+    sink = logging.StreamHandler(devnull)
+    sink.setFormatter(
+        logging.Formatter('[PASYNC %(levelname)-7s] %(message)s'))
+    modes = (
+        ('off', logging.WARNING, None, None),
+        ('sync', logging.INFO, sink, None),
+        ('queued', logging.INFO, QueueHandler([sink]), None),
+        ('queued_sampled_100_per_second', logging.INFO,
+         QueueHandler([sink]), 100),
+    )
+    results = {}
+    try:
+        for name, level, handler, rate in modes:
+            logger.handlers = [handler] if handler else []
+            logger.setLevel(level)
+            task_sampler.max_per_second = rate
+            results[name] = _handle_frames(args.logging_frames)
+            if handler is not sink and handler is not None:
+                handler.close()
+    finally:
+        logger.handlers, level, task_sampler.max_per_second = saved
+        logger.setLevel(level)
+        set_queue(queue)
+        devnull.close()
+    return results
+
+
+def _json_payload(size, seed=0):
+    "A task message of about ``size`` bytes of repetitive JSON."
+    rng = random.Random(seed)
+    rows = []
+    task = {'task_id': seed, 'task_content': 'report',
+            'task_params': {'rows': rows}, 'task_priority': 0}
+    payload = json.dumps(task).encode()
+    while len(payload) < size:
+        rows.extend({
+            'user': 'user{}'.format(rng.randint(0, 50)),
+            'status': rng.choice(('active', 'pending', 'closed')),
+            'region': rng.choice(('eu-west-1', 'us-east-1', 'ap-south-1')),
+            'amount': rng.randint(0, 100000),
+        } for _ in range(8))
+        payload = json.dumps(task).encode()
+    return payload
+
+
+def _time_calls(func, arg, count):
+    start = clock()
+    for _ in range(count):
+        result = func(arg)
+    return result, (clock() - start) / count * 1e6
+
+
+def bench_compression(args):
+    dictionary = b''.join(_json_payload(256, seed) for seed in range(16))
+    results = {}
+    for name in available_compressors():
+        for shared in (None, dictionary):
+            compressor = get_compressor(name, shared)
+            if shared is not None and compressor.dictionary is None:
+                continue
+            sizes = {}
+            for size in args.payload_sizes:
+                payload = _json_payload(size, seed=99)
+                count = max(10, args.compression_bytes // len(payload))
+                data, compress_us = _time_calls(compressor.compress, payload,
+                                                count)
+                _, decompress_us = _time_calls(
+                    lambda d: compressor.decompress(d, len(payload)), data,
+                    count)
+                sizes[str(len(payload))] = {
+                    'ratio': round(len(payload) / float(len(data)), 2),
+                    'compress_us': round(compress_us, 2),
+                    'decompress_us': round(decompress_us, 2),
+                }
+            results[name + ('' if shared is None else '_dictionary')] = sizes
+
+    zlib = get_compressor('zlib')
+    mix = [_json_payload(size, seed)
+           for seed in range(20) for size in args.payload_sizes]
+    raw = sum(len(payload) for payload in mix)
+    thresholds = {}
+    for threshold in args.compress_thresholds:
+        start = clock()
+        sent = sum(len(encode(payload, zlib, threshold)) for payload in mix)
+        thresholds[str(threshold)] = {
+            'bytes_sent_ratio': round(sent / float(raw), 3),
+            'cpu_us_per_message': round((clock() - start) / len(mix) * 1e6,
+                                        2),
+        }
+    results['zlib_thresholds'] = thresholds
+    return results
+
+
+BENCHMARKS = {
+    'queue': bench_queue,
+    'parser': bench_parser,
+    'latency': bench_latency,
+    'saturation': bench_saturation,
+    'logging': bench_logging,
+    'compression': bench_compression,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=GROUPS, default=GROUPS)
+    parser.add_argument('--quick', action='store_true',
+                        help="Smaller runs for a smoke test.")
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES),
+                        default=sorted(ENGINES))
+    parser.add_argument('--payload-sizes', nargs='+', type=int,
+                        default=[16, 1024, 65536])
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--queue-items', type=int, default=200000)
+    parser.add_argument('--parser-frames', type=int, default=200000)
+    parser.add_argument('--latency-samples', type=int, default=5000)
+    parser.add_argument('--logging-frames', type=int, default=100000)
+    parser.add_argument('--compression-bytes', type=int, default=20000000,
+                        help="bytes to compress per compressor and size")
+    parser.add_argument('--compress-thresholds', nargs='+', type=int,
+                        default=[0, 256, 1024, 4096, 1000000])
+    parser.add_argument('--saturation-tasks', type=int, default=5000,
+                        help="tasks sent by each client")
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help="tasks per pipelined round trip")
+    parser.add_argument('--server-processes', type=int, default=1,
+                        help="prefork server processes")
+    parser.add_argument('--log-level', default='WARNING',
+                        help="server log level; INFO logs every task")
+    args = parser.parse_args()
+    if args.quick:
+        args.queue_items //= 20
+        args.parser_frames //= 20
+        args.latency_samples //= 20
+        args.logging_frames //= 20
+        args.saturation_tasks //= 20
+        args.compression_bytes //= 20
+        args.clients = [min(args.clients), max(args.clients)]
+
+    results = {}
+    for group in GROUPS:
+        if group in args.only:
+            results[group] = BENCHMARKS[group](args)
+
+    print(json.dumps({
+        'benchmark': 'suite',
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'timestamp': int(time.time()),
+        'options': dict((k, v) for k, v in vars(args).items()
+                        if k not in ('only', 'quick')),
+        'results': results,
+    }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,153 @@
 # -*- coding: utf-8 -*-
 
-from pasync import QServer, QHandler
+import argparse
+import importlib
+import os
+
+from pasync import QServer, EventQServer, QHandler
+from pasync.journal import DurableQ, FSYNC_MODES, FSYNC_GROUP
+from pasync.log import task_sampler
+from pasync.metrics import start_http_server
+from pasync.prefork import Supervisor
+from pasync.compression import available_compressors
+from pasync.hooks import OVERFLOW_BLOCK, OVERFLOW_DROP, task_callback_hook
+from pasync.serializers import available_serializers
+from pasync.server import (
+    get_queue, set_queue, TaskSession, idempotency_cache
+)
+from pasync.worker import TaskWorker
 
 HOST, PORT = ("localhost", 1234)
 
 import logging
 logger = logging.getLogger(__name__)
 
+ENGINES = {
+    'threaded': QServer,
+    'event': EventQServer,
+}
+
+parser = argparse.ArgumentParser(description="Run a PAsync server.")
+parser.add_argument('--host', default=HOST)
+parser.add_argument('--port', type=int, default=PORT)
+parser.add_argument('--engine', choices=sorted(ENGINES), default='threaded',
+                    help="'threaded' runs a thread per connection, 'event' "
+                         "multiplexes every connection on one thread.")
+parser.add_argument('--processes', type=int, default=1,
+                    help="Server processes sharing the port, each with its "
+                         "own queue and worker; 0 for one per CPU.")
+parser.add_argument('--pool', choices=sorted(TaskWorker.pool_classes),
+                    default='thread',
+                    help="Run tasks on threads (I/O-bound) or processes "
+                         "(CPU-bound).")
+parser.add_argument('--concurrency', type=int, default=None,
+                    help="Tasks run at once; defaults to the CPU count.")
+parser.add_argument('--tasks', action='append', default=[],
+                    metavar='MODULE',
+                    help="Import MODULE so its tasks get registered; may be "
+                         "given more than once.")
+parser.add_argument('--queue-size', type=int, default=10000,
+                    help="Tasks the queue holds before clients are told to "
+                         "wait; 0 for no limit.")
+parser.add_argument('--idempotency-ttl', type=float, default=300,
+                    help="Seconds to remember the result of a task sent "
+                         "with an idempotency key.")
+parser.add_argument('--idempotency-size', type=int, default=10000,
+                    help="Idempotency keys remembered at most.")
+parser.add_argument('--journal', metavar='DIR', default=None,
+                    help="Persist queued tasks in DIR and replay them on "
+                         "startup.")
+parser.add_argument('--fsync', choices=FSYNC_MODES, default=FSYNC_GROUP,
+                    help="Journal durability: 'group' shares one sync "
+                         "between concurrent puts.")
+parser.add_argument('--spool-dir', metavar='DIR', default=None,
+                    help="Receive task attachments into files in DIR "
+                         "(the system temp dir by default).")
+parser.add_argument('--serializers', nargs='+', metavar='NAME',
+                    choices=available_serializers(),
+                    default=list(TaskSession.allowed_serializers),
+                    help="Serializers clients may switch to; JSON is always "
+                         "accepted. Only allow pickle or marshal for "
+                         "trusted clients.")
+parser.add_argument('--compression', nargs='*', metavar='NAME',
+                    choices=available_compressors(),
+                    default=list(TaskSession.allowed_compressors),
+                    help="Compressors clients may ask for; none to turn "
+                         "compression off.")
+parser.add_argument('--compress-threshold', type=int,
+                    default=TaskSession.compress_threshold, metavar='BYTES',
+                    help="Compress messages to clients from this size on.")
+parser.add_argument('--compression-dict', metavar='FILE', action='append',
+                    default=[],
+                    help="A shared dictionary clients may compress with.")
+parser.add_argument('--task-log-rate', type=float, default=100,
+                    help="Log at most this many tasks a second; 0 for no "
+                         "limit.")
+parser.add_argument('--task-log-every', type=int, default=1, metavar='N',
+                    help="Log only one task in N.")
+parser.add_argument('--hook-workers', type=int, default=0, metavar='N',
+                    help="Run task callbacks on N background threads; 0 "
+                         "runs them inline, before the next task.")
+parser.add_argument('--hook-queue-size', type=int, default=10000,
+                    help="Task callback calls that may wait to run.")
+parser.add_argument('--hook-overflow', choices=(OVERFLOW_DROP, OVERFLOW_BLOCK),
+                    default=OVERFLOW_DROP,
+                    help="Drop task callback calls when their queue is "
+                         "full, or wait for room.")
+parser.add_argument('--hook-timeout', type=float, default=None,
+                    metavar='SECONDS',
+                    help="Replace the thread of a task callback running "
+                         "this long.")
+parser.add_argument('--metrics-port', type=int, default=None,
+                    help="Serve Prometheus metrics on this local port.")
+args = parser.parse_args()
+
+for module in args.tasks:
+    importlib.import_module(module)
+
+TaskSession.allowed_serializers = tuple(args.serializers)
+TaskSession.spool_dir = args.spool_dir
+TaskSession.allowed_compressors = tuple(args.compression)
+TaskSession.compress_threshold = args.compress_threshold
+for path in args.compression_dict:
+    with open(path, 'rb') as f:
+        TaskSession.add_compression_dictionary(f.read())
+task_sampler.every = args.task_log_every
+task_sampler.max_per_second = args.task_log_rate or None
+
+get_queue().set_maxsize(args.queue_size)
+idempotency_cache.ttl = args.idempotency_ttl
+idempotency_cache.maxsize = args.idempotency_size
+if args.hook_workers > 0:
+    task_callback_hook.dispatch_async(
+        workers=args.hook_workers, maxsize=args.hook_queue_size,
+        overflow=args.hook_overflow, timeout=args.hook_timeout)
+
+
+def setup(index=None):
+    "Give this server process its queue and worker."
+    if args.journal:
+        directory = args.journal
+        if index is not None:
+            # Each prefork child replays its own journal.
+            directory = os.path.join(directory, str(index))
+        set_queue(DurableQ(directory, maxsize=get_queue().maxsize,
+                           fsync=args.fsync))
+
+    worker = TaskWorker(queue=get_queue(), pool=args.pool,
+                        concurrency=args.concurrency)
+    worker.start()
+
 
-server = QServer((HOST, PORT), QHandler)
-server.serve_forever()
+if args.processes != 1:
+    supervisor = Supervisor(ENGINES[args.engine], (args.host, args.port),
+                            QHandler, processes=args.processes, setup=setup)
+    if args.metrics_port:
+        start_http_server(args.metrics_port, registry=supervisor)
+    supervisor.serve_forever()
+else:
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    setup()
+    server = ENGINES[args.engine]((args.host, args.port), QHandler)
+    server.serve_forever()
@@ -2,18 +2,21 @@
 
 import logging
 
-from pasync.server import QServer, QHandler
+from pasync.log import QueueHandler
+from pasync.server import QServer, EventQServer, QHandler
 
 logger = logging.getLogger(__name__)
 console = logging.StreamHandler()
 console.setLevel(logging.INFO)
 console.setFormatter(
     logging.Formatter('[PASYNC %(levelname)-7s] %(message)s'))
-logger.addHandler(console)
+# Written from a background thread, off the request path.
+log_handler = QueueHandler([console])
+logger.addHandler(log_handler)
 logger.setLevel(logging.INFO)
 
 version_info = (0, 0, 1)
 __version__ = ".".join([str(v) for v in version_info])
 
 
-__all__ = ["QServer", "QHandler", "__version__"]
+__all__ = ["QServer", "EventQServer", "QHandler", "__version__"]
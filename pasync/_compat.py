@@ -3,7 +3,7 @@
 import sys
 
 try:  # Python 3
-    from queue import LifoQueue, Empty, Full
+    from queue import LifoQueue, Queue, Empty, Full
 except ImportError:
     from Queue import Empty, Full
     try:  # Python 2.6 - 2.7
@@ -28,6 +28,7 @@ except ImportError:
 
 if sys.version_info[0] < 3:
 
+    import math
     import time
     import socket
     import errno
@@ -85,14 +86,29 @@ if sys.version_info[0] < 3:
         return x
 
     def nativerstr(x):
-        return x if isinstance(x, str) else x.decode('utf-8', 'replace')
+        return x if isinstance(x, str) else x.encode('utf-8', 'replace')
+
+    def isfinite(x):
+        return not (math.isinf(x) or math.isnan(x))
+
+    from SocketServer import TCPServer, StreamRequestHandler, ThreadingMixIn
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    basestring = basestring
+    unicode = unicode
+    long = long
+    xrange = xrange
 else:
+    from io import BytesIO
+    from math import isfinite
+    from socketserver import TCPServer, StreamRequestHandler, ThreadingMixIn
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
     def recv(sock, *args, **kwargs):
         return sock.recv(*args, **kwargs)
 
-    def recv_info(sock, *args, **kwargs):
-        return sock.recv_info(*args, **kwargs)
+    def recv_into(sock, *args, **kwargs):
+        return sock.recv_into(*args, **kwargs)
 
     def iteritems(x):
         return iter(x.items())
@@ -104,4 +120,9 @@ else:
         return chr(x)
 
     def nativerstr(x):
-        return x if isinstance(x, str) else x.encode('utf-8', 'replace')
+        return x if isinstance(x, str) else x.decode('utf-8', 'replace')
+
+    basestring = str
+    unicode = str
+    long = int
+    xrange = range
@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""asyncio client for QServer (Python 3.7+).
+
+Mirrors ``pasync.connection``: ``AsyncConnection.send`` and ``get_result``
+are awaitables, and ``AsyncConnectionPool`` hands out connections up to a
+max size. A connection keeps a background reader that matches acks to
+their ``task_id``, so any number of tasks may be in flight on one socket
+without threads.
+
+Like ``Connection``, it keeps within the credit the server grants and
+resends tasks rejected while the server's queue was full, and sends
+attachments raw after their task, files with ``loop.sendfile``.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from pasync import attachments as _attachments, compression
+from pasync.protocol import (
+    MAX_FRAME_SIZE, pack_frame, SYM_CRLF, SYM_DOLLAR, SYM_DASH
+)
+from pasync.exceptions import (
+    TimeoutError,
+    ConnectionError,
+    FlowTimeoutError,
+    PoolExhaustedError,
+    InvalidResponse,
+    ResponseError,
+    SocketRecvQueueEmptyError
+)
+from pasync.serializers import (
+    DEFAULT_SERIALIZER, available_serializers, get_serializer
+)
+from pasync.utils import to_timestamp
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_THRESHOLD = compression.DEFAULT_THRESHOLD
+
+
+class AsyncConnection(object):
+    """Manages asyncio TCP communication to and from QServer"""
+    description_format = "AsyncConnection<host={}, port={}>"
+
+    def __init__(self, host="localhost", port=1234, socket_timeout=None,
+                 socket_connect_timeout=None, queue_max_size=None,
+                 serializer=DEFAULT_SERIALIZER, initial_credit=100,
+                 flow_timeout=None, compression=None,
+                 compress_threshold=_DEFAULT_THRESHOLD,
+                 compression_dict=None):
+        self.pid = os.getpid()
+        self.host = host
+        self.port = port
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.queue_max_size = queue_max_size
+        self.serializers = [serializer] if isinstance(
+            serializer, str) else list(serializer)
+        self.serializer = get_serializer(DEFAULT_SERIALIZER)
+        self.compressors = [compression] if isinstance(
+            compression, str) else list(compression or ())
+        self.compress_threshold = compress_threshold
+        self.compression_dict = compression_dict
+        self.compressor = None
+        self.initial_credit = initial_credit
+        self.credit = initial_credit
+        self.flow_timeout = flow_timeout
+        self._credit_event = None
+        self.task_id = 0
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._loop = None
+        self._pending = {}
+        # Unclaimed task results keyed by task_id, in arrival order, and
+        # the futures of get_result calls waiting on a specific task / on
+        # whichever task finishes next.
+        self._results = OrderedDict()
+        self._result_waiters = {}
+        # task_id -> _Stream, for tasks whose result is streamed.
+        self._streams = {}
+        # task_id -> [(source, offset, size)] of tasks not sent yet.
+        self._attachments = {}
+        self._any_waiters = deque()
+        self._stats_waiters = deque()
+
+    def __repr__(self):
+        return self.description_format.format(self.host, self.port)
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                self.socket_connect_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timeout connecting to server")
+        except OSError as e:
+            raise ConnectionError("Error connecting to %s:%s. %s." %
+                                  (self.host, self.port, e))
+        self.serializer = get_serializer(DEFAULT_SERIALIZER)
+        self.compressor = None
+        self.credit = self.initial_credit
+        self._credit_event = asyncio.Event()
+        self._credit_event.set()
+        if self.serializers != [DEFAULT_SERIALIZER] or self.compressors:
+            try:
+                await asyncio.wait_for(self.hello(), self.socket_timeout)
+            except asyncio.TimeoutError:
+                self._close(ConnectionError("Handshake failed."))
+                raise TimeoutError("Timeout during the handshake")
+            except OSError as e:
+                self._close(ConnectionError("Handshake failed."))
+                raise ConnectionError("Error connecting to %s:%s. %s." %
+                                      (self.host, self.port, e))
+            except Exception:
+                self._close(ConnectionError("Handshake failed."))
+                raise
+        self._read_task = self._loop.create_task(self._read_loop())
+
+    async def hello(self):
+        """Agree on a serializer with the server, which may pick JSON, and
+        on a compressor, which it may decline.
+        """
+        options = {'serializers': [
+            name for name in self.serializers
+            if name in available_serializers()]}
+        if self.compressors:
+            options['compression'] = [
+                name for name in self.compressors
+                if name in compression.available_compressors()]
+            if self.compression_dict is not None:
+                options['dictionary'] = compression.dictionary_id(
+                    self.compression_dict)
+        self._writer.write(pack_frame(self.serializer.dumps(
+            {'hello': options})))
+        await self._writer.drain()
+        reply = self.serializer.loads(await self._read_frame())
+        hello = reply.get('hello') or {}
+        self.serializer = get_serializer(hello.get('serializer',
+                                                   DEFAULT_SERIALIZER))
+        self._set_credit(hello.get('credit', self.credit))
+        if hello.get('compression'):
+            self.compressor = compression.get_compressor(
+                hello['compression'], self.compression_dict
+                if hello.get('dictionary') else None)
+
+    def _pack(self, message):
+        payload = self.serializer.dumps(message)
+        if self.compressor is not None:
+            payload = compression.encode(payload, self.compressor,
+                                         self.compress_threshold)
+        return pack_frame(payload)
+
+    async def disconnect(self):
+        self._close(ConnectionError("Connection closed."))
+        if self._read_task is not None:
+            self._read_task.cancel()
+            try:
+                await self._read_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._read_task = None
+
+    def _close(self, exc):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+        pending, self._pending = self._pending, {}
+        pending = list(pending.values()) + list(self._stats_waiters)
+        self._stats_waiters.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(exc)
+        if self._credit_event is not None:
+            # Wake senders waiting for credit so they see the failure.
+            self._credit_event.set()
+
+    def _set_credit(self, credit):
+        self.credit = credit
+        if credit is None or credit > 0:
+            self._credit_event.set()
+        else:
+            self._credit_event.clear()
+
+    async def _read_frame(self):
+        header = await self._reader.readline()
+        if not header:
+            raise ConnectionError("Connection closed by server.")
+        if not header.endswith(SYM_CRLF):
+            raise InvalidResponse("Protocol Error: truncated header")
+        if header[:1] == SYM_DASH:
+            raise ResponseError(header[1:-2].decode('utf-8', 'replace'))
+        if header[:1] != SYM_DOLLAR:
+            raise InvalidResponse("Protocol Error: %r" % (header[:16],))
+        try:
+            length = int(header[1:-2])
+        except ValueError:
+            raise InvalidResponse("Protocol Error: invalid frame length %r" %
+                                  (header[1:-2],))
+        if length < 0 or length > MAX_FRAME_SIZE:
+            raise InvalidResponse("Protocol Error: frame length %d out of "
+                                  "range" % length)
+        data = await self._reader.readexactly(length + 2)
+        return data[:-2]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                payload = await self._read_frame()
+                if self.compressor is not None:
+                    payload = compression.decode(payload, self.compressor)
+                message = self.serializer.loads(payload)
+                if 'stats' in message:
+                    if self._stats_waiters:
+                        future = self._stats_waiters.popleft()
+                        if not future.done():
+                            future.set_result(message['stats'])
+                    continue
+                if 'task_ack' not in message:
+                    if 'credit' in message:
+                        self._set_credit(message['credit'])
+                    else:
+                        self._set_result(message)
+                    continue
+                self._set_credit(message.get('credit'))
+                future = self._pending.pop(message.get('task_id'), None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self._close(ConnectionError("Connection closed by server."))
+        except Exception as e:
+            self._close(e)
+
+    async def stats(self):
+        "Return the server's metrics snapshot."
+        if self._writer is None:
+            await self.connect()
+        future = self._loop.create_future()
+        self._stats_waiters.append(future)
+        self._writer.write(self._pack({'stats': True}))
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self.socket_timeout)
+        except asyncio.TimeoutError:
+            self._close(TimeoutError("Timeout reading from socket"))
+            raise TimeoutError("Timeout reading from socket")
+
+    def pack_task(self, data, priority=0, eta=None, countdown=None,
+                  idempotency_key=None, attachments=None, **kwargs):
+        """Build the next task message and reserve its ``task_id``.
+
+        Higher ``priority`` tasks are run first. A task with ``eta`` (a Unix
+        timestamp or datetime) or ``countdown`` (seconds from now) waits on
+        the server until then, and is queued at its priority.
+
+        Tasks sent with the same ``idempotency_key`` run once: a resend gets
+        the first one's result (under its own ``task_id``) and an ack with
+        ``task_duplicate`` set.
+
+        ``attachments`` are as for ``Connection.pack_task``.
+        """
+        task = {
+            'task_id': self.task_id,
+            'task_content': data,
+            'task_params': kwargs,
+            'task_priority': priority
+        }
+        if countdown is not None:
+            eta = time.time() + countdown
+        if eta is not None:
+            task['task_eta'] = to_timestamp(eta)
+        if idempotency_key is not None:
+            task['task_key'] = idempotency_key
+        if attachments:
+            specs, sources = [], []
+            for name, source in attachments.items():
+                offset = _attachments.offset_of(source)
+                size = _attachments.size_of(source)
+                specs.append([name, size])
+                sources.append((source, offset, size))
+            task['task_attachments'] = specs
+            self._attachments[self.task_id] = sources
+        self.task_id += 1
+        return task
+
+    async def send(self, data, ack=True, **kwargs):
+        """Submit one task and return its ack.
+
+        With ``ack=False`` a rejected task does not raise.
+        """
+        received = (await self.send_packed_tasks(
+            [self.pack_task(data, **kwargs)]))[0]
+        if ack and received.get('task_ack') is not True:
+            raise ResponseError(received.get('msg'))
+        return received
+
+    async def send_many(self, tasks):
+        "Submit every task content in ``tasks`` and return their acks."
+        return await self.send_packed_tasks(
+            [self.pack_task(data) for data in tasks])
+
+    async def send_packed_tasks(self, tasks):
+        """Send ``tasks`` within the server's credit and return their acks.
+
+        See ``Connection.send_packed_tasks``.
+        """
+        if self._writer is None:
+            await self.connect()
+
+        deadline = None
+        if self.flow_timeout is not None:
+            deadline = time.time() + self.flow_timeout
+        received = {}
+        pending = list(tasks)
+        try:
+            while pending:
+                await self._wait_for_credit(deadline)
+                if self.credit is None:
+                    batch, pending = pending, []
+                else:
+                    batch = pending[:self.credit]
+                    pending = pending[self.credit:]
+                    self._set_credit(self.credit - len(batch))
+                acks = await self._send_batch(batch)
+                received.update((ack.get('task_id'), ack) for ack in acks)
+                pending = [t for t, ack in zip(batch, acks)
+                           if not ack.get('task_ack') and 'credit' in ack] + \
+                    pending
+        finally:
+            if self._attachments:
+                for t in tasks:
+                    self._attachments.pop(t['task_id'], None)
+        return [received.get(t['task_id']) for t in tasks]
+
+    async def _wait_for_credit(self, deadline):
+        while self.credit is not None and self.credit <= 0:
+            if self._writer is None:
+                raise ConnectionError("Connection closed.")
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise FlowTimeoutError(
+                        "Timeout waiting for server credit")
+            try:
+                await asyncio.wait_for(self._credit_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                raise FlowTimeoutError("Timeout waiting for server credit")
+
+    async def _send_batch(self, tasks):
+        if self._writer is None:
+            raise ConnectionError("Connection closed.")
+        # Packed before any is pending, so a bad task leaves none behind.
+        packed = [self._pack(task) for task in tasks]
+        futures = []
+        for task in tasks:
+            future = self._loop.create_future()
+            self._pending[task['task_id']] = future
+            futures.append(future)
+        try:
+            frames = []
+            for task, frame in zip(tasks, packed):
+                frames.append(frame)
+                sources = self._attachments.get(task['task_id'])
+                if sources:
+                    # Their bytes follow the frame unframed.
+                    self._writer.write(b''.join(frames))
+                    frames = []
+                    for source, offset, size in sources:
+                        await self._send_attachment(source, offset, size)
+            self._writer.write(b''.join(frames))
+            await self._writer.drain()
+            return await asyncio.wait_for(asyncio.gather(*futures),
+                                          self.socket_timeout)
+        except asyncio.TimeoutError:
+            self._close(TimeoutError("Timeout reading from socket"))
+            raise TimeoutError("Timeout reading from socket")
+        except OSError as e:
+            self._close(ConnectionError(str(e)))
+            raise ConnectionError("Error while writing to socket: %s" % e)
+
+    async def _send_attachment(self, source, offset, size):
+        if not hasattr(source, 'read'):
+            self._writer.write(source)
+        elif size:
+            # Waits for the buffered frames to go out first.
+            await self._loop.sendfile(self._writer.transport, source,
+                                      offset, size)
+
+    def _set_result(self, ret):
+        task_id = ret.get('task_id')
+        stream = self._streams.get(task_id)
+        if ret.get('task_status') == 'CHUNK':
+            if stream is None:
+                stream = self._streams[task_id] = _Stream()
+            stream.chunks.append(ret.get('task_result'))
+            stream.ready.set()
+            return
+        if stream is not None:
+            stream.final = ret
+            stream.ready.set()
+            any_waiters = self._any_waiters
+            while any_waiters and any_waiters[0].done():
+                any_waiters.popleft()
+            if task_id not in self._result_waiters and (
+                    stream.iterating or not any_waiters):
+                # Kept for iter_results, or a later get_result.
+                return
+            # A get_result is waiting: it drops the chunks, as
+            # Connection.get_result does.
+            del self._streams[task_id]
+        waiter = self._result_waiters.pop(task_id, None)
+        while waiter is None and self._any_waiters:
+            waiter = self._any_waiters.popleft()
+            if waiter.done():
+                waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(ret)
+            return
+
+        if self.queue_max_size is not None and \
+                len(self._results) >= self.queue_max_size:
+            # Raising here would only reach the event loop's exception
+            # handler, so drop the result and say so.
+            logger.warning("{!r} dropped a result: too many unclaimed "
+                           "results, use **await conn.get_result()** to "
+                           "consume.".format(self))
+            return
+        self._results[task_id] = ret
+
+    async def get_result(self, task_id=None, timeout=5):
+        """Return a task result message, waiting up to ``timeout``.
+
+        With ``task_id`` wait for that task's result, otherwise return the
+        oldest unclaimed one. A result message is a dict with ``task_id``,
+        ``task_status`` and ``task_result``.
+        """
+        results = self._results
+        if task_id is None and results:
+            return results.popitem(last=False)[1]
+        if task_id is not None and task_id in results:
+            return results.pop(task_id)
+        if task_id is None:
+            for key, stream in list(self._streams.items()):
+                if stream.final is not None and not stream.iterating:
+                    del self._streams[key]
+                    return stream.final
+        stream = self._streams.get(task_id)
+        if stream is not None and stream.final is not None:
+            del self._streams[task_id]
+            return stream.final
+
+        waiter = asyncio.get_running_loop().create_future()
+        if task_id is None:
+            self._any_waiters.append(waiter)
+        else:
+            self._result_waiters[task_id] = waiter
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            raise SocketRecvQueueEmptyError("No reslut.")
+        finally:
+            if task_id is not None and \
+                    self._result_waiters.get(task_id) is waiter:
+                del self._result_waiters[task_id]
+
+    def iter_results(self, task_id, timeout=5):
+        """Iterate with ``async for`` over the result of a task, piece by
+        piece as the server sends it.
+
+        As ``Connection.iter_results``: a generator task's chunks, or the
+        one result of any other task, waiting up to ``timeout`` for each,
+        and ``ResponseError`` if the task fails. Unlike it, chunks are read
+        as they arrive and wait in memory for the consumer.
+        """
+        stream = self._streams.get(task_id)
+        if stream is None:
+            stream = self._streams[task_id] = _Stream()
+            final = self._results.pop(task_id, None)
+            if final is not None:
+                stream.final = final
+                stream.ready.set()
+        stream.iterating = True
+        return _ResultIterator(self, task_id, stream, timeout)
+
+
+class _Stream(object):
+    __slots__ = ('chunks', 'final', 'ready', 'iterating')
+
+    def __init__(self):
+        self.chunks = deque()
+        self.final = None
+        self.ready = asyncio.Event()
+        # Set by ``iter_results``; otherwise the final message is an
+        # ordinary result.
+        self.iterating = False
+
+
+class _ResultIterator(object):
+
+    def __init__(self, connection, task_id, stream, timeout):
+        self.connection = connection
+        self.task_id = task_id
+        self.stream = stream
+        self.timeout = timeout
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        stream = self.stream
+        while not self.done:
+            if stream.chunks:
+                return stream.chunks.popleft()
+            final = stream.final
+            if final is not None:
+                self.done = True
+                streams = self.connection._streams
+                if streams.get(self.task_id) is stream:
+                    del streams[self.task_id]
+                if final.get('task_status') != 'SUCCESS':
+                    raise ResponseError(final.get('task_result'))
+                if 'task_chunks' not in final:
+                    return final.get('task_result')
+                break
+            stream.ready.clear()
+            try:
+                await asyncio.wait_for(stream.ready.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise SocketRecvQueueEmptyError("No reslut.")
+        raise StopAsyncIteration
+
+
+class AsyncConnectionPool(object):
+
+    def __init__(self, connection_class=AsyncConnection, max_connections=50,
+                 timeout=20, **connection_kwargs):
+        self.connection_class = connection_class
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.connection_kwargs = connection_kwargs
+
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        # Made on first use, in the loop that uses it.
+        self.pool = None
+        self._connections = []
+
+    def _get_pool(self):
+        if self.pool is None:
+            # Fill up a LIFO queue with ``None`` placeholders.
+            self.pool = asyncio.LifoQueue(self.max_connections)
+            while True:
+                try:
+                    self.pool.put_nowait(None)
+                except asyncio.QueueFull:
+                    break
+        return self.pool
+
+    def make_connection(self):
+        "Make a fresh connection."
+        connection = self.connection_class(**self.connection_kwargs)
+        self._connections.append(connection)
+        return connection
+
+    async def get_connection(self):
+        try:
+            connection = await asyncio.wait_for(self._get_pool().get(),
+                                                self.timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhaustedError("No connection available.")
+
+        if connection is None:
+            connection = self.make_connection()
+        try:
+            await connection.connect()
+        except Exception:
+            self.pool.put_nowait(None)
+            raise
+        return connection
+
+    def release(self, connection):
+        "Release the connection back to the pool."
+        if connection.pid != self.pid or self.pool is None:
+            return
+        try:
+            self.pool.put_nowait(connection)
+        except asyncio.QueueFull:
+            pass
+
+    async def disconnect(self):
+        for connection in self._connections:
+            await connection.disconnect()
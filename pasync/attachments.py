@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Binary attachments: large payloads sent beside a task, not inside it.
+
+A task message lists its attachments as ``[name, size]`` pairs in
+``task_attachments``, and their raw bytes follow its frame back to back,
+with no framing or encoding. The client sends files with
+``socket.sendfile``; the server receives each into a ``Spool``, a
+memory-mapped file in ``TaskSession.spool_dir``, so a transfer takes the
+same memory whatever its size.
+
+Once they are all in, the server queues the task with
+``task_attachments`` mapping each name to its spool file. The worker maps
+the files read-only and passes them to the task function as ``mmap``
+keyword arguments, then unmaps and deletes them when the task ends.
+"""
+
+import mmap
+import os
+import sys
+import tempfile
+
+from pasync._compat import recv_into
+
+# Copy size for platforms without sendfile or direct receives.
+CHUNK_SIZE = 65536
+
+
+class Spool(object):
+    "A file of ``size`` bytes being filled from a socket through ``mmap``."
+
+    def __init__(self, size, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix='pasync-', suffix='.spool',
+                                         dir=directory)
+        try:
+            os.ftruncate(fd, size)
+            # A zero-length file can not be mapped.
+            self._map = mmap.mmap(fd, size) if size else None
+        except Exception:
+            os.close(fd)
+            os.unlink(self.path)
+            raise
+        os.close(fd)
+        self.size = size
+        self.offset = 0
+
+    def __repr__(self):
+        return "Spool<path={}, size={}>".format(self.path, self.size)
+
+    @property
+    def remaining(self):
+        return self.size - self.offset
+
+    def write(self, data):
+        "Store as much of ``data`` as fits and return how much that was."
+        n = min(len(data), self.remaining)
+        if n:
+            chunk = data[:n]
+            if sys.version_info[0] < 3:
+                # Python 2's mmap only takes a str.
+                chunk = chunk.tobytes() if isinstance(
+                    chunk, memoryview) else bytes(chunk)
+            self._map[self.offset:self.offset + n] = chunk
+            self.offset += n
+        return n
+
+    def recv(self, sock):
+        "Receive straight into the file; returns 0 if the peer closed."
+        n = min(self.remaining, CHUNK_SIZE * 16)
+        if sys.version_info[0] >= 3:
+            # Python 2's mmap has no buffer to slice a memoryview from.
+            view = memoryview(self._map)
+            try:
+                n = recv_into(sock, view[self.offset:self.offset + n])
+            finally:
+                view.release()
+            self.offset += n
+            return n
+        return self.write(sock.recv(min(n, CHUNK_SIZE)))
+
+    def close(self):
+        "Unmap the file, keeping it on disk."
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def discard(self):
+        self.close()
+        remove([self.path])
+
+
+def _fileno(source):
+    "The descriptor of a real file, None for an in-memory one."
+    try:
+        return source.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        # io.BytesIO raises io.UnsupportedOperation.
+        return None
+
+
+def offset_of(source):
+    "Where ``send`` starts reading ``source``."
+    return source.tell() if hasattr(source, 'read') else 0
+
+
+def size_of(source):
+    """The number of bytes ``send`` will send from ``source``: the rest of
+    a file from its current position, or all of a bytes-like object.
+    """
+    if not hasattr(source, 'read'):
+        return len(source)
+    fd = _fileno(source)
+    if fd is not None:
+        return os.fstat(fd).st_size - source.tell()
+    position = source.tell()
+    source.seek(0, os.SEEK_END)
+    end = source.tell()
+    source.seek(position)
+    return end - position
+
+
+def send(sock, source, offset, size):
+    "Send ``size`` bytes of ``source``, a file from ``offset`` or bytes."
+    if not hasattr(source, 'read'):
+        sock.sendall(source)
+    elif hasattr(sock, 'sendfile') and _fileno(source) is not None:
+        sock.sendfile(source, offset, size)
+    else:
+        source.seek(offset)
+        while size > 0:
+            data = source.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise IOError("{!r} ended early".format(source))
+            sock.sendall(data)
+            size -= len(data)
+
+
+def open_all(paths):
+    "Map the spool files of a task, ``{name: path}``, read-only."
+    maps = {}
+    try:
+        for name, path in paths.items():
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                maps[name] = mmap.mmap(f.fileno(), size,
+                                       access=mmap.ACCESS_READ) \
+                    if size else b''
+    except Exception:
+        close_all(maps)
+        raise
+    return maps
+
+
+def close_all(maps):
+    for value in maps.values():
+        if isinstance(value, mmap.mmap):
+            try:
+                value.close()
+            except BufferError:
+                # The task kept a view of it; it is unmapped when freed.
+                pass
+
+
+def remove(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from time import time as _time
+
+
+class LRUCache(object):
+    """A mapping of at most ``maxsize`` entries, dropping the least
+    recently used first; entries also expire ``ttl`` seconds after they
+    were set, unless set with ``ttl=None``.
+
+    Not thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires is not None and expires <= _time():
+            del self._data[key]
+            return default
+        # Move to the most recently used end.
+        del self._data[key]
+        self._data[key] = entry
+        return value
+
+    def set(self, key, value, ttl=-1):
+        "Store ``value``; ``ttl`` defaults to ``self.ttl``."
+        if ttl == -1:
+            ttl = self.ttl
+        self._data.pop(key, None)
+        self._data[key] = (None if ttl is None else _time() + ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
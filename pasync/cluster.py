@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""Client-side sharding over several QServer nodes.
+
+``ClusterClient`` routes each task to a node picked by its key on a
+consistent-hash ring, through one ``ConnectionPool`` per node. A node
+that can not be connected to or talked to is marked down and its keys
+move to the next nodes on the ring; it is retried after
+``retry_interval`` seconds and takes its keys back once it answers
+again. A node that is only busy (no free pooled connection, or no credit
+in time) keeps its keys and the error goes to the caller. Adding or
+removing a node only moves the keys of that node.
+"""
+
+import bisect
+import hashlib
+import itertools
+import logging
+import struct
+import threading
+import time
+import weakref
+
+from pasync._compat import b
+from pasync.connection import ConnectionPool
+from pasync.exceptions import (
+    ConnectionError, TimeoutError, FlowTimeoutError, PoolExhaustedError,
+    SocketRecvQueueEmptyError
+)
+
+logger = logging.getLogger(__name__)
+
+_POINTS = struct.Struct('<IIII')
+
+
+class HashRing(object):
+    """Consistent-hash ring with ``replicas`` virtual nodes per node.
+
+    Each md5 digest gives four points, as in ketama.
+    """
+
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = []
+        self._members = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, node):
+        return node in self._members
+
+    @property
+    def nodes(self):
+        return sorted(self._members)
+
+    @staticmethod
+    def _hash(key):
+        return _POINTS.unpack(hashlib.md5(b(key)).digest())
+
+    def add_node(self, node):
+        if node in self._members:
+            return
+        self._members.add(node)
+        points = []
+        for i in range(self.replicas // 4):
+            points.extend(self._hash('{}-{}'.format(node, i)))
+        for point in points:
+            i = bisect.bisect(self._keys, point)
+            self._keys.insert(i, point)
+            self._nodes.insert(i, node)
+
+    def remove_node(self, node):
+        if node not in self._members:
+            return
+        self._members.discard(node)
+        kept = [(k, n) for k, n in zip(self._keys, self._nodes) if n != node]
+        self._keys = [k for k, _ in kept]
+        self._nodes = [n for _, n in kept]
+
+    def get_node(self, key):
+        for node in self.iter_nodes(key):
+            return node
+        return None
+
+    def iter_nodes(self, key):
+        "Yield each node once, starting with the owner of ``key``."
+        if not self._keys:
+            return
+        start = bisect.bisect(self._keys, self._hash(key)[0])
+        seen = set()
+        count = len(self._keys)
+        for i in range(count):
+            node = self._nodes[(start + i) % count]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self._members):
+                    return
+
+
+def _node_name(node):
+    if isinstance(node, (tuple, list)):
+        return '{}:{}'.format(*node)
+    return node
+
+
+class ClusterClient(object):
+    """Sends tasks to a set of QServer ``nodes``.
+
+    ``nodes`` are ``'host:port'`` strings or ``(host, port)`` tuples; other
+    keyword arguments go to every node's ``ConnectionPool``. Tasks with
+    the same ``key`` go to the same node while it is up; tasks without
+    one are spread over the ring.
+
+    Task ids are unique across the cluster client, so a result is fetched
+    with ``get_result(ack['task_id'])``; ``ack['node']`` says where the
+    task went.
+    """
+
+    def __init__(self, nodes, replicas=160, retry_interval=30,
+                 pool_class=ConnectionPool, **pool_kwargs):
+        self.replicas = replicas
+        self.retry_interval = retry_interval
+        self.pool_class = pool_class
+        self.pool_kwargs = pool_kwargs
+        self.ring = HashRing(replicas=replicas)
+        self.pools = {}
+        self._lock = threading.Lock()
+        self._down = {}
+        self._task_ids = itertools.count()
+        self._spread = itertools.count()
+        # task_id -> connection that will receive its result, and a lock
+        # per connection so that reading a result never races a send.
+        self._owners = {}
+        self._connection_locks = weakref.WeakKeyDictionary()
+        for node in nodes:
+            self.add_node(node)
+
+    def __repr__(self):
+        return "ClusterClient<nodes={}>".format(self.ring.nodes)
+
+    def add_node(self, node):
+        name = _node_name(node)
+        host, port = name.rsplit(':', 1)
+        with self._lock:
+            if name in self.pools:
+                return
+            self.pools[name] = self.pool_class(host=host, port=int(port),
+                                               **self.pool_kwargs)
+            self.ring.add_node(name)
+
+    def remove_node(self, node):
+        name = _node_name(node)
+        with self._lock:
+            pool = self.pools.pop(name, None)
+            self.ring.remove_node(name)
+            self._down.pop(name, None)
+        if pool is not None:
+            pool.disconnect()
+
+    def is_down(self, node):
+        until = self._down.get(node)
+        return until is not None and time.time() < until
+
+    def mark_down(self, node, error=None):
+        with self._lock:
+            if node not in self.pools:
+                return
+            first = node not in self._down
+            self._down[node] = time.time() + self.retry_interval
+        if first:
+            logger.warning("Node {} is down: {}".format(node, error))
+
+    def _mark_up(self, node):
+        if node in self._down:
+            with self._lock:
+                if self._down.pop(node, None) is not None:
+                    logger.info("Node {} is back".format(node))
+
+    def nodes_for(self, key):
+        "Candidate nodes for ``key``: its owner first, down nodes skipped."
+        for node in self.ring.iter_nodes(key):
+            if not self.is_down(node):
+                yield node
+
+    def _route_key(self, key):
+        return str(next(self._spread)) if key is None else str(key)
+
+    def _send_to_node(self, node, contents, kwargs_list):
+        pool = self.pools[node]
+        connection = pool.get_connection()
+        lock = self._connection_locks.setdefault(connection,
+                                                 threading.Lock())
+        try:
+            with lock:
+                tasks = []
+                for data, kwargs in zip(contents, kwargs_list):
+                    connection.task_id = next(self._task_ids)
+                    tasks.append(connection.pack_task(data, **kwargs))
+                acks = connection.send_packed_tasks(tasks)
+        except (ConnectionError, TimeoutError):
+            self._connection_locks.pop(connection, None)
+            raise
+        finally:
+            pool.release(connection)
+        for ack in acks:
+            ack['node'] = node
+            if ack.get('task_ack'):
+                self._owners[ack['task_id']] = connection
+        return acks
+
+    def _send_group(self, key, contents, kwargs_list):
+        last_error = None
+        for node in self.nodes_for(key):
+            try:
+                acks = self._send_to_node(node, contents, kwargs_list)
+            except (PoolExhaustedError, FlowTimeoutError):
+                # Busy, not down: moving its keys would split them.
+                raise
+            except (ConnectionError, TimeoutError) as e:
+                self.mark_down(node, e)
+                if any(getattr(e, 'acks', None) or ()):
+                    # Part of the group is queued there; resending it
+                    # elsewhere would run those tasks twice.
+                    raise
+                last_error = e
+                continue
+            self._mark_up(node)
+            return acks
+        raise ConnectionError("No node available for key {!r}: {}".format(
+            key, last_error))
+
+    def send(self, data, key=None, **kwargs):
+        """Submit one task, routed by ``key``, and return its ack.
+
+        Without ``key`` a task's ``idempotency_key`` routes it, so that its
+        resends reach the node that remembers it.
+        """
+        if key is None:
+            key = kwargs.get('idempotency_key')
+        return self._send_group(self._route_key(key), [data], [kwargs])[0]
+
+    def send_many(self, tasks, keys=None):
+        """Submit every task content in ``tasks`` with one pipelined round
+        trip per node, and return the acks in order.
+
+        ``keys``, if given, holds the routing key of each task.
+        """
+        if keys is None:
+            keys = [None] * len(tasks)
+        groups = {}
+        for i, (data, key) in enumerate(zip(tasks, keys)):
+            key = self._route_key(key)
+            node = next(self.nodes_for(key), None)
+            if node is None:
+                raise ConnectionError("No node available")
+            groups.setdefault(node, ([], key))[0].append(i)
+
+        acks = [None] * len(tasks)
+        for node, (indexes, key) in groups.items():
+            # Retries of a failed node's group follow the ring from the
+            # key of its first task.
+            group_acks = self._send_group(
+                key, [tasks[i] for i in indexes], [{}] * len(indexes))
+            for i, ack in zip(indexes, group_acks):
+                acks[i] = ack
+        return acks
+
+    def get_result(self, task_id, timeout=5):
+        "Wait up to ``timeout`` for the result of a task sent from here."
+        connection = self._owners.get(task_id)
+        if connection is None:
+            raise SocketRecvQueueEmptyError(
+                "Unknown task_id: {!r}".format(task_id))
+        lock = self._connection_locks.get(connection)
+        if lock is None:
+            # Its connection failed since.
+            self._owners.pop(task_id, None)
+            raise ConnectionError("Connection of task {!r} was lost".format(
+                task_id))
+        deadline = time.time() + timeout
+        while True:
+            # Poll in short slices so senders sharing the connection are
+            # not held up for the whole timeout.
+            with lock:
+                try:
+                    result = connection.get_result(
+                        task_id, timeout=min(0.05, max(
+                            0, deadline - time.time())))
+                except SocketRecvQueueEmptyError:
+                    if time.time() >= deadline:
+                        raise
+                    continue
+            self._owners.pop(task_id, None)
+            return result
+
+    def disconnect(self):
+        for pool in list(self.pools.values()):
+            pool.disconnect()
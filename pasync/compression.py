@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Payload compression.
+
+Like the serializer, a compressor is agreed on in the ``hello`` exchange:
+the client lists the ones it prefers, and the server picks the first it
+also allows, or none. From then on every frame payload, both ways, starts
+with a flag byte: ``FLAG_RAW`` or ``FLAG_COMPRESSED``. Each side only
+compresses payloads of at least its own ``threshold`` bytes, as small
+messages cost more CPU than they save.
+
+Both sides may also hold a shared dictionary, which helps the small,
+similar messages most, for compressors that support one (zlib on
+Python 3, zstd). It is named in the handshake by ``dictionary_id``, and
+only used if the server has the same one.
+
+zlib is always there; lz4 and zstd are used when their packages are
+installed.
+"""
+
+import hashlib
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from pasync._compat import b
+from pasync.exceptions import InvalidResponse
+from pasync.protocol import MAX_FRAME_SIZE
+
+FLAG_RAW = b('\x00')
+FLAG_COMPRESSED = b('\x01')
+
+DEFAULT_THRESHOLD = 1024
+
+
+def dictionary_id(dictionary):
+    "The name both sides use for a shared ``dictionary`` (bytes)."
+    return hashlib.sha1(dictionary).hexdigest()[:16]
+
+
+class Compressor(object):
+    """Base compressor, optionally primed with a shared ``dictionary``.
+
+    Instances may be used from several threads at once.
+    """
+    name = None
+    supports_dictionary = False
+
+    def __init__(self, dictionary=None):
+        self.dictionary = dictionary if self.supports_dictionary else None
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data, max_size):
+        "Raise ``ValueError`` rather than inflate past ``max_size``."
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+class ZlibCompressor(Compressor):
+    name = 'zlib'
+    # zdict arrived in Python 3.3.
+    supports_dictionary = sys.version_info >= (3, 3)
+    level = 1
+
+    def compress(self, data):
+        if self.dictionary is None:
+            return zlib.compress(data, self.level)
+        c = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, 9,
+                             zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+        return c.compress(data) + c.flush()
+
+    def decompress(self, data, max_size):
+        if self.dictionary is None:
+            d = zlib.decompressobj()
+        else:
+            d = zlib.decompressobj(zdict=self.dictionary)
+        result = d.decompress(data, max_size)
+        if d.unconsumed_tail:
+            raise ValueError("larger than {} bytes".format(max_size))
+        # Python 2 has no eof to tell a truncated stream by.
+        if not getattr(d, 'eof', True):
+            raise ValueError("incomplete stream")
+        return result
+
+
+class LZ4Compressor(Compressor):
+    name = 'lz4'
+
+    def compress(self, data):
+        return lz4_frame.compress(data)
+
+    def decompress(self, data, max_size):
+        d = lz4_frame.LZ4FrameDecompressor()
+        # One byte over is enough to tell, without inflating the rest.
+        result = d.decompress(data, max_size + 1)
+        if len(result) > max_size:
+            raise ValueError("larger than {} bytes".format(max_size))
+        if not d.eof:
+            raise ValueError("incomplete frame")
+        return result
+
+
+class ZstdCompressor(Compressor):
+    name = 'zstd'
+    supports_dictionary = True
+    level = 3
+
+    def __init__(self, dictionary=None):
+        Compressor.__init__(self, dictionary)
+        self._dict = None
+        if self.dictionary is not None:
+            self._dict = zstandard.ZstdCompressionDict(self.dictionary)
+            self._dict.precompute_compress(level=self.level)
+        # zstandard contexts are not thread-safe.
+        self._local = threading.local()
+
+    def _contexts(self):
+        local = self._local
+        if not hasattr(local, 'compressor'):
+            kwargs = {} if self._dict is None else {'dict_data': self._dict}
+            local.compressor = zstandard.ZstdCompressor(level=self.level,
+                                                        **kwargs)
+            local.decompressor = zstandard.ZstdDecompressor(**kwargs)
+        return local
+
+    def compress(self, data):
+        return self._contexts().compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        return self._contexts().decompressor.decompress(
+            data, max_output_size=max_size)
+
+
+_compressors = OrderedDict()
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def register_compressor(cls):
+    "Make the compressor class ``cls`` available under its ``name``."
+    _compressors[cls.name] = cls
+    return cls
+
+
+def available_compressors():
+    return list(_compressors)
+
+
+def get_compressor(name, dictionary=None):
+    "A shared ``name`` compressor using ``dictionary`` if it can."
+    cls = _compressors.get(name)
+    if cls is None:
+        raise ValueError("Unknown compressor: {!r}".format(name))
+    if not cls.supports_dictionary:
+        dictionary = None
+    key = name, dictionary
+    with _instances_lock:
+        compressor = _instances.get(key)
+        if compressor is None:
+            compressor = _instances[key] = cls(dictionary)
+    return compressor
+
+
+def negotiate(offered, allowed):
+    "Pick the first of the client's ``offered`` names the server allows."
+    for name in offered:
+        if name in allowed and name in _compressors:
+            return name
+    return None
+
+
+def encode(payload, compressor, threshold=DEFAULT_THRESHOLD):
+    "Flag ``payload``, compressed if it is big enough and that helps."
+    if compressor is None:
+        return payload
+    if len(payload) >= threshold:
+        data = compressor.compress(payload)
+        if len(data) < len(payload):
+            return FLAG_COMPRESSED + data
+    return FLAG_RAW + payload
+
+
+def decode(payload, compressor):
+    "Undo ``encode``."
+    if compressor is None:
+        return payload
+    flag = payload[:1]
+    if flag == FLAG_RAW:
+        return payload[1:]
+    if flag != FLAG_COMPRESSED:
+        raise InvalidResponse("Protocol Error: bad compression flag %r" %
+                              (flag,))
+    try:
+        return compressor.decompress(payload[1:], MAX_FRAME_SIZE)
+    except Exception as e:
+        raise InvalidResponse("Protocol Error: cannot decompress: {}".format(
+            e))
+
+
+register_compressor(ZlibCompressor)
+if lz4_frame is not None:
+    register_compressor(LZ4Compressor)
+if zstandard is not None:
+    register_compressor(ZstdCompressor)
@@ -3,20 +3,25 @@
 import socket
 import os
 import sys
+import time
+import logging
 import threading
+import weakref
+from collections import OrderedDict, deque
 from select import select
 
 from pasync._compat import (
-    Empty, Full, iteritems, BytesIO, recv, b, byte_to_chr,
-    nativerstr
+    iteritems, recv_into, b, byte_to_chr, nativerstr, basestring, unicode,
+    long, xrange
 )
-from pasync._compat import LifoQueue, Queue
-from pasync.hooks import task_callback_hook
+from pasync import attachments as _attachments, compression
+from pasync.protocol import pack_frame
 from pasync.exceptions import (
     PAsyncError,
     TimeoutError,
     ConnectionError,
-    SocketQueueError,
+    FlowTimeoutError,
+    PoolExhaustedError,
     SocketRecvQueueFullError,
     SocketRecvQueueEmptyError,
     InvalidResponse,
@@ -26,7 +31,13 @@ from pasync.exceptions import (
     NoScriptError,
     ReadOnlyError
 )
-from pasync.utils import json_encode, json_decode
+from pasync.metrics import registry
+from pasync.serializers import (
+    DEFAULT_SERIALIZER, available_serializers, get_serializer
+)
+from pasync.utils import to_timestamp
+
+_DEFAULT_THRESHOLD = compression.DEFAULT_THRESHOLD
 
 SYM_STAR = b('*')
 SYM_DOLLAR = b('$')
@@ -35,6 +46,26 @@ SYM_EMPTY = b('')
 
 SERVER_CLOSED_CONNECTION_ERROR = "Connection closed by server."
 
+logger = logging.getLogger(__name__)
+
+pool_connections_created = registry.counter(
+    'pasync_pool_connections_created_total',
+    "Connections opened by connection pools.")
+pool_connections_in_use = registry.gauge(
+    'pasync_pool_connections_in_use',
+    "Connections currently checked out of connection pools.")
+pool_wait_seconds = registry.histogram(
+    'pasync_pool_wait_seconds', "Time spent waiting for a pooled connection.")
+pool_exhausted = registry.counter(
+    'pasync_pool_exhausted_total',
+    "get_connection calls that timed out with no connection free.")
+pool_connections_evicted = registry.counter(
+    'pasync_pool_connections_evicted_total',
+    "Pooled connections closed for being idle or old for too long.")
+pool_health_check_failures = registry.counter(
+    'pasync_pool_health_check_failures_total',
+    "Pooled connections found dead on checkout.")
+
 
 class Token(object):
     def __init__(self, value):
@@ -72,31 +103,56 @@ class BaseParser(object):
 
 
 class SocketBuffer(object):
+    """Receive buffer for one socket.
+
+    Data is received with ``recv_into`` straight into a reusable
+    ``bytearray``; ``_start``/``_end`` delimit the unread bytes and
+    ``_scan`` is where ``readline`` resumes looking for CRLF, so a partial
+    line is never searched twice. Replies are copied out exactly once, from
+    a ``memoryview`` slice.
+    """
+    # Drop a buffer that grew for one huge frame once it has been drained.
+    max_idle_size = 1024 * 1024
+
     def __init__(self, socket, socket_read_size):
         self._sock = socket
         self.socket_read_size = socket_read_size
-        self._buffer = BytesIO()
-        self.bytes_written = 0
-        self.bytes_read = 0
+        # Allocated on first read; a server may hold many idle buffers.
+        self._buffer = bytearray()
+        self._view = memoryview(self._buffer)
+        self._start = self._end = self._scan = 0
 
     @property
     def length(self):
-        return self.bytes_written - self.bytes_read
+        return self._end - self._start
 
-    def _read_from_socket(self, length=None):
-        socket_read_size = self.socket_read_size
+    def _reserve(self, size):
+        "Make room for ``size`` more bytes after ``_end``."
         buf = self._buffer
-        buf.seek(self.bytes_written)
+        if len(buf) - self._end >= size:
+            return
+        start, unread = self._start, self._end - self._start
+        if unread + size <= len(buf):
+            buf[:unread] = buf[start:self._end]
+        else:
+            buf = bytearray(max(2 * len(buf), unread + size))
+            buf[:unread] = self._view[start:self._end]
+            self._buffer = buf
+            self._view = memoryview(buf)
+        self._scan -= start
+        self._start, self._end = 0, unread
+
+    def _read_from_socket(self, length=None):
         marker = 0
 
         try:
             while True:
-                data = recv(self._sock, socket_read_size)
-                if isinstance(data, bytes) and len(data) == 0:
+                self._reserve(max(self.socket_read_size,
+                                  (length or 0) - marker))
+                data_length = recv_into(self._sock, self._view[self._end:])
+                if not data_length:
                     raise socket.error(SERVER_CLOSED_CONNECTION_ERROR)
-                buf.write(data)
-                data_length = len(data)
-                self.bytes_written += data_length
+                self._end += data_length
                 marker += data_length
 
                 if length is not None and length > marker:
@@ -110,50 +166,71 @@ class SocketBuffer(object):
                                   (e.args,))
 
     def read(self, length):
-        length += 2
-
-        if length > self.length:
-            self._read_from_socket(length - self.length)
-
-        self._buffer.seek(self.bytes_read)
-        data = self._buffer.read(length)
-        self.bytes_read += len(data)
-
-        if self.bytes_read == self.bytes_written:
+        start = self._start
+        stop = start + length
+        if stop + 2 > self._end:
+            self._read_from_socket(stop + 2 - self._end)
+            start = self._start
+            stop = start + length
+
+        data = self._view[start:stop].tobytes()
+        stop += 2
+        if stop < self._end:
+            self._start = self._scan = stop
+        else:
             self.purge()
-
-        return data[:-2]
+        return data
 
     def readline(self):
-        buf = self._buffer
-        buf.seek(self.bytes_read)
-        data = buf.readline()
-
-        while not data.endswith(SYM_CRLF):
+        end = self._buffer.find(SYM_CRLF, self._scan, self._end)
+        while end < 0:
+            # The CR may already be here with the LF still to come.
+            self._scan = max(self._start, self._end - 1)
             self._read_from_socket()
-            buf.seek(self.bytes_read)
-            data = buf.readline()
-
-        self.bytes_read += len(data)
+            end = self._buffer.find(SYM_CRLF, self._scan, self._end)
 
-        if self.bytes_read == self.bytes_written:
+        data = self._view[self._start:end].tobytes()
+        end += 2
+        if end < self._end:
+            self._start = self._scan = end
+        else:
             self.purge()
-
-        return data[:-2]
+        return data
+
+    def read_into(self, spool):
+        """Move raw bytes into ``spool``: what is buffered, or else one
+        receive straight from the socket. Returns how many.
+        """
+        if self._end > self._start:
+            start = self._start
+            n = spool.write(self._view[start:min(self._end,
+                                                  start + spool.remaining)])
+            if start + n < self._end:
+                self._start = self._scan = start + n
+            else:
+                self.purge()
+            return n
+        try:
+            n = spool.recv(self._sock)
+        except socket.timeout:
+            raise TimeoutError("Timeout reading from socket")
+        except socket.error:
+            e = sys.exc_info()[1]
+            raise ConnectionError("Error while reading from socket: %s" %
+                                  (e.args,))
+        if not n:
+            raise ConnectionError(SERVER_CLOSED_CONNECTION_ERROR)
+        return n
 
     def purge(self):
-        self._buffer.seek(0)
-        self._buffer.truncate()
-        self.bytes_written = 0
-        self.bytes_read = 0
+        self._start = self._end = self._scan = 0
+        if len(self._buffer) > self.max_idle_size:
+            self._buffer = bytearray()
+            self._view = memoryview(self._buffer)
 
     def close(self):
-        try:
-            self.purge()
-            self._buffer.close()
-        except:
-            pass
         self._buffer = None
+        self._view = None
         self._sock = None
 
 
@@ -194,7 +271,7 @@ class PythonParser(BaseParser):
         if not response:
             raise ConnectionError(SERVER_CLOSED_CONNECTION_ERROR)
 
-        byte, response = byte_to_chr(response[0], response[1:])
+        byte, response = byte_to_chr(response[0]), response[1:]
 
         if byte not in ('-', '+', ':', '$', '*'):
             raise InvalidResponse("Protocol Error: %s, %s" %
@@ -232,9 +309,13 @@ class Connection(object):
     def __init__(self, host="localhost", port=1234, socket_timeout=None,
                  socket_connect_timeout=None, socket_keepalive=False,
                  socket_keepalive_options=None, retry_on_time=False,
-                 encoding='utf-8', encoding_errors='strict', queue_class=Queue,
-                 queue_timeout=5, queue_max_size=100, decode_responses=False,
-                 parser_class=PythonParser, socket_read_size=65536):
+                 encoding='utf-8', encoding_errors='strict',
+                 queue_max_size=None, decode_responses=False,
+                 parser_class=PythonParser, socket_read_size=65536,
+                 serializer=DEFAULT_SERIALIZER, initial_credit=100,
+                 flow_timeout=None, compression=None,
+                 compress_threshold=_DEFAULT_THRESHOLD,
+                 compression_dict=None):
         self.pid = os.getpid()
         self.host = host
         self.port = port
@@ -246,22 +327,37 @@ class Connection(object):
         self.encoding = encoding
         self.encoding_errors = encoding_errors
         self.decode_responses = decode_responses
-        self.queue_class = queue_class
         self.queue_max_size = queue_max_size
-        self.queue_timeout = queue_timeout
         self.socket_read_size = socket_read_size
+        # A name or a list of names in order of preference; what the
+        # server agrees to ends up in ``self.serializer`` on connect.
+        self.serializers = [serializer] if isinstance(
+            serializer, basestring) else list(serializer)
+        self.serializer = get_serializer(DEFAULT_SERIALIZER)
+        # Compressors to offer the same way, used for messages of at least
+        # ``compress_threshold`` bytes; see ``pasync.compression``.
+        self.compressors = [compression] if isinstance(
+            compression, basestring) else list(compression or ())
+        self.compress_threshold = compress_threshold
+        self.compression_dict = compression_dict
+        self.compressor = None
+        # Tasks the server lets us send before it acks more; ``None`` when
+        # the server does not do flow control. Refreshed by every ack.
+        self.initial_credit = initial_credit
+        self.credit = initial_credit
+        self.flow_timeout = flow_timeout
         self._sock = None
         self._parser = parser_class(socket_read_size)
         self._connect_callback = []
-        # register callback
-        task_callback_hook.register(self._set_result)
 
         self.task_id = 0
 
-        self._init_queue()
-
-    def _init_queue(self):
-        self.queue = self.queue_class(maxsize=self.queue_max_size)
+        # Unclaimed task results keyed by task_id, in arrival order, and
+        # the unread chunks of streaming tasks.
+        self._results = OrderedDict()
+        self._streams = {}
+        # task_id -> [(source, offset, size)] of tasks still to be sent.
+        self._attachments = {}
 
     def __repr__(self):
         return self.description_format.format(self.host, self.port)
@@ -286,6 +382,13 @@ class Connection(object):
         self._sock = sock
         try:
             self.on_connect()
+        except socket.timeout:
+            self.disconnect()
+            raise TimeoutError("Timeout during the handshake")
+        except socket.error:
+            e = sys.exc_info()[1]
+            self.disconnect()
+            raise ConnectionError(self._error_message(e))
         except PAsyncError:
             self.disconnect()
             raise
@@ -335,6 +438,54 @@ class Connection(object):
 
     def on_connect(self):
         self._parser.on_connect(self)
+        self.serializer = get_serializer(DEFAULT_SERIALIZER)
+        self.compressor = None
+        self.credit = self.initial_credit
+        if self.serializers != [DEFAULT_SERIALIZER] or self.compressors:
+            self.hello()
+
+    def hello(self):
+        """Agree on a serializer with the server, which may pick JSON, and
+        on a compressor, which it may decline.
+        """
+        # Like compressors, serializers not installed here are not
+        # offered; with none left the server picks JSON.
+        options = {'serializers': [
+            name for name in self.serializers
+            if name in available_serializers()]}
+        if self.compressors:
+            options['compression'] = [
+                name for name in self.compressors
+                if name in compression.available_compressors()]
+            if self.compression_dict is not None:
+                options['dictionary'] = compression.dictionary_id(
+                    self.compression_dict)
+        self._sock.sendall(pack_frame(self.serializer.dumps(
+            {'hello': options})))
+        reply = self.serializer.loads(self.read_response())
+        hello = reply.get('hello') or {}
+        self.serializer = get_serializer(hello.get('serializer',
+                                                   DEFAULT_SERIALIZER))
+        self.credit = hello.get('credit', self.credit)
+        if hello.get('compression'):
+            self.compressor = compression.get_compressor(
+                hello['compression'], self.compression_dict
+                if hello.get('dictionary') else None)
+
+    def pack(self, message):
+        "Encode ``message`` as a frame for this connection."
+        payload = self.serializer.dumps(message)
+        if self.compressor is not None:
+            payload = compression.encode(payload, self.compressor,
+                                         self.compress_threshold)
+        return pack_frame(payload)
+
+    def read_payload(self):
+        "Read the next message's decoded, but not yet deserialized, bytes."
+        payload = self.read_response()
+        if self.compressor is not None:
+            payload = compression.decode(payload, self.compressor)
+        return payload
 
     def disconnect(self):
         self._parser.on_disconnect()
@@ -347,29 +498,196 @@ class Connection(object):
             pass
         self._sock = None
 
-    def send(self, data, ack=True, **kwargs):
+    def pack_task(self, data, priority=0, eta=None, countdown=None,
+                  idempotency_key=None, attachments=None, **kwargs):
+        """Build the next task message and reserve its ``task_id``.
+
+        Higher ``priority`` tasks are run first. A task with ``eta`` (a Unix
+        timestamp or datetime) or ``countdown`` (seconds from now) waits on
+        the server until then, and is queued at its priority.
+
+        Tasks sent with the same ``idempotency_key`` run once: a resend gets
+        the first one's result (under its own ``task_id``) and an ack with
+        ``task_duplicate`` set.
+
+        ``attachments`` maps parameter names to large payloads, sent raw
+        after the task instead of encoded in it: files (from their current
+        position on, with ``sendfile`` if they have a descriptor) or
+        bytes. The task
+        function gets each as a read-only ``mmap``.
+        """
         task = {
             'task_id': self.task_id,
             'task_content': data,
-            'task_params': kwargs
+            'task_params': kwargs,
+            'task_priority': priority
         }
+        if countdown is not None:
+            eta = time.time() + countdown
+        if eta is not None:
+            task['task_eta'] = to_timestamp(eta)
+        if idempotency_key is not None:
+            task['task_key'] = idempotency_key
+        if attachments:
+            specs, sources = [], []
+            for name, source in attachments.items():
+                offset = _attachments.offset_of(source)
+                size = _attachments.size_of(source)
+                specs.append([name, size])
+                sources.append((source, offset, size))
+            task['task_attachments'] = specs
+            self._attachments[self.task_id] = sources
+        self.task_id += 1
+        return task
+
+    def send(self, data, ack=True, **kwargs):
+        "Submit one task and return its ack; ``ack['task_id']`` names it."
+        received = self.send_packed_tasks([self.pack_task(data, **kwargs)])[0]
+        if ack and received.get('task_ack') is not True:
+            raise ResponseError(received.get('msg'))
+        return received
+
+    def send_many(self, tasks):
+        "Submit every task content in ``tasks`` with pipelined round trips."
+        pipe = self.pipeline()
+        for data in tasks:
+            pipe.send(data)
+        return pipe.execute()
+
+    def pipeline(self, chunk_size=1000):
+        return Pipeline(self, chunk_size=chunk_size)
+
+    def send_packed_tasks(self, tasks):
+        """Send ``tasks`` within the server's credit and return their acks.
+
+        Tasks go out in pipelined batches of at most ``credit``, one
+        ``sendall`` each. With no credit left this blocks, up to
+        ``flow_timeout`` seconds, until the server grants more. Tasks the
+        server turned away because its queue was full are sent again then,
+        so none is dropped. Acks are matched to tasks by ``task_id`` and
+        returned in the order the tasks were given.
+
+        An error raised part way has the acks received so far, in the same
+        order and None for the rest, as its ``acks``.
+        """
         if self._sock is None:
             raise ConnectionError("Socket has not created!!")
 
+        deadline = None
+        if self.flow_timeout is not None:
+            deadline = time.time() + self.flow_timeout
+        received = {}
+        pending = list(tasks)
         try:
-            self._sock.sendall(json_encode(task))
-            received = json_decode(self._sock.recv(self.socket_read_size))
-            # After received ack
-            self.task_id += 1
-            if ack:
-                if received.get('task_ack') is True:
-                    pass
+            while pending:
+                self._wait_for_credit(deadline)
+                if self.credit is None:
+                    batch, pending = pending, []
                 else:
-                    print received.get('msg')
+                    batch = pending[:self.credit]
+                    pending = pending[self.credit:]
+                    self.credit -= len(batch)
+                try:
+                    self._send_batch(batch)
+                    acks = {}
+                    while len(acks) < len(batch):
+                        ack = self.read_message()
+                        if ack is not None:
+                            acks[ack.get('task_id')] = ack
+                except Exception:
+                    self.disconnect()
+                    raise
+                received.update(acks)
+                pending = [t for t in batch if self._should_resend(
+                    acks.get(t['task_id']))] + pending
+        except PAsyncError as e:
+            e.acks = [received.get(t['task_id']) for t in tasks]
+            raise
+        finally:
+            if self._attachments:
+                for t in tasks:
+                    self._attachments.pop(t['task_id'], None)
+        return [received.get(t['task_id']) for t in tasks]
+
+    def _send_batch(self, batch):
+        frames = []
+        for t in batch:
+            frames.append(self.pack(t))
+            sources = self._attachments.get(t['task_id'])
+            if sources:
+                # Their bytes follow the frame unframed.
+                self._sock.sendall(SYM_EMPTY.join(frames))
+                frames = []
+                for source, offset, size in sources:
+                    _attachments.send(self._sock, source, offset, size)
+        if frames:
+            self._sock.sendall(SYM_EMPTY.join(frames))
+
+    @staticmethod
+    def _should_resend(ack):
+        "A task rejected by a server doing flow control is retried."
+        return ack is not None and not ack.get('task_ack') and \
+            'credit' in ack
+
+    def _wait_for_credit(self, deadline):
+        while self.credit is not None and self.credit <= 0:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise FlowTimeoutError(
+                        "Timeout waiting for server credit")
+            if self.can_read(timeout):
+                self.read_message()
+
+    def stats(self):
+        "Return the server's metrics snapshot."
+        if self._sock is None:
+            self.connect()
+        try:
+            self._sock.sendall(self.pack({'stats': True}))
+            while True:
+                message = self.serializer.loads(self.read_payload())
+                if 'stats' in message:
+                    return message['stats']
+                if 'task_ack' not in message:
+                    self._set_result(message)
         except Exception:
             self.disconnect()
             raise
 
+    def read_message(self):
+        """Read one message, queueing it if it is a task result.
+
+        Results are pushed by the server as soon as a task finishes, so they
+        may arrive between acks. Returns the message if it is an ack.
+        """
+        message = self.serializer.loads(self.read_payload())
+        if 'task_ack' in message:
+            self.credit = message.get('credit')
+            return message
+        if 'credit' in message:
+            self.credit = message['credit']
+            return
+        self._set_result(message)
+
+    def check_health(self):
+        """Cheap liveness probe: no round trip, only a look for EOF or an
+        error on the socket. Unread task results count as alive.
+        """
+        sock = self._sock
+        if sock is None:
+            return False
+        try:
+            readable, _, failed = select([sock], [], [sock], 0)
+            if failed:
+                return False
+            if not readable:
+                return True
+            return bool(sock.recv(1, socket.MSG_PEEK))
+        except (socket.error, ValueError):
+            return False
+
     def can_read(self, timeout=0):
         sock = self._sock
         if not sock:
@@ -404,54 +722,204 @@ class Connection(object):
         return value
 
     def _set_result(self, ret):
-        if not hasattr(self, "queue"):
-            raise SocketQueueError("Socket queue has not Initialized")
-
-        if self.queue.qsize() < self.queue_max_size:
-            self.queue.put_nowait(ret)
+        if ret.get('task_status') == 'CHUNK':
+            self._streams.setdefault(ret.get('task_id'), deque()).append(
+                ret.get('task_result'))
+            return
+        if self.queue_max_size is not None and \
+                len(self._results) >= self.queue_max_size:
+            raise SocketRecvQueueFullError(
+                "Socket result has too many results hasn't been consume."
+                "use **conn.get_result()** to consume."
+            )
+        self._results[ret.get('task_id')] = ret
+
+    def get_result(self, task_id=None, timeout=5):
+        """Return a task result message, waiting up to ``timeout``.
+
+        With ``task_id`` wait for that task's result, otherwise return the
+        oldest unclaimed one. A result message is a dict with ``task_id``,
+        ``task_status`` and ``task_result``.
+        """
+        results = self._results
+        deadline = time.time() + timeout
+        while not (task_id in results if task_id is not None else results):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SocketRecvQueueEmptyError("No reslut.")
+            if self.can_read(remaining):
+                self.read_message()
+        if task_id is None:
+            result = results.popitem(last=False)[1]
         else:
-            try:
-                self.queue.put(ret, timeout=self.queue_timeout)
-            except Full:
-                raise SocketRecvQueueFullError(
-                    "Socket result has too many results hasn't been consume."
-                    "use **conn.get(result)** to consume."
-                )
-
-    def get_result(self, timeout=5):
-        if self.queue.qsize() > 0:
-            return self.queue.get_nowait()
+            result = results.pop(task_id)
+        if 'task_chunks' in result:
+            self._streams.pop(result.get('task_id'), None)
+        return result
+
+    def iter_results(self, task_id, timeout=5):
+        """Yield the result of a task piece by piece as the server sends it.
+
+        A generator task streams the values it yields, and they come out
+        here as they arrive, waiting up to ``timeout`` for each; any other
+        task yields its one result. Raises ``ResponseError`` if the task
+        fails, after the chunks sent before the failure.
+
+        Chunks are only read from the socket as the iterator is consumed,
+        so a slow consumer slows the task down rather than piling them up.
+        """
+        streams = self._streams
+        results = self._results
+        deadline = time.time() + timeout
+        while True:
+            chunks = streams.get(task_id)
+            if chunks:
+                yield chunks.popleft()
+                deadline = time.time() + timeout
+                continue
+            if task_id in results:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SocketRecvQueueEmptyError("No reslut.")
+            if self.can_read(remaining):
+                self.read_message()
+        result = results.pop(task_id)
+        streams.pop(task_id, None)
+        if result.get('task_status') != 'SUCCESS':
+            raise ResponseError(result.get('task_result'))
+        if 'task_chunks' not in result:
+            yield result.get('task_result')
+
+
+class Pipeline(object):
+    """Buffer tasks and submit them together.
+
+    Tasks are written ``chunk_size`` at a time so that unread acks never
+    fill the socket buffers while we are still sending.
+    """
+
+    def __init__(self, connection, chunk_size=1000):
+        self.connection = connection
+        self.chunk_size = chunk_size
+        self.tasks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def reset(self):
+        for task in self.tasks:
+            self.connection._attachments.pop(task['task_id'], None)
+        self.tasks = []
+
+    def send(self, data, **kwargs):
+        self.tasks.append(self.connection.pack_task(data, **kwargs))
+        return self
+
+    def execute(self):
+        "Submit the buffered tasks and return their acks in order."
+        tasks, self.tasks = self.tasks, []
+        acks = []
+        for i in range(0, len(tasks), self.chunk_size):
+            acks.extend(self.connection.send_packed_tasks(
+                tasks[i:i + self.chunk_size]))
+        return acks
+
+
+class _Waiter(object):
+    "A thread blocked in ``get_connection``, served in arrival order."
+    __slots__ = ('event', 'connection', 'granted')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.connection = None
+        self.granted = False
+
+
+def _reap_loop(pool_ref, stop, interval):
+    # Holds the pool weakly so a forgotten pool can still be collected.
+    while not stop.wait(interval):
+        pool = pool_ref()
+        if pool is None:
+            return
         try:
-            return self.queue.get(timeout=self.queue_timeout)
-        except Empty:
-            raise SocketRecvQueueEmptyError("No reslut.")
+            pool.reap()
+        except Exception:
+            logger.exception("Connection pool reaper failed")
+        del pool
 
 
 class ConnectionPool(object):
+    """Thread-safe pool of up to ``max_connections`` connections.
+
+    * Checkout connects new connections and probes idle ones with
+      ``Connection.check_health`` (no round trip), replacing dead ones.
+    * Idle connections are reused most recently released first, so the
+      rest age out: a background reaper closes those idle for longer than
+      ``max_idle_time`` or open for longer than ``max_lifetime`` seconds,
+      and keeps ``min_idle`` connected ones ready (also at start).
+    * When every connection is in use, callers wait up to ``timeout``
+      seconds and are served first come, first served.
+    """
 
     def __init__(self, connection_class=Connection, max_connections=50,
-                 timeout=20, queue_class=LifoQueue, **connection_kwargs):
+                 timeout=20, min_idle=0, max_idle_time=None,
+                 max_lifetime=None, reap_interval=None, health_check=True,
+                 **connection_kwargs):
+        if min_idle > max_connections:
+            raise ValueError("min_idle can not exceed max_connections")
         self.connection_class = connection_class
-        self.queue_class = queue_class
         self.timeout = timeout
         self.max_connections = max_connections
+        self.min_idle = min_idle
+        self.max_idle_time = max_idle_time
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        if reap_interval is None:
+            limits = [t / 2.0 for t in (max_idle_time, max_lifetime) if t]
+            reap_interval = min(limits + [30.0])
+        self.reap_interval = reap_interval
         self.connection_kwargs = connection_kwargs
+        self._reaper_stop = None
 
         self.reset()
 
     def reset(self):
         self.pid = os.getpid()
         self._check_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._idle = deque()
+        self._in_use = set()
+        self._waiters = deque()
+        # Connections that exist or are being created.
+        self._created = 0
 
-        # Create and fill up a thread safe queue with ``None`` values.
-        self.pool = self.queue_class(self.max_connections)
-        while True:
-            try:
-                self.pool.put_nowait(None)
-            except Full:
-                break
+        self._start_reaper()
+        if self.min_idle:
+            self.prewarm()
 
-        self._connections = []
+    @property
+    def _connections(self):
+        return list(self._idle) + list(self._in_use)
+
+    def _start_reaper(self):
+        if self._reaper_stop is not None:
+            self._reaper_stop.set()
+        self._reaper_stop = None
+        if not (self.min_idle or self.max_idle_time or self.max_lifetime):
+            return
+        self._reaper_stop = threading.Event()
+        thread = threading.Thread(
+            target=_reap_loop, name='pasync-pool-reaper',
+            args=(weakref.ref(self), self._reaper_stop, self.reap_interval))
+        thread.daemon = True
+        thread.start()
 
     def _check_pid(self):
         "Check if has changed process."
@@ -465,21 +933,78 @@ class ConnectionPool(object):
     def make_connection(self):
         "Make a fresh connection."
         connection = self.connection_class(**self.connection_kwargs)
-        self._connections.append(connection)
+        connection._pool_created_at = time.time()
+        pool_connections_created.inc()
         return connection
 
-    def get_connection(self):
-        self._check_pid()
-
-        connection = None
+    def _new_connection(self):
+        "Create and connect a connection for a slot already counted."
         try:
-            connection = self.pool.get(timeout=self.timeout)
-        except Empty:
-            raise ConnectionError("No connection available.")
+            connection = self.make_connection()
+            connection.connect()
+        except Exception:
+            self._free_slot()
+            raise
+        return connection
+
+    def _free_slot(self):
+        "A counted connection went away; let a waiter create another."
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._created -= 1
+
+    def _expired(self, connection, now):
+        return bool(self.max_lifetime) and \
+            now - connection._pool_created_at > self.max_lifetime
+
+    def get_connection(self, timeout=None):
+        """Check out a connected connection.
+
+        Waits up to ``timeout`` (default ``self.timeout``; ``None`` there
+        waits forever) when the pool is exhausted.
+        """
+        self._check_pid()
 
+        start = time.time()
+        connection = waiter = None
+        with self._lock:
+            if self._waiters:
+                waiter = _Waiter()
+            elif self._idle:
+                connection = self._idle.pop()
+            elif self._created < self.max_connections:
+                self._created += 1
+            else:
+                waiter = _Waiter()
+            if waiter is not None:
+                self._waiters.append(waiter)
+
+        if waiter is not None:
+            waiter.event.wait(self.timeout if timeout is None else timeout)
+            with self._lock:
+                if not waiter.granted:
+                    self._waiters.remove(waiter)
+                    pool_exhausted.inc()
+                    pool_wait_seconds.observe(time.time() - start)
+                    raise PoolExhaustedError("No connection available.")
+            connection = waiter.connection
+        pool_wait_seconds.observe(time.time() - start)
+
+        if connection is not None and self.health_check and \
+                not connection.check_health():
+            pool_health_check_failures.inc()
+            connection.disconnect()
+            connection = None
         if connection is None:
-            connection = self.make_connection()
+            connection = self._new_connection()
 
+        with self._lock:
+            self._in_use.add(connection)
+        pool_connections_in_use.inc()
         return connection
 
     def release(self, connection):
@@ -488,12 +1013,92 @@ class ConnectionPool(object):
         if connection.pid != self.pid:
             return
 
-        # Put the connetion back to the pool.
-        try:
-            self.pool.put_nowait(connection)
-        except Full:
-            pass
+        now = time.time()
+        with self._lock:
+            if connection not in self._in_use:
+                return
+            self._in_use.discard(connection)
+            pool_connections_in_use.dec()
+            expired = self._expired(connection, now)
+            if not expired:
+                connection._pool_idle_since = now
+                if self._waiters:
+                    # Hand it straight to the longest waiting thread.
+                    waiter = self._waiters.popleft()
+                    waiter.connection = connection
+                    waiter.granted = True
+                    waiter.event.set()
+                else:
+                    self._idle.append(connection)
+        if expired:
+            pool_connections_evicted.inc()
+            connection.disconnect()
+            self._free_slot()
+
+    def reap(self):
+        """Close idle connections past ``max_idle_time`` or ``max_lifetime``
+        and top the idle ones back up to ``min_idle``.
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            keep = deque()
+            # Oldest released first.
+            for connection in self._idle:
+                idle_for = now - connection._pool_idle_since
+                if self._expired(connection, now) or (
+                        self.max_idle_time and
+                        idle_for > self.max_idle_time and
+                        len(self._idle) - len(evicted) > self.min_idle):
+                    evicted.append(connection)
+                else:
+                    keep.append(connection)
+            self._idle = keep
+        for connection in evicted:
+            pool_connections_evicted.inc()
+            connection.disconnect()
+            self._free_slot()
+        self.prewarm()
+
+    def prewarm(self):
+        "Open connections until ``min_idle`` are idle, within the limit."
+        while True:
+            with self._lock:
+                if len(self._idle) >= self.min_idle or self._waiters or \
+                        self._created >= self.max_connections:
+                    return
+                self._created += 1
+            try:
+                connection = self._new_connection()
+            except PAsyncError as e:
+                logger.warning("Could not pre-warm {}: {}".format(self, e))
+                return
+            connection._pool_idle_since = time.time()
+            with self._lock:
+                if self._waiters:
+                    # Someone started waiting meanwhile; it is theirs.
+                    waiter = self._waiters.popleft()
+                    waiter.connection = connection
+                    waiter.granted = True
+                    waiter.event.set()
+                    return
+                self._idle.append(connection)
 
     def disconnect(self):
         for connection in self._connections:
             connection.disconnect()
+
+    def close(self):
+        "Stop the reaper and close every connection."
+        if self._reaper_stop is not None:
+            self._reaper_stop.set()
+            self._reaper_stop = None
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+            self._created -= len(idle)
+        for connection in idle:
+            connection.disconnect()
+        self.disconnect()
+
+    def __repr__(self):
+        return "{}<{!r}>".format(type(self).__name__, self.connection_kwargs)
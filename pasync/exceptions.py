@@ -13,6 +13,16 @@ class ConnectionError(PAsyncError):
     pass
 
 
+class PoolExhaustedError(ConnectionError):
+    # Every connection of a pool stayed busy: the server may be fine.
+    pass
+
+
+class FlowTimeoutError(TimeoutError):
+    # The server granted no credit in time: busy, not gone.
+    pass
+
+
 class SocketQueueError(PAsyncError):
     pass
 
@@ -47,3 +57,7 @@ class NoScriptError(PAsyncError):
 
 class ReadOnlyError(PAsyncError):
     pass
+
+
+class SerializerError(PAsyncError):
+    pass
@@ -1,22 +1,229 @@
 # -*- coding: utf-8 -*-
+"""Hooks: callbacks announced events, e.g. every finished task.
+
+By default ``send`` runs the callbacks inline, one after the other; one
+that raises is logged and the rest still run. After ``dispatch_async``
+``send`` only queues one call per callback, and ``workers`` background
+threads run them, so a slow callback costs its caller nothing.
+
+When the queue is full a call is dropped (``OVERFLOW_DROP``), or the
+caller waits up to ``block_timeout`` for room first (``OVERFLOW_BLOCK``).
+A callback still running after ``timeout`` seconds is left to finish on
+its own: its thread is replaced, so the others keep going, up to
+``workers`` stuck threads at a time.
+
+Each hook keeps ``pasync_hook_<name>_*`` metrics: callback run times,
+errors, timeouts, drops and queue depth.
+"""
+
+import logging
+import os
+import threading
+from time import sleep, time as _time
+
+from pasync._compat import Full, Queue
+from pasync.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
 
 
 class TaskHandlerHook(object):
     def __init__(self, name):
         self.name = name
         self.callbacks = []
+        self.dispatcher = None
+        prefix = 'pasync_hook_{}_'.format(name)
+        self.seconds = registry.histogram(
+            prefix + 'seconds', "Time {} hook callbacks took.".format(name))
+        self.errors = registry.counter(
+            prefix + 'errors_total',
+            "{} hook callbacks that raised.".format(name))
+        self.timeouts = registry.counter(
+            prefix + 'timeouts_total',
+            "{} hook callbacks still running after the timeout.".format(
+                name))
+        self.dropped = registry.counter(
+            prefix + 'dropped_total',
+            "{} hook calls dropped because the queue was full.".format(name))
+        registry.gauge(prefix + 'queue_depth',
+                       "{} hook calls waiting to run.".format(name),
+                       func=self._queue_depth)
 
     def register(self, callback):
         self.callbacks.append(callback)
 
     def send(self, *args, **kwargs):
-        for c in self.callbacks:
-            try:
-                c(*args, **kwargs)
-            except Exception:
-                raise
+        "Run, or queue a run of, every callback with these arguments."
+        dispatcher = self.dispatcher
+        if dispatcher is not None:
+            for callback in self.callbacks:
+                dispatcher.submit(callback, args, kwargs)
+            return
+        for callback in self.callbacks:
+            self.run(callback, args, kwargs)
+
+    def run(self, callback, args, kwargs):
+        "Run one callback, timed, logging instead of raising its error."
+        start = _time()
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            self.errors.inc()
+            logger.exception("{} hook callback {!r} failed".format(
+                self.name, callback))
+        finally:
+            self.seconds.observe(_time() - start)
 
     def clear(self):
         self.callbacks = []
 
+    def dispatch_async(self, workers=1, maxsize=10000,
+                       overflow=OVERFLOW_DROP, block_timeout=None,
+                       timeout=None):
+        "Run callbacks on background threads from now on."
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_BLOCK):
+            raise ValueError("overflow must be {!r} or {!r}".format(
+                OVERFLOW_DROP, OVERFLOW_BLOCK))
+        self.dispatch_sync()
+        self.dispatcher = HookDispatcher(self, workers, maxsize, overflow,
+                                         block_timeout, timeout)
+        return self.dispatcher
+
+    def dispatch_sync(self, wait=1):
+        """Run callbacks inline again, after giving the queued ones up to
+        ``wait`` seconds.
+        """
+        dispatcher, self.dispatcher = self.dispatcher, None
+        if dispatcher is not None:
+            dispatcher.close(wait)
+
+    def _queue_depth(self):
+        dispatcher = self.dispatcher
+        return 0 if dispatcher is None else dispatcher.qsize()
+
+
+class HookDispatcher(object):
+    """The threads and queue behind ``TaskHandlerHook.dispatch_async``.
+
+    Threads start with the first call, in whichever process makes it, so
+    a dispatcher set up before a fork works in the children.
+    """
+
+    def __init__(self, hook, workers=1, maxsize=10000,
+                 overflow=OVERFLOW_DROP, block_timeout=None, timeout=None):
+        self.hook = hook
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.timeout = timeout
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # thread -> (callback, start, timed_out) of the call it is running.
+        self._running = {}
+        self._stuck = set()
+        self._threads = []
+        self._closed = False
+
+    def qsize(self):
+        return 0 if self._pid != os.getpid() else self._queue.qsize()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue(self.maxsize)
+            self._running = {}
+            self._stuck = set()
+            self._threads = []
+            for _ in range(self.workers):
+                self._spawn()
+            if self.timeout is not None:
+                thread = threading.Thread(
+                    target=self._watch,
+                    name='pasync-hook-{}-watch'.format(self.hook.name))
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _spawn(self):
+        thread = threading.Thread(
+            target=self._work, args=(self._queue,),
+            name='pasync-hook-{}'.format(self.hook.name))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, callback, args, kwargs):
+        "Queue a call, or drop it per ``overflow``; never raises."
+        if self._pid != os.getpid():
+            self._start()
+        call = callback, args, kwargs
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put(call, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(call)
+        except Full:
+            self.hook.dropped.inc()
+
+    def _work(self, queue):
+        me = threading.current_thread()
+        while True:
+            call = queue.get()
+            if call is None:
+                return
+            callback, args, kwargs = call
+            with self._lock:
+                self._running[me] = (callback, _time(), False)
+            try:
+                self.hook.run(callback, args, kwargs)
+            finally:
+                with self._lock:
+                    self._running.pop(me, None)
+                    if me in self._stuck:
+                        # Replaced while we were stuck; bow out.
+                        self._stuck.discard(me)
+                        return
+
+    def _watch(self):
+        timeout = self.timeout
+        while not self._closed:
+            sleep(min(timeout / 2.0, 1))
+            now = _time()
+            with self._lock:
+                for thread, call in list(self._running.items()):
+                    callback, start, timed_out = call
+                    if timed_out or now - start < timeout:
+                        continue
+                    # Counted once, whether or not it can be replaced.
+                    self._running[thread] = (callback, start, True)
+                    self.hook.timeouts.inc()
+                    logger.warning(
+                        "{} hook callback {!r} has been running for {:.1f}s"
+                        .format(self.hook.name, callback, now - start))
+                    if len(self._stuck) < self.workers:
+                        self._stuck.add(thread)
+                        self._spawn()
+
+    def close(self, wait=1):
+        "Stop the threads once the calls queued so far have run."
+        self._closed = True
+        if self._pid != os.getpid():
+            return
+        deadline = _time() + wait
+        # Stuck threads leave by themselves; one stop for each of the rest.
+        for _ in range(self.workers):
+            try:
+                self._queue.put(None, timeout=max(0, deadline - _time()))
+            except Full:
+                return
+        for thread in list(self._threads):
+            thread.join(max(0, deadline - _time()))
+
+
 task_callback_hook = TaskHandlerHook('task')
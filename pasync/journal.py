@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""Durable task queue backed by an append-only segment log.
+
+Every queued task is appended to a memory-mapped segment file as a ``PUT``
+record before it is acked, and an ``ACK`` record is appended once a worker
+has finished it. On startup the log is replayed and every ``PUT`` without
+an ``ACK`` goes back onto the priority heap, so accepted tasks survive a
+restart (delivery is at-least-once: a task that was running during a
+crash runs again).
+
+A task delayed until an eta is logged as a ``DELAYED`` record, which also
+holds the eta, and only enters the heap when it is due; on startup the
+ones still to come are handed back by ``DurableQ.take_delayed``.
+
+Durability is set by ``fsync``:
+
+* ``'none'``   -- leave write-back to the OS; survives a process crash but
+  not a power loss.
+* ``'always'`` -- msync after every put.
+* ``'group'``  -- a background flusher msyncs whatever has accumulated and
+  wakes every put that it covered, so concurrent puts share one sync.
+
+Segments are preallocated, written through ``mmap`` and rotated when full.
+A prefix of segments whose tasks are all acked is deleted; when the
+oldest segment is mostly acked its few live tasks are copied forward so it
+can be dropped too.
+"""
+
+import os
+import mmap
+import zlib
+import bisect
+import struct
+import logging
+import threading
+from time import time as _time
+
+from pasync._compat import b
+from pasync.q import ShardedQ, Item
+from pasync.serializers import (
+    DEFAULT_SERIALIZER, get_serializer, get_serializer_by_id
+)
+
+logger = logging.getLogger(__name__)
+
+RECORD_PUT = 1
+RECORD_ACK = 2
+RECORD_DELAYED = 3
+
+FSYNC_NONE = 'none'
+FSYNC_ALWAYS = 'always'
+FSYNC_GROUP = 'group'
+FSYNC_MODES = (FSYNC_NONE, FSYNC_ALWAYS, FSYNC_GROUP)
+
+# crc32 of everything after it, then payload length, record type, payload
+# serializer id, record id and priority.
+CRC = struct.Struct('>I')
+HEADER = struct.Struct('>IBBQd')
+RECORD_OVERHEAD = CRC.size + HEADER.size
+# Leads the payload of a delayed task's record.
+ETA = struct.Struct('>d')
+
+SEGMENT_SUFFIX = '.seg'
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Segment(object):
+    "One preallocated, memory-mapped log file."
+
+    def __init__(self, directory, base, size=None):
+        self.base = base
+        self.path = os.path.join(directory, '%020d%s' % (base, SEGMENT_SUFFIX))
+        if size is not None:
+            with open(self.path, 'wb') as f:
+                f.truncate(size)
+        self.size = os.path.getsize(self.path)
+        self._file = open(self.path, 'r+b')
+        self.mm = mmap.mmap(self._file.fileno(), self.size)
+        self.pos = 0
+        self.synced_pos = 0
+        self.puts = 0
+        self.live = set()
+
+    def scan(self):
+        """Yield ``(type, rid, priority, codec, payload)`` for every intact
+        record.
+
+        Stops at the first zeroed or torn record and leaves ``pos`` there.
+        """
+        mm = self.mm
+        pos = 0
+        while pos + RECORD_OVERHEAD <= self.size:
+            crc, = CRC.unpack_from(mm, pos)
+            length, rtype, codec, rid, priority = HEADER.unpack_from(
+                mm, pos + CRC.size)
+            end = pos + RECORD_OVERHEAD + length
+            if rtype not in (RECORD_PUT, RECORD_ACK, RECORD_DELAYED) or \
+                    end > self.size:
+                break
+            if zlib.crc32(mm[pos + CRC.size:end]) & 0xffffffff != crc:
+                break
+            if priority == int(priority):
+                priority = int(priority)
+            yield rtype, rid, priority, codec, mm[pos + RECORD_OVERHEAD:end]
+            pos = end
+        self.pos = self.synced_pos = pos
+
+    def write(self, record):
+        end = self.pos + len(record)
+        self.mm[self.pos:end] = record
+        self.pos = end
+
+    def flush(self, start, end):
+        if end <= start:
+            return
+        start -= start % mmap.PAGESIZE
+        self.mm.flush(start, end - start)
+
+    def close(self):
+        self.mm.close()
+        self._file.close()
+
+    def delete(self):
+        self.close()
+        os.unlink(self.path)
+
+
+class SegmentLog(object):
+    """The append-only log behind ``DurableQ``.
+
+    Record ids are handed out in append order and double as the queue's
+    FIFO sequence numbers, so a replayed backlog keeps its order.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 fsync=FSYNC_GROUP, compact_ratio=0.1):
+        if fsync not in FSYNC_MODES:
+            raise ValueError("fsync must be one of {}".format(FSYNC_MODES))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._need_flush = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._segments = []
+        self._bases = []
+        self._moved = {}
+        self._next_rid = 1
+        self._written = 0
+        self._synced = 0
+        self._compacting = False
+        self._closed = False
+
+        self.recovered = self._recover()
+        if not self._segments:
+            self._new_segment(self.segment_size)
+
+        self._flusher = None
+        if fsync == FSYNC_GROUP:
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='pasync-journal-flush')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    @property
+    def _active(self):
+        return self._segments[-1]
+
+    def _recover(self):
+        """Load every segment and return the live
+        ``(rid, priority, codec, payload, eta)``, ``eta`` None unless the
+        task was delayed.
+        """
+        names = sorted(n for n in os.listdir(self.directory)
+                       if n.endswith(SEGMENT_SUFFIX))
+        records = {}
+        owners = {}
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not os.path.getsize(path):
+                # Crashed between creating and sizing the file.
+                os.unlink(path)
+                continue
+            segment = Segment(self.directory, int(name[:-len(SEGMENT_SUFFIX)]))
+            self._add_segment(segment)
+            self._next_rid = max(self._next_rid, segment.base)
+            for rtype, rid, priority, codec, payload in segment.scan():
+                if rtype != RECORD_ACK:
+                    eta = None
+                    if rtype == RECORD_DELAYED:
+                        eta, = ETA.unpack_from(payload)
+                        payload = payload[ETA.size:]
+                    records[rid] = (priority, codec, payload, eta)
+                    owners[rid] = segment
+                    segment.puts += 1
+                    self._next_rid = max(self._next_rid, rid + 1)
+                else:
+                    records.pop(rid, None)
+                    owners.pop(rid, None)
+
+        for rid, segment in owners.items():
+            segment.live.add(rid)
+            if rid < segment.base:
+                self._moved[rid] = segment
+        if self._segments:
+            self._written = self._synced = self._active.pos
+            self._drop_acked_prefix()
+        logger.info("Journal {} recovered {} pending tasks from {} "
+                    "segments".format(self.directory, len(records),
+                                      len(names)))
+        return [(rid,) + records[rid] for rid in sorted(records)]
+
+    def _add_segment(self, segment):
+        self._segments.append(segment)
+        self._bases.append(segment.base)
+
+    def _new_segment(self, size):
+        # Segments are named by their first record id; skip ids if a
+        # segment filled up with acks alone, so names stay unique.
+        if self._bases:
+            self._next_rid = max(self._next_rid, self._bases[-1] + 1)
+        self._add_segment(Segment(self.directory, self._next_rid, size))
+        _fsync_dir(self.directory)
+
+    def _segment_for(self, rid):
+        segment = self._moved.get(rid)
+        if segment is not None:
+            return segment
+        i = bisect.bisect_right(self._bases, rid) - 1
+        return self._segments[i] if i >= 0 else None
+
+    def _append(self, rtype, rid, priority, payload, codec=0):
+        """Write one record and return its record id.
+
+        A ``rid`` of ``None`` allocates the next id, after any rotation, so
+        that new ids always fall inside the segment that holds them.
+        """
+        size = RECORD_OVERHEAD + len(payload)
+        # Compacting into a fresh segment may leave too little room.
+        while self._active.pos + size > self._active.size:
+            self._rotate(size)
+        if rid is None:
+            rid = self._next_rid
+            self._next_rid += 1
+        body = HEADER.pack(len(payload), rtype, codec, rid, priority) + payload
+        self._active.write(CRC.pack(zlib.crc32(body) & 0xffffffff) + body)
+        self._written += size
+        return rid
+
+    def _rotate(self, record_size):
+        old = self._active
+        if self.fsync != FSYNC_NONE:
+            old.flush(old.synced_pos, old.pos)
+            old.synced_pos = old.pos
+            self._synced = self._written
+            self._flushed.notify_all()
+        self._new_segment(max(self.segment_size, record_size))
+        self._compact()
+
+    def append_puts(self, items, eta=None):
+        """Log ``items`` and stamp each with its record id as ``seq``;
+        as delayed until ``eta`` if given.
+
+        Returns once the records are as durable as ``fsync`` promises.
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError("Journal is closed")
+            active = None
+            for item in items:
+                data = item.data
+                serializer = get_serializer(item.codec or DEFAULT_SERIALIZER)
+                if not isinstance(data, bytes):
+                    data = serializer.dumps(data)
+                rtype = RECORD_PUT
+                if eta is not None:
+                    rtype = RECORD_DELAYED
+                    data = ETA.pack(eta) + data
+                rid = self._append(rtype, None, item.priority, data,
+                                   serializer.id)
+                active = self._active
+                active.puts += 1
+                active.live.add(rid)
+                item.seq = rid
+            target = self._written
+
+            if self.fsync == FSYNC_ALWAYS:
+                active.flush(active.synced_pos, active.pos)
+                active.synced_pos = active.pos
+                self._synced = target
+            elif self.fsync == FSYNC_GROUP:
+                self._need_flush.notify()
+                while self._synced < target and not self._closed:
+                    self._flushed.wait()
+
+    def append_ack(self, rid):
+        """Mark ``rid`` consumed.
+
+        Acks are not waited on: losing one only means the task runs again
+        after a crash.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            segment = self._segment_for(rid)
+            if segment is None or rid not in segment.live:
+                return
+            segment.live.discard(rid)
+            self._moved.pop(rid, None)
+            self._append(RECORD_ACK, rid, 0, b(''))
+            if self.fsync == FSYNC_GROUP:
+                self._need_flush.notify()
+            if segment is self._segments[0] and not segment.live:
+                self._drop_acked_prefix()
+
+    def _drop_acked_prefix(self):
+        # Only a prefix may go: a later segment can hold the acks of tasks
+        # that live in earlier ones.
+        while len(self._segments) > 1 and not self._segments[0].live:
+            self._segments.pop(0).delete()
+            self._bases.pop(0)
+
+    def _compact(self):
+        "Copy the few live tasks of a mostly-acked oldest segment forward."
+        if self._compacting or len(self._segments) < 3:
+            return
+        oldest = self._segments[0]
+        if len(oldest.live) > oldest.puts * self.compact_ratio:
+            self._drop_acked_prefix()
+            return
+
+        self._compacting = True
+        try:
+            live = oldest.live
+            for rtype, rid, priority, codec, payload in oldest.scan():
+                if rtype != RECORD_ACK and rid in live:
+                    self._append(rtype, rid, priority, bytes(payload), codec)
+                    self._active.puts += 1
+                    self._active.live.add(rid)
+                    self._moved[rid] = self._active
+            oldest.live = set()
+            self._drop_acked_prefix()
+        finally:
+            self._compacting = False
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while self._synced >= self._written and not self._closed:
+                    self._need_flush.wait()
+                if self._closed:
+                    return
+                segment = self._active
+                start, end = segment.synced_pos, segment.pos
+                target = self._written
+            try:
+                segment.flush(start, end)
+            except (ValueError, OSError, EnvironmentError):
+                # Rotated and deleted meanwhile; rotation synced it already.
+                pass
+            with self._lock:
+                segment.synced_pos = max(segment.synced_pos, end)
+                self._synced = max(self._synced, target)
+                self._flushed.notify_all()
+
+    def pending(self):
+        "Number of logged tasks not acked yet."
+        with self._lock:
+            return sum(len(s.live) for s in self._segments)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._need_flush.notify_all()
+            self._flushed.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            for segment in self._segments:
+                if self.fsync != FSYNC_NONE:
+                    segment.flush(segment.synced_pos, segment.pos)
+                segment.close()
+            self._segments = []
+            self._bases = []
+
+
+class DurableQ(ShardedQ):
+    """``ShardedQ`` whose contents survive restarts.
+
+    Puts are logged to a ``SegmentLog`` in ``path`` before they become
+    visible; call ``ack(item)`` once an item has been processed. Anything
+    put but not acked is back in the queue when a ``DurableQ`` is opened
+    on the same ``path`` again (without its ``reply``, since the client
+    connection is gone).
+
+    ``put_delayed`` logs a task that is to wait for its eta elsewhere, and
+    is ``put`` once due without being logged again. Those still waiting
+    at a restart come back from ``take_delayed``; overdue ones are queued.
+    """
+
+    def __init__(self, path, maxsize=0, shards=8, **log_options):
+        ShardedQ.__init__(self, maxsize, shards)
+        self.log = SegmentLog(path, **log_options)
+        items = []
+        self._delayed = []
+        now = _time()
+        for rid, priority, codec, payload, eta in self.log.recovered:
+            item = Item(bytes(payload), priority,
+                        codec=get_serializer_by_id(codec).name)
+            item.seq = rid
+            if eta is not None and eta > now:
+                self._delayed.append((eta, item))
+            else:
+                items.append(item)
+        self.log.recovered = None
+        for i in range(len(self._shards)):
+            chunk = items[i::len(self._shards)]
+            if chunk:
+                self._push(chunk)
+
+    def _stamp(self, items):
+        # Delayed items were logged when they came in.
+        items = [item for item in items if not item.seq]
+        if items:
+            self.log.append_puts(items)
+
+    def put_delayed(self, item, eta):
+        "Log ``item``, to be ``put`` at the Unix timestamp ``eta``."
+        self.log.append_puts([item], eta)
+
+    def take_delayed(self):
+        "Return the recovered ``(eta, item)`` still to come, once."
+        delayed, self._delayed = self._delayed, []
+        return delayed
+
+    def ack(self, item):
+        self.log.append_ack(item.seq)
+
+    def close(self):
+        self.log.close()
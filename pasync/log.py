@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Logging that stays off the request path.
+
+``QueueHandler`` only appends a record to a queue; a background thread
+formats it and passes it on to the real handlers, so a slow terminal or
+disk never stalls a request. Messages are formatted lazily, from the
+logger's ``%`` arguments, and only on that thread.
+
+Per-task records are first offered to ``task_sampler``, which lets
+through one in ``every`` and at most ``max_per_second`` of them.
+"""
+
+import logging
+import os
+import threading
+from time import time as _time
+
+from pasync._compat import Full, Queue
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a thread that passes them on to ``handlers``.
+
+    When ``maxsize`` records are waiting, new ones are dropped and counted
+    in ``dropped`` rather than blocking the caller. The thread starts with
+    the first record, in whichever process logs it, so forked children
+    get their own.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A queue inherited over fork may have been locked by a thread
+            # that does not exist here.
+            self._queue = Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._queue,),
+                                            name='pasync-log')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, queue):
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        "Write out the waiting records and stop the thread."
+        if self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=1)
+            except Full:
+                pass
+            self._thread.join(1)
+        self._pid = None
+        logging.Handler.close(self)
+
+
+class Sampler(object):
+    """Decides which of a stream of events to log.
+
+    Calling it says yes to one event in ``every``, and to no more than
+    ``max_per_second`` a second (``None`` for no limit). ``dropped``
+    counts the others.
+    """
+
+    def __init__(self, every=1, max_per_second=None):
+        self.every = every
+        self.max_per_second = max_per_second
+        self.dropped = 0
+        self._seen = 0
+        self._tokens = max_per_second or 0
+        self._last = _time()
+
+    def __call__(self):
+        # Unlocked: a race only makes the sampling slightly approximate.
+        self._seen += 1
+        if self.every > 1 and self._seen % self.every:
+            self.dropped += 1
+            return False
+        rate = self.max_per_second
+        if rate is None:
+            return True
+        now = _time()
+        self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+        self._last = now
+        if self._tokens < 1:
+            self.dropped += 1
+            return False
+        self._tokens -= 1
+        return True
+
+
+# Per-task log lines at INFO.
+task_sampler = Sampler(max_per_second=100)
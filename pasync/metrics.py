@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""Process-wide metrics.
+
+Counters, gauges and latency histograms live in ``registry``. They can
+be read with a ``stats`` request on a task connection
+(``Connection.stats()``) or scraped in Prometheus text format from
+``start_http_server``.
+
+Histograms keep HDR-style log-linear buckets over whole microseconds:
+eight buckets per power of two, so any reported percentile is within
+12.5% of the true value, whatever the range, with a few hundred ints
+of state.
+"""
+
+import threading
+from time import time as _time
+
+from pasync._compat import BaseHTTPRequestHandler, HTTPServer, b
+
+
+class Counter(object):
+    "A value that only goes up."
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+    def state(self):
+        return self.value
+
+    def merge(self, state):
+        "Add the ``state`` of the same metric from another process."
+        self.inc(state)
+
+    def samples(self):
+        yield self.name, self._value
+
+
+class Gauge(Counter):
+    """A value that goes up and down.
+
+    With ``func`` the value is whatever ``func()`` returns when read, which
+    costs nothing until someone looks.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        Counter.__init__(self, name, help)
+        self.func = func
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self.func is not None:
+            return self.func()
+        return self._value
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram(object):
+    "Latency distribution in seconds, exported as a summary."
+    kind = 'summary'
+    sub_bucket_bits = 3
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._counts = []
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        sub = 1 << self.sub_bucket_bits
+        if value < sub:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        return sub * shift + (value >> shift)
+
+    def _value_at(self, index):
+        "The midpoint of bucket ``index``, in microseconds."
+        sub = 1 << self.sub_bucket_bits
+        if index < 2 * sub:
+            return index
+        shift = index // sub - 1
+        low = (index % sub + sub) << shift
+        return low + ((1 << shift) - 1) / 2.0
+
+    def observe(self, seconds):
+        value = int(seconds * 1e6) if seconds > 0 else 0
+        index = self._index(value)
+        with self._lock:
+            counts = self._counts
+            if index >= len(counts):
+                counts.extend([0] * (index + 1 - len(counts)))
+            counts[index] += 1
+            self._count += 1
+            self._sum += seconds
+            if value > self._max:
+                self._max = value
+
+    def time(self):
+        "Context manager observing the duration of its block."
+        return _Timer(self)
+
+    @property
+    def count(self):
+        return self._count
+
+    def percentile(self, q):
+        "Approximate ``q`` (0 to 1) quantile in seconds, or ``None``."
+        with self._lock:
+            counts = list(self._counts)
+            total = self._count
+            top = self._max
+        if not total:
+            return None
+        rank = max(1, int(round(q * total)))
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value_at(index), top) / 1e6
+        return top / 1e6
+
+    def snapshot(self):
+        snap = dict(('p%d' % round(q * 100), self.percentile(q))
+                    for q in self.quantiles)
+        snap.update(count=self._count, sum=self._sum, max=self._max / 1e6)
+        return snap
+
+    def state(self):
+        with self._lock:
+            return [list(self._counts), self._count, self._sum, self._max]
+
+    def merge(self, state):
+        "Add the ``state`` of the same metric from another process."
+        counts, count, total, top = state
+        with self._lock:
+            mine = self._counts
+            if len(counts) > len(mine):
+                mine.extend([0] * (len(counts) - len(mine)))
+            for index, n in enumerate(counts):
+                mine[index] += n
+            self._count += count
+            self._sum += total
+            self._max = max(self._max, top)
+
+    def samples(self):
+        for q in self.quantiles:
+            value = self.percentile(q)
+            yield ('%s{quantile="%s"}' % (self.name, q),
+                   'NaN' if value is None else value)
+        yield self.name + '_sum', self._sum
+        yield self.name + '_count', self._count
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = _time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(_time() - self.start)
+
+
+class Registry(object):
+    kinds = {'counter': Counter, 'gauge': Gauge, 'summary': Histogram}
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError("Metric {!r} is already a {}".format(
+                    name, metric.kind))
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get_or_create(Counter, name, help)
+
+    def gauge(self, name, help='', func=None):
+        gauge = self._get_or_create(Gauge, name, help)
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, help=''):
+        return self._get_or_create(Histogram, name, help)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self):
+        "Every metric's current value, as a serializable dict."
+        return dict((name, metric.snapshot())
+                    for name, metric in sorted(self._metrics.items()))
+
+    def dump(self):
+        """Every metric's state, picklable, for ``merge`` in another
+        process.
+        """
+        return dict((name, (metric.kind, metric.help, metric.state()))
+                    for name, metric in list(self._metrics.items()))
+
+    def merge(self, dump):
+        "Add a ``dump`` from another process; counts and gauges are summed."
+        for name, (kind, help, state) in dump.items():
+            self._get_or_create(self.kinds[kind], name, help).merge(state)
+
+    def to_prometheus(self):
+        "Render every metric in the Prometheus text exposition format."
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append('{} {}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        body = b(self.registry.to_prometheus())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr='127.0.0.1', registry=registry):
+    """Serve ``registry`` for Prometheus on ``addr:port`` from a daemon
+    thread, and return the server.
+    """
+    class Handler(MetricsHandler):
+        pass
+    Handler.registry = registry
+    server = HTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='pasync-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
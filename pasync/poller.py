@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Readiness pollers used by ``EventQServer``.
+
+All pollers share one small interface (``register`` / ``modify`` /
+``unregister`` / ``poll``) and report events as ``POLL_READ`` /
+``POLL_WRITE`` bitmasks, so the server does not care whether epoll, poll
+or select is underneath.
+"""
+
+import errno
+import select
+
+POLL_READ = 0x001
+POLL_WRITE = 0x004
+POLL_ERROR = 0x008 | 0x010
+
+
+def _interrupted(e):
+    return e.args and e.args[0] == errno.EINTR
+
+
+class EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd, events):
+        self._epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        try:
+            return self._epoll.poll(-1 if timeout is None else timeout)
+        except (select.error, IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+
+    def close(self):
+        self._epoll.close()
+
+
+class PollPoller(object):
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd, events):
+        self._poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            return self._poll.poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+    "Portable fallback, limited to ``FD_SETSIZE`` descriptors."
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, events):
+        if events & POLL_READ:
+            self._readers.add(fd)
+        if events & POLL_WRITE:
+            self._writers.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout=None):
+        try:
+            r, w, x = select.select(self._readers, self._writers,
+                                    self._readers | self._writers, timeout)
+        except (select.error, IOError, OSError) as e:
+            if _interrupted(e):
+                return []
+            raise
+        events = {}
+        for fd in r:
+            events[fd] = events.get(fd, 0) | POLL_READ
+        for fd in w:
+            events[fd] = events.get(fd, 0) | POLL_WRITE
+        for fd in x:
+            events[fd] = events.get(fd, 0) | POLL_ERROR
+        return list(events.items())
+
+    def close(self):
+        self._readers.clear()
+        self._writers.clear()
+
+
+def default_poller():
+    "Return the most scalable poller this platform supports."
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""Prefork: several server processes on one port.
+
+``Supervisor`` forks ``processes`` children, each running its own server,
+so accepting, parsing and decoding tasks use every core instead of one
+GIL. The children bind the same port with ``SO_REUSEPORT`` where the
+platform has it, and the kernel spreads connections over them; elsewhere
+they share a listening socket inherited from the supervisor.
+
+Each child is a whole node with its own queue and worker, started by the
+``setup`` callable after the fork: a task runs in the process that took
+it, and its result goes back over the same connection. A child that dies
+is started again in the same slot, so ``setup(index)`` can give it back
+its journal.
+
+Children report their metrics every ``report_interval`` seconds, and
+``Supervisor.registry`` merges them: the counters, gauges and histograms
+of the whole server, queue depths included.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from pasync._compat import Empty
+from pasync.metrics import Registry, registry
+from pasync.server import QHandler
+
+logger = logging.getLogger(__name__)
+
+if hasattr(multiprocessing, 'get_context'):
+    # Children run ``setup`` as given, which only a fork can do.
+    _mp = multiprocessing.get_context('fork')
+else:
+    _mp = multiprocessing
+
+HAS_REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+class Supervisor(object):
+    """Runs ``processes`` copies of ``server_class`` on ``server_address``
+    and keeps them running.
+
+    ``setup(index)`` runs first in every child, e.g. to set up its queue
+    and start its ``TaskWorker``; threads and pools must be started
+    there, as they do not survive a fork.
+    """
+
+    def __init__(self, server_class, server_address,
+                 RequestHandlerClass=QHandler, processes=None, setup=None,
+                 reuse_port=HAS_REUSE_PORT, report_interval=1,
+                 restart_delay=1):
+        self.server_class = server_class
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.processes = processes or multiprocessing.cpu_count()
+        self.setup = setup
+        self.reuse_port = reuse_port
+        self.report_interval = report_interval
+        self.restart_delay = restart_delay
+        self.restarts = 0
+        self._socket = None
+        self._children = [None] * self.processes
+        self._started = [0] * self.processes
+        self._reports = {}
+        # What dead children counted, so totals never go backwards.
+        self._retired = Registry()
+        self._queue = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "Supervisor<address={}, processes={}>".format(
+            self.server_address, self.processes)
+
+    def start(self, timeout=30):
+        """Bind the port, fork the children, and wait up to ``timeout``
+        for them all to be listening.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Only holds the port (and resolves port 0) for the children;
+            # a socket that never listens gets no connections.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.server_address)
+        if not self.reuse_port:
+            sock.listen(self.server_class.request_queue_size)
+        self._socket = sock
+        self.server_address = sock.getsockname()
+        self._queue = _mp.Queue()
+        self._running = True
+        for index in range(self.processes):
+            self._spawn(index)
+        # A child reports once its server is listening.
+        deadline = time.time() + timeout
+        while len(self._reports) < self.processes and \
+                time.time() < deadline:
+            self._collect(0.1)
+
+    def _spawn(self, index):
+        child = _mp.Process(target=self._run_child, args=(index,),
+                            name='pasync-server-{}'.format(index))
+        # Not daemonic, so that a child may have a process pool.
+        child.start()
+        self._children[index] = child
+        self._started[index] = time.time()
+        logger.info("Started server process {} (pid {})".format(
+            index, child.pid))
+
+    def _run_child(self, index):
+        # The supervisor stops us; Ctrl-C in a terminal must not.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.setup is not None:
+            self.setup(index)
+        server = self._make_server()
+        reporter = threading.Thread(target=self._report, args=(index,),
+                                    name='pasync-prefork-report')
+        reporter.daemon = True
+        reporter.start()
+        server.serve_forever()
+
+    def _make_server(self):
+        server = self.server_class(self.server_address,
+                                   self.RequestHandlerClass,
+                                   bind_and_activate=False)
+        if self.reuse_port:
+            server.allow_reuse_address = True
+            server.allow_reuse_port = True
+            server.server_bind()
+            self._socket.close()
+        else:
+            server.socket.close()
+            server.socket = self._socket
+            server.server_address = self.server_address
+        server.server_activate()
+        return server
+
+    def _report(self, index):
+        pid = os.getpid()
+        while True:
+            self._queue.put((index, pid, registry.dump()))
+            time.sleep(self.report_interval)
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the children if needed, then restart any that die until
+        ``stop`` is called or the process gets SIGTERM or SIGINT.
+        """
+        if not self._running:
+            self.start()
+
+        def handler(signum, frame):
+            self.stop(wait=False)
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, handler)
+        try:
+            while self._running:
+                self._collect(poll_interval)
+                self._check_children()
+        finally:
+            self._stop_children()
+
+    def _collect(self, timeout):
+        try:
+            index, pid, dump = self._queue.get(timeout=timeout)
+        except Empty:
+            return
+        except (IOError, OSError, EOFError):
+            # Interrupted by a signal.
+            return
+        with self._lock:
+            while True:
+                self._reports[index] = (pid, dump)
+                try:
+                    index, pid, dump = self._queue.get_nowait()
+                except Empty:
+                    break
+
+    def _check_children(self):
+        now = time.time()
+        for index, child in enumerate(self._children):
+            if child is None or child.is_alive() or not self._running:
+                continue
+            if child.exitcode is not None:
+                logger.warning(
+                    "Server process {} (pid {}) exited with {}".format(
+                        index, child.pid, child.exitcode))
+                child.join()
+                self._retire(index, child.pid)
+                self._children[index] = None
+                # Do not spin on a child that dies straight away.
+                self._started[index] = max(
+                    now, self._started[index] + self.restart_delay)
+        for index, child in enumerate(self._children):
+            if child is None and self._running and \
+                    now >= self._started[index]:
+                self.restarts += 1
+                self._spawn(index)
+
+    def _retire(self, index, pid):
+        with self._lock:
+            report = self._reports.get(index)
+            if report is None or report[0] != pid:
+                return
+            del self._reports[index]
+            # Gauges describe a live process, so they go with it.
+            self._retired.merge(dict(
+                (name, metric) for name, metric in report[1].items()
+                if metric[0] != 'gauge'))
+
+    def stop(self, wait=True):
+        "Make ``serve_forever`` stop the children and return."
+        self._running = False
+        if wait:
+            self._stop_children()
+
+    def _stop_children(self):
+        for child in self._children:
+            if child is not None and child.is_alive():
+                child.terminate()
+        for child in self._children:
+            if child is not None:
+                child.join()
+        self._children = [None] * self.processes
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    @property
+    def pids(self):
+        return [child.pid for child in self._children if child is not None]
+
+    @property
+    def registry(self):
+        "The merged metrics of every child, live and dead."
+        merged = Registry()
+        with self._lock:
+            merged.merge(self._retired.dump())
+            for pid, dump in self._reports.values():
+                merged.merge(dump)
+        merged.gauge('pasync_prefork_processes',
+                     "Server processes running.").set(len(self.pids))
+        merged.counter('pasync_prefork_restarts_total',
+                       "Server processes restarted after dying.").inc(
+                           self.restarts)
+        return merged
+
+    def snapshot(self):
+        return self.registry.snapshot()
+
+    def to_prometheus(self):
+        return self.registry.to_prometheus()
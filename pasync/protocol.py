@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Wire framing shared by ``QHandler`` and ``Connection``.
+
+Every message is sent as a length-prefixed bulk frame::
+
+    $<length>\\r\\n<payload>\\r\\n
+
+which is the same layout ``PythonParser`` already understands, so a client
+reads replies through ``read_response`` and the server reads tasks through
+a ``SocketBuffer``. Errors are sent as ``-<CODE> <message>\\r\\n`` lines.
+"""
+
+from pasync._compat import b
+from pasync.exceptions import InvalidResponse
+
+SYM_DOLLAR = b('$')
+SYM_DASH = b('-')
+SYM_CRLF = b('\r\n')
+SYM_EMPTY = b('')
+
+# Refuse to buffer absurd frames announced by a broken or hostile peer.
+MAX_FRAME_SIZE = 512 * 1024 * 1024
+
+
+def pack_frame(payload):
+    "Wrap ``payload`` in a length-prefixed frame."
+    payload = b(payload)
+    return SYM_DOLLAR + b(str(len(payload))) + SYM_CRLF + payload + SYM_CRLF
+
+
+def pack_error(message, code='ERR'):
+    "Build an error line the client parser turns into an exception."
+    return SYM_DASH + b(code) + b(' ') + b(message) + SYM_CRLF
+
+
+def read_frame(buf):
+    "Read one frame payload from a ``SocketBuffer``."
+    header = buf.readline()
+    if header[:1] != SYM_DOLLAR:
+        raise InvalidResponse("Protocol Error: expected frame, got %r" %
+                              (header[:16],))
+    try:
+        length = int(header[1:])
+    except ValueError:
+        raise InvalidResponse("Protocol Error: invalid frame length %r" %
+                              (header[1:],))
+    if length < 0 or length > MAX_FRAME_SIZE:
+        raise InvalidResponse("Protocol Error: frame length %d out of range" %
+                              length)
+    return buf.read(length)
+
+
+class FrameDecoder(object):
+    """Incremental frame parser for non-blocking sockets.
+
+    ``feed`` whatever ``recv`` returned, then call ``next_frame`` until it
+    returns ``None`` (no complete frame buffered yet).
+    """
+
+    max_header_size = 32
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._buffer) - self._pos
+
+    def feed(self, data):
+        self._buffer += data
+
+    def next_frame(self):
+        buf = self._buffer
+        pos = self._pos
+        end = buf.find(SYM_CRLF, pos)
+        if end < 0:
+            if len(buf) - pos > self.max_header_size:
+                raise InvalidResponse("Protocol Error: frame header too long")
+            return None
+        if buf[pos:pos + 1] != SYM_DOLLAR:
+            raise InvalidResponse("Protocol Error: expected frame, got %r" %
+                                  (bytes(buf[pos:pos + 16]),))
+        try:
+            length = int(bytes(buf[pos + 1:end]))
+        except ValueError:
+            raise InvalidResponse("Protocol Error: invalid frame length %r" %
+                                  (bytes(buf[pos + 1:end]),))
+        if length < 0 or length > MAX_FRAME_SIZE:
+            raise InvalidResponse("Protocol Error: frame length %d out of "
+                                  "range" % length)
+        start = end + 2
+        stop = start + length
+        if len(buf) < stop + 2:
+            return None
+        if buf[stop:stop + 2] != SYM_CRLF:
+            raise InvalidResponse("Protocol Error: frame not terminated")
+        payload = bytes(buf[start:stop])
+        self._consume(stop + 2)
+        return payload
+
+    def read_into(self, spool):
+        """Move buffered raw bytes, that follow a frame unframed, into
+        ``spool`` and return how many.
+        """
+        pos = self._pos
+        n = spool.write(self._buffer[pos:pos + spool.remaining])
+        self._consume(pos + n)
+        return n
+
+    def _consume(self, pos):
+        self._pos = pos
+        # Compact once the consumed prefix dominates the buffer.
+        if pos == len(self._buffer) or pos > 65536:
+            del self._buffer[:pos]
+            self._pos = 0
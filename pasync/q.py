@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import heapq
-from pasync._compat import Queue
+import itertools
+import threading
+from time import time as _time
+
+from pasync._compat import Queue, Empty, Full
 
 
 class Q(Queue):
@@ -16,26 +20,329 @@ class Q(Queue):
         return len(self.queue)
 
     def _put(self, item):
-        _item = (-item.priority, self._index, item)
-        heapq.heappush(self.queue, _item)
+        item.seq = self._index
+        heapq.heappush(self.queue, item)
         self._index += 1
 
     def _get(self):
-        return heapq.heappop(self.queue)[-1]
+        return heapq.heappop(self.queue)
+
+    def set_maxsize(self, maxsize):
+        self.maxsize = maxsize
+
+
+class _Shard(object):
+    __slots__ = ('lock', 'heap')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+
+
+class _Lane(_Shard):
+    "The heap of one batched task kind, with its own consumers."
+    __slots__ = ('not_empty', 'waiters')
+
+    def __init__(self, mutex):
+        _Shard.__init__(self)
+        self.not_empty = threading.Condition(mutex)
+        self.waiters = 0
+
+
+class ShardedQ(object):
+    """Priority Queue (highest first) split over independently locked heaps.
+
+    Producers push onto the shards round-robin, so concurrent ``put`` calls
+    rarely contend on the same lock; ``get`` peeks at every shard's head
+    and pops the best one. Sequence numbers come from one global counter.
+
+    Guarantees:
+
+    * With no concurrent ``put``, ``get`` returns exactly what ``Q`` would:
+      highest priority first, first in first out within a priority.
+    * Under concurrency an item put while a ``get`` is scanning may be
+      passed over by that ``get`` and returned by the next one instead.
+    * ``maxsize`` is a soft bound: it may be overshot by up to the number
+      of threads putting at the same moment, or by one ``put_many`` batch.
+
+    The API follows ``Queue`` (``put``/``get`` with ``block`` and
+    ``timeout``, ``Full``/``Empty``), plus ``put_many``, ``get_many`` and
+    ``wait``, which waits for an item without taking it.
+    Callbacks added with ``add_space_listener`` run after every ``get``,
+    outside any lock, e.g. to grant producers more credit.
+
+    After ``add_lane(kind)``, items whose ``kind`` is ``kind`` go to a
+    heap of their own, which only ``get_batch(kind)`` takes from.
+    """
+
+    def __init__(self, maxsize=0, shards=8):
+        self.maxsize = maxsize
+        self._shards = [_Shard() for _ in range(shards)]
+        self._seq = itertools.count()
+        self._next_shard = itertools.count()
+        # Only threads that actually have to wait touch these.
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._waiters = {'get': 0, 'put': 0}
+        self._space_listeners = []
+        self._lanes = {}
+
+    def qsize(self):
+        return sum(len(shard.heap) for shard in self._shards) + \
+            sum(len(lane.heap) for lane in list(self._lanes.values()))
+
+    def empty(self):
+        return not any(shard.heap for shard in self._shards)
+
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
 
     def set_maxsize(self, maxsize):
         self.maxsize = maxsize
 
+    def add_space_listener(self, callback):
+        self._space_listeners.append(callback)
+
+    def remove_space_listener(self, callback):
+        if callback in self._space_listeners:
+            self._space_listeners.remove(callback)
+
+    def add_lane(self, kind):
+        "Keep items of ``kind`` apart, for ``get_batch``."
+        with self._mutex:
+            if kind not in self._lanes:
+                self._lanes[kind] = _Lane(self._mutex)
+
+    def put(self, item, block=True, timeout=None):
+        self.put_many([item], block, timeout)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+    def put_many(self, items, block=True, timeout=None):
+        "Put every item in ``items`` under a single shard lock."
+        if self.maxsize > 0 and self.full():
+            self._wait(self._not_full, 'put', self.full, block, timeout, Full)
+        self._stamp(items)
+        self._push(items)
+
+    def _stamp(self, items):
+        "Give each item its FIFO sequence number."
+        seq = self._seq
+        for item in items:
+            item.seq = next(seq)
+
+    def _push(self, items):
+        if self._lanes:
+            items = self._push_lanes(items)
+            if not items:
+                return
+        shards = self._shards
+        shard = shards[next(self._next_shard) % len(shards)]
+        with shard.lock:
+            for item in items:
+                heapq.heappush(shard.heap, item)
+        # A waiter registers before re-checking ``empty``, so either we
+        # see it here or it sees our items.
+        if self._waiters['get']:
+            with self._not_empty:
+                self._not_empty.notify(len(items))
+
+    def _push_lanes(self, items):
+        "Push the items that have a lane there; return the others."
+        lanes = self._lanes
+        rest = []
+        for item in items:
+            lane = lanes.get(item.kind)
+            if lane is None:
+                rest.append(item)
+                continue
+            with lane.lock:
+                heapq.heappush(lane.heap, item)
+            if lane.waiters:
+                with lane.not_empty:
+                    lane.not_empty.notify()
+        return rest
+
+    def get(self, block=True, timeout=None):
+        return self.get_many(1, block, timeout)[0]
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def get_many(self, max_items, block=True, timeout=None):
+        """Remove and return up to ``max_items`` items, best first.
+
+        Blocks (per ``block`` / ``timeout``) only until the first item is
+        available; the rest are whatever is queued at that moment.
+        """
+        if timeout is not None:
+            endtime = _time() + timeout
+        while True:
+            item = self._pop()
+            if item is not None:
+                break
+            if timeout is not None:
+                timeout = max(0.0, endtime - _time())
+            self._wait(self._not_empty, 'get', self.empty, block, timeout,
+                       Empty)
+
+        items = [item]
+        while len(items) < max_items:
+            item = self._pop()
+            if item is None:
+                break
+            items.append(item)
+
+        if self._waiters['put']:
+            with self._not_full:
+                self._not_full.notify(len(items))
+        for listener in self._space_listeners:
+            listener()
+        return items
+
+    def wait(self, timeout=None, kind=None):
+        """Wait up to ``timeout`` for an item for ``get``, or in the lane
+        of ``kind`` for ``get_batch``, and return whether there is one.
+        """
+        if kind is None:
+            try:
+                self._wait(self._not_empty, 'get', self.empty, True, timeout,
+                           Empty)
+            except Empty:
+                return False
+            return True
+        lane = self._lanes[kind]
+        if timeout is not None:
+            endtime = _time() + timeout
+        with lane.not_empty:
+            lane.waiters += 1
+            try:
+                while not lane.heap:
+                    if timeout is None:
+                        lane.not_empty.wait()
+                        continue
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        return False
+                    lane.not_empty.wait(remaining)
+            finally:
+                lane.waiters -= 1
+        return True
+
+    def get_batch(self, kind, max_items, block=True, timeout=None):
+        """Remove and return up to ``max_items`` items of ``kind``, best
+        first, under one lock.
+
+        Blocks (per ``block`` / ``timeout``) only until the first item is
+        available.
+        """
+        lane = self._lanes[kind]
+        if timeout is not None:
+            endtime = _time() + timeout
+        while True:
+            with lane.lock:
+                heap = lane.heap
+                items = [heapq.heappop(heap)
+                         for _ in range(min(max_items, len(heap)))]
+            if items:
+                break
+            if not block:
+                raise Empty
+            with lane.not_empty:
+                lane.waiters += 1
+                try:
+                    if lane.heap:
+                        continue
+                    if timeout is None:
+                        lane.not_empty.wait()
+                        continue
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    lane.not_empty.wait(remaining)
+                finally:
+                    lane.waiters -= 1
+
+        if self._waiters['put']:
+            with self._not_full:
+                self._not_full.notify(len(items))
+        for listener in self._space_listeners:
+            listener()
+        return items
+
+    def _pop(self):
+        "Pop the best head across all shards, or return ``None``."
+        while True:
+            best = best_head = None
+            for shard in self._shards:
+                try:
+                    head = shard.heap[0]
+                except IndexError:
+                    continue
+                if best is None or head < best_head:
+                    best, best_head = shard, head
+            if best is None:
+                return None
+            with best.lock:
+                if best.heap:
+                    return heapq.heappop(best.heap)
+            # Another consumer emptied that shard meanwhile; rescan.
+
+    def _wait(self, cond, kind, blocked, block, timeout, exc):
+        "Wait on ``cond`` until ``blocked()`` is false."
+        if not block:
+            raise exc
+        if timeout is not None:
+            if timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            endtime = _time() + timeout
+        with cond:
+            self._waiters[kind] += 1
+            try:
+                while blocked():
+                    if timeout is None:
+                        cond.wait()
+                        continue
+                    remaining = endtime - _time()
+                    if remaining <= 0.0:
+                        raise exc
+                    cond.wait(remaining)
+            finally:
+                self._waiters[kind] -= 1
+
 
 class Item(object):
     """Data Struct
-    Data with priority to put in `Q`
+    Data with priority to put in `Q`, plus an optional `reply` callable
+    that delivers the task result back to whoever submitted it.
+
+    Items sit in the heaps as they are (no ``(priority, index, item)``
+    wrapper tuples) and use ``__slots__``, since a busy server keeps
+    millions of them queued. ``seq`` is assigned by the queue on put.
+    The server stores the raw task frame as ``data``, with the name of
+    its serializer as ``codec``; it is decoded only when a worker
+    dequeues it. ``kind`` is the task name, for queues that keep some
+    kinds apart for batching.
     """
-    def __init__(self, data, priority=0):
+    __slots__ = ('data', 'priority', 'seq', 'reply', 'codec', 'kind')
+
+    def __init__(self, data, priority=0, reply=None, codec=None, kind=None):
         self.data = data
         self.priority = priority
+        self.seq = 0
+        self.reply = reply
+        self.codec = codec
+        self.kind = kind
+
+    def __lt__(self, other):
+        # Highest priority first, then first in first out.
+        if self.priority != other.priority:
+            return self.priority > other.priority
+        return self.seq < other.seq
 
     def __repr__(self):
         return "Item({!r}, {!r})".format(self.data, self.priority)
 
-q = Q()
+q = ShardedQ()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Delayed tasks.
+
+``TimingWheel`` is a hierarchical timing wheel: ``levels`` wheels of
+``2 ** bits`` slots, where a slot of level ``i`` spans ``2 ** (bits * i)``
+ticks. A timer goes into the lowest level whose range covers its delay,
+and is moved down a level each time the wheel above turns onto its slot,
+so adding and expiring a timer costs O(1) however many are pending.
+Timers beyond the top level wait in a heap until they come into range.
+
+``Scheduler`` turns a wheel from a background thread and hands every due
+task to ``put``, e.g. to enqueue it at its priority.
+"""
+
+import heapq
+import logging
+import threading
+from time import time as _time
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel(object):
+    "Timers in whole ticks; ``now`` is the current tick."
+
+    def __init__(self, now=0, bits=8, levels=4):
+        self.now = now
+        self.bits = bits
+        self.levels = levels
+        self._mask = (1 << bits) - 1
+        self._wheels = [[[] for _ in range(1 << bits)]
+                        for _ in range(levels)]
+        self._overflow = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, expire, value):
+        """Add a timer firing at tick ``expire``.
+
+        Returns False, without adding it, if it is already due.
+        """
+        if not self._insert(expire, value):
+            return False
+        self._count += 1
+        return True
+
+    def _insert(self, expire, value):
+        delay = expire - self.now
+        if delay <= 0:
+            return False
+        bits = self.bits
+        for level in range(self.levels):
+            if delay < 1 << (bits * (level + 1)):
+                slot = (expire >> (bits * level)) & self._mask
+                self._wheels[level][slot].append((expire, value))
+                return True
+        heapq.heappush(self._overflow, (expire, id(value), value))
+        return True
+
+    def advance(self, now):
+        "Move on to tick ``now`` and return the values of expired timers."
+        due = []
+        if not self._count:
+            self.now = max(self.now, now)
+            return due
+        bits, mask = self.bits, self._mask
+        while self.now < now:
+            self.now += 1
+            tick = self.now
+            # Cascade from the top so a slot refilled from above is
+            # cascaded again on the same tick.
+            for level in range(self.levels - 1, 0, -1):
+                if tick & ((1 << (bits * level)) - 1):
+                    continue
+                if level == self.levels - 1:
+                    self._pull_overflow(due)
+                slot = (tick >> (bits * level)) & mask
+                timers = self._wheels[level][slot]
+                if timers:
+                    self._wheels[level][slot] = []
+                    for expire, value in timers:
+                        if not self._insert(expire, value):
+                            due.append(value)
+            slot = self._wheels[0][tick & mask]
+            if slot:
+                self._wheels[0][tick & mask] = []
+                due.extend(value for _, value in slot)
+        self._count -= len(due)
+        return due
+
+    def _pull_overflow(self, due):
+        horizon = self.now + (1 << (self.bits * self.levels))
+        overflow = self._overflow
+        while overflow and overflow[0][0] < horizon:
+            expire, _, value = heapq.heappop(overflow)
+            if not self._insert(expire, value):
+                due.append(value)
+
+
+class Scheduler(object):
+    """Runs ``put(value)`` for each scheduled value once its time comes.
+
+    Times are Unix timestamps, rounded up to ``tick`` seconds. The thread
+    starts with the first ``schedule`` and sleeps while nothing is
+    pending.
+    """
+
+    def __init__(self, put, tick=0.01, bits=8, levels=4):
+        self.put = put
+        self.tick = tick
+        self._wheel = TimingWheel(self._tick_of(_time()), bits, levels)
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def _tick_of(self, when):
+        return int(when / self.tick)
+
+    def schedule(self, when, value):
+        """Run ``put(value)`` at ``when``.
+
+        Returns False, without scheduling, if ``when`` has already passed.
+        """
+        with self._cond:
+            if not len(self._wheel):
+                # Idle wheels are not turned; catch up first.
+                self._wheel.advance(self._tick_of(_time()))
+            # Round up so a task never runs early.
+            if not self._wheel.add(self._tick_of(when) + 1, value):
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='pasync-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            elif len(self._wheel) == 1:
+                self._cond.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not len(self._wheel):
+                    self._cond.wait()
+                due = self._wheel.advance(self._tick_of(_time()))
+                if not due:
+                    self._cond.wait(self.tick)
+            for value in due:
+                try:
+                    self.put(value)
+                except Exception:
+                    logger.exception("Failed to enqueue a delayed task")
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Message serializers.
+
+Every message on a connection is encoded with one serializer. A fresh
+connection speaks JSON; a client may open with a ``hello`` message
+listing the serializers it prefers, and the server answers with the
+first one it also allows. Both sides then switch for the rest of the
+connection.
+
+``pickle`` and ``marshal`` let a peer run arbitrary constructors or
+depend on the interpreter version, so a server only accepts what is in
+``TaskSession.allowed_serializers``.
+"""
+
+import json
+import marshal
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from pasync._compat import b
+from pasync.exceptions import SerializerError
+
+DEFAULT_SERIALIZER = 'json'
+
+
+class Serializer(object):
+    """Base serializer.
+
+    ``id`` is a stable one-byte code used wherever the name would be too
+    big to store, e.g. in journal records.
+    """
+    name = None
+    id = None
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.name)
+
+
+class JSONSerializer(Serializer):
+    name = 'json'
+    id = 1
+
+    def dumps(self, obj):
+        try:
+            return b(json.dumps(obj))
+        except (TypeError, ValueError) as e:
+            raise SerializerError("Cannot encode as json: {}".format(e))
+
+    def loads(self, data):
+        try:
+            return json.loads(data)
+        except (TypeError, ValueError) as e:
+            raise SerializerError("Cannot decode json: {}".format(e))
+
+
+class MsgpackSerializer(Serializer):
+    name = 'msgpack'
+    id = 2
+
+    def dumps(self, obj):
+        try:
+            return msgpack.packb(obj, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError) as e:
+            raise SerializerError("Cannot encode as msgpack: {}".format(e))
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise SerializerError("Cannot decode msgpack: {}".format(e))
+
+
+class PickleSerializer(Serializer):
+    name = 'pickle'
+    id = 3
+    # Protocol 2 is the newest one Python 2 can read.
+    protocol = 2
+
+    def dumps(self, obj):
+        try:
+            return pickle.dumps(obj, self.protocol)
+        except Exception as e:
+            raise SerializerError("Cannot encode as pickle: {}".format(e))
+
+    def loads(self, data):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            raise SerializerError("Cannot decode pickle: {}".format(e))
+
+
+class MarshalSerializer(Serializer):
+    "Fast for builtin types, but both ends must run the same Python."
+    name = 'marshal'
+    id = 4
+
+    def dumps(self, obj):
+        try:
+            return marshal.dumps(obj, 2)
+        except ValueError as e:
+            raise SerializerError("Cannot encode as marshal: {}".format(e))
+
+    def loads(self, data):
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as e:
+            raise SerializerError("Cannot decode marshal: {}".format(e))
+
+
+_serializers = OrderedDict()
+_serializers_by_id = {}
+
+
+def register_serializer(serializer):
+    "Make ``serializer`` (an instance) available under its ``name``."
+    _serializers[serializer.name] = serializer
+    _serializers_by_id[serializer.id] = serializer
+    return serializer
+
+
+def get_serializer(name):
+    try:
+        return _serializers[name]
+    except KeyError:
+        raise SerializerError("Unknown serializer: {!r}".format(name))
+
+
+def get_serializer_by_id(serializer_id):
+    try:
+        return _serializers_by_id[serializer_id]
+    except KeyError:
+        raise SerializerError("Unknown serializer id: {!r}".format(
+            serializer_id))
+
+
+def available_serializers():
+    return list(_serializers)
+
+
+def negotiate(offered, allowed):
+    "Pick the first of the client's ``offered`` names the server allows."
+    for name in offered:
+        if name in allowed and name in _serializers:
+            return name
+    return DEFAULT_SERIALIZER
+
+
+register_serializer(JSONSerializer())
+register_serializer(PickleSerializer())
+register_serializer(MarshalSerializer())
+if msgpack is not None:
+    register_serializer(MsgpackSerializer())
@@ -1,61 +1,921 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import errno
+import fcntl
+import socket
 import logging
-from SocketServer import TCPServer, StreamRequestHandler, ThreadingMixIn
+import threading
+from collections import deque
+from time import time as _time
 
-from pasync._compat import Full
-from pasync.utils import json_decode, json_encode
+from pasync._compat import (
+    Full, TCPServer, StreamRequestHandler, ThreadingMixIn, basestring,
+    isfinite, long
+)
+from pasync import attachments, compression
+from pasync.connection import SocketBuffer
+from pasync.exceptions import (
+    ConnectionError, InvalidResponse, SerializerError
+)
+from pasync.poller import default_poller, POLL_READ, POLL_WRITE
+from pasync.protocol import (
+    pack_frame, pack_error, read_frame, FrameDecoder, SYM_EMPTY
+)
+from pasync.serializers import DEFAULT_SERIALIZER, get_serializer, negotiate
 from pasync.hooks import task_callback_hook
+from pasync.log import task_sampler
+from pasync.metrics import registry
 from pasync.q import q, Item
+from pasync.scheduler import Scheduler
+from pasync.cache import LRUCache
 
 logger = logging.getLogger(__name__)
-q.set_maxsize(10)
 
+tasks_enqueued = registry.counter(
+    'pasync_tasks_enqueued_total', "Tasks accepted into the queue.")
+tasks_rejected = registry.counter(
+    'pasync_tasks_rejected_total', "Tasks refused because the queue was full.")
+enqueue_seconds = registry.histogram(
+    'pasync_enqueue_seconds', "Time spent waiting to put a task on the queue.")
+ack_seconds = registry.histogram(
+    'pasync_ack_seconds', "Time from reading a task frame to its ack.")
+connections_total = registry.counter(
+    'pasync_connections_total', "Client connections accepted.")
+connections_active = registry.gauge(
+    'pasync_connections_active', "Client connections currently open.")
+protocol_errors = registry.counter(
+    'pasync_protocol_errors_total', "Connections dropped for a bad frame.")
+connection_errors = registry.counter(
+    'pasync_connection_errors_total',
+    "Connections dropped because handling them failed unexpectedly.")
+registry.gauge('pasync_queue_depth', "Tasks waiting in the queue.",
+               func=lambda: q.qsize())
+tasks_delayed = registry.counter(
+    'pasync_tasks_delayed_total', "Tasks accepted with an eta to wait for.")
+registry.gauge('pasync_task_logs_sampled_out',
+               "Per-task log lines skipped by sampling.",
+               func=lambda: task_sampler.dropped)
+idempotent_hits = registry.counter(
+    'pasync_idempotent_hits_total',
+    "Submits answered from an earlier task with the same key.")
+registry.gauge('pasync_queue_maxsize', "Queue capacity, 0 if unbounded.",
+               func=lambda: q.maxsize)
+compression_saved = registry.counter(
+    'pasync_compression_saved_bytes_total',
+    "Bytes saved by compressing the messages sent to clients.")
+attachment_bytes = registry.counter(
+    'pasync_attachment_bytes_total', "Attachment bytes spooled to disk.")
 
-def task_handler(task, timeout=3):
+
+# Sessions last told they have no credit, to be granted more as soon as
+# the queue has room again.
+_starved = set()
+_starved_lock = threading.Lock()
+
+
+def _grant_credit():
+    "Queue space listener: send fresh credit to starved sessions."
+    if not _starved:
+        return
+    with _starved_lock:
+        sessions = list(_starved)
+    for session in sessions:
+        session.refresh_credit()
+
+
+def _listen(queue, listen=True):
+    method = 'add_space_listener' if listen else 'remove_space_listener'
+    callback = getattr(queue, method, None)
+    if callback is not None:
+        callback(_grant_credit)
+
+
+def set_queue(queue):
+    "Make ``task_handler`` enqueue into ``queue`` instead of ``pasync.q.q``."
+    global q
+    _listen(q, False)
+    q = queue
+    _listen(q)
+    # Delayed tasks a journal kept across a restart.
+    take_delayed = getattr(queue, 'take_delayed', None)
+    if take_delayed is not None:
+        for eta, item in take_delayed():
+            if not scheduler.schedule(eta, item):
+                _promote(item)
+
+
+def get_queue():
+    return q
+
+
+_listen(q)
+
+
+# Seconds before a due task finds its queue full is tried again.
+PROMOTE_RETRY = 0.1
+
+
+def _promote(item):
+    "Enqueue a delayed task whose eta has come."
     try:
-        q.put(Item(task), timeout=timeout)
+        q.put(item, block=False)
     except Full:
+        # Waiting here would hold up every other timer; try again later.
+        scheduler.schedule(_time() + PROMOTE_RETRY, item)
+        return
+    tasks_enqueued.inc()
+
+
+scheduler = Scheduler(_promote)
+registry.gauge('pasync_tasks_scheduled',
+               "Delayed tasks waiting for their eta.",
+               func=lambda: len(scheduler))
+
+
+# Tasks by idempotency key (``task_key``): an ``_Execution`` while one is
+# queued or running, then its successful result message for ``ttl``.
+idempotency_cache = LRUCache(maxsize=10000, ttl=300)
+_idempotency_lock = threading.Lock()
+registry.gauge('pasync_idempotency_keys',
+               "Idempotency keys remembered, running or done.",
+               func=lambda: len(idempotency_cache))
+
+
+class _Execution(object):
+    "The ``reply`` of a keyed task, fanning its result out to every submit."
+    __slots__ = ('key', 'waiters')
+
+    def __init__(self, key, reply, task_id):
+        self.key = key
+        self.waiters = [(reply, task_id)]
+
+    def __call__(self, result):
+        status = result.get('task_status')
+        with _idempotency_lock:
+            if status == 'CHUNK':
+                # Part of a streamed result; a submit that attaches later
+                # only gets the chunks from then on.
+                waiters = list(self.waiters)
+            else:
+                waiters, self.waiters = self.waiters, []
+                if idempotency_cache.get(self.key) is self:
+                    if status == 'SUCCESS' and 'task_chunks' not in result:
+                        idempotency_cache.set(self.key, result)
+                    else:
+                        # Let a retry run it again; a stream is not kept.
+                        idempotency_cache.pop(self.key)
+        for reply, task_id in waiters:
+            if reply is not None:
+                reply(dict(result, task_id=task_id))
+
+    def reject(self):
+        """The task never got queued: forget it and fail the later
+        submits. The first one is told by its ack.
+        """
+        with _idempotency_lock:
+            waiters, self.waiters = self.waiters[1:], []
+            if idempotency_cache.get(self.key) is self:
+                idempotency_cache.pop(self.key)
+        for reply, task_id in waiters:
+            if reply is not None:
+                reply({'task_id': task_id, 'task_status': 'FAILURE',
+                       'task_result': 'Task Queue Is Full!'})
+
+
+def _claim(key, reply, task_id):
+    """Attach to an earlier submit of ``key`` and return True, or make
+    this submit the one that runs and return its ``_Execution``.
+    """
+    with _idempotency_lock:
+        entry = idempotency_cache.get(key)
+        if entry is None:
+            execution = _Execution(key, reply, task_id)
+            idempotency_cache.set(key, execution, ttl=None)
+            return execution
+        if isinstance(entry, _Execution):
+            entry.waiters.append((reply, task_id))
+            return True
+    if reply is not None:
+        reply(dict(entry, task_id=task_id))
+    return True
+
+
+def task_handler(task, timeout=3, reply=None, raw=None, codec=None):
+    """Enqueue ``task``, or hand it to ``scheduler`` if it has a
+    ``task_eta`` (a Unix timestamp) still to come.
+
+    A task with a ``task_key`` already submitted is not queued again: it
+    gets the result of that earlier task, now or when it finishes, and
+    True is returned.
+
+    If the undecoded frame is given as ``raw`` (encoded with the serializer
+    named ``codec``), that is what gets queued, so the decoded dict can be
+    freed as soon as the task has been acked.
+    """
+    key = task.get('task_key')
+    if key is not None:
+        execution = _claim(key, reply, task.get('task_id'))
+        if execution is True:
+            idempotent_hits.inc()
+            return True
+        reply = execution
+    kind = task.get('task_content')
+    item = Item(task if raw is None else raw,
+                priority=task.get('task_priority') or 0,
+                reply=reply, codec=codec,
+                kind=kind if isinstance(kind, basestring) else None)
+    eta = task.get('task_eta')
+    logged = False
+    if eta:
+        put_delayed = getattr(q, 'put_delayed', None)
+        if put_delayed is not None and eta > _time():
+            # Its ack promises it is kept, so a journal must have it now.
+            put_delayed(item, eta)
+            logged = True
+        if scheduler.schedule(eta, item):
+            tasks_delayed.inc()
+            return False
+    start = _time()
+    try:
+        q.put(item, timeout=timeout)
+    except Full:
+        tasks_rejected.inc()
+        if logged:
+            q.ack(item)
+        if key is not None:
+            execution.reject()
         raise
-    ret = 'Successful executed'
-    task_callback_hook.send(ret)
+    finally:
+        enqueue_seconds.observe(_time() - start)
+    tasks_enqueued.inc()
+    return False
+
+
+def _finite(value):
+    "Whether ``value`` is missing or a finite number; JSON allows NaN."
+    if value is None:
+        return True
+    return isinstance(value, (int, long, float)) and isfinite(value)
+
+
+def _valid_key(key):
+    "Whether ``key`` is a string or an integer; ``True`` would equal 1."
+    return isinstance(key, basestring) or (
+        isinstance(key, (int, long)) and not isinstance(key, bool))
+
+
+class TaskSession(object):
+    """Per-connection protocol state.
+
+    Turns task frames into ack frames; shared by ``QHandler`` and
+    ``EventQServer`` so both engines speak exactly the same protocol.
+
+    Messages are JSON until the client's first frame asks for another
+    serializer with ``{'hello': {'serializers': [...]}}``; the reply names
+    the first of those in ``allowed_serializers``, and both sides use it
+    from the next frame on. A ``{'stats': true}`` frame is answered with
+    ``{'stats': <metrics snapshot>}``.
+
+    Flow control: every ack (and the hello reply) carries ``credit``, how
+    many more tasks the client may send now, i.e. its share of the free
+    queue capacity, capped at ``credit_window``. A connection told 0 has
+    its tasks rejected at once rather than after ``enqueue_timeout``, and
+    is sent ``{'credit': n}`` as soon as the queue has room again.
+
+    The hello may also list ``compression`` names, and a ``dictionary`` id
+    (see ``pasync.compression``); the reply names the first of those in
+    ``allowed_compressors``, or None, and the dictionary if it is in
+    ``compression_dictionaries``. Messages of ``compress_threshold`` bytes
+    or more are then sent compressed.
+
+    A task with ``task_attachments`` is followed by their raw bytes, which
+    are spooled to files in ``spool_dir`` (see ``pasync.attachments``);
+    while ``receiving`` the transport hands them over with
+    ``feed_attachment``, and the task is acked once they are all in.
+    """
+    # pickle and marshal would let any client run code or crash us.
+    allowed_serializers = ('msgpack', 'json')
+    allowed_compressors = ('zstd', 'lz4', 'zlib')
+    compress_threshold = compression.DEFAULT_THRESHOLD
+    # dictionary_id -> shared dictionary, see ``add_compression_dictionary``.
+    compression_dictionaries = {}
+    credit_window = 1000
+    # Where attachments are spooled, the system temp dir if None.
+    spool_dir = None
+    max_attachment_size = 1 << 32
+
+    def __init__(self, client_address, enqueue_timeout=3, write=None):
+        self.client_address = client_address
+        self.enqueue_timeout = enqueue_timeout
+        self.write = write
+        self.serializer = get_serializer(DEFAULT_SERIALIZER)
+        self.compressor = None
+        self.greeted = False
+        self.starved = False
+        self._credit_owed = False
+        # (task, [(name, Spool)], start) while attachments come in.
+        self._incoming = None
+        connections_total.inc()
+        connections_active.inc()
+
+    def close(self):
+        self._set_starved(False)
+        if self._incoming is not None:
+            for name, spool in self._incoming[1]:
+                spool.discard()
+            self._incoming = None
+        connections_active.dec()
+
+    def credit(self):
+        "How many more tasks this connection may send right now."
+        maxsize = q.maxsize
+        if maxsize <= 0:
+            return self.credit_window
+        free = maxsize - q.qsize()
+        if free <= 0:
+            return 0
+        share = free // max(1, connections_active.value)
+        return max(1, min(self.credit_window, share))
+
+    def _set_starved(self, starved):
+        with _starved_lock:
+            self.starved = starved
+            if starved:
+                _starved.add(self)
+            else:
+                _starved.discard(self)
+
+    def next_credit(self):
+        "The credit to send with an ack, noting if it runs out."
+        credit = self.credit()
+        if not credit:
+            self._credit_owed = True
+        elif self.starved:
+            self._set_starved(False)
+        return credit
+
+    def acks_sent(self):
+        """Called by the transport once acks are written. A client told it
+        has no credit is only listed as starved now, so that a push of
+        fresh credit can never overtake the ack and be undone by it.
+        """
+        if self._credit_owed:
+            self._credit_owed = False
+            self._set_starved(True)
+            # Room may have freed up before we were listed as starved.
+            self.refresh_credit()
+
+    def refresh_credit(self):
+        "Tell a starved client it may send again, if it may."
+        credit = self.credit()
+        if not credit:
+            return
+        with _starved_lock:
+            if not self.starved:
+                return
+            self.starved = False
+            _starved.discard(self)
+        self.write(self.pack({'credit': credit}))
+
+    def pack(self, message):
+        "Encode ``message`` as a frame, compressed if it is worth it."
+        payload = self.serializer.dumps(message)
+        if self.compressor is None:
+            return pack_frame(payload)
+        data = compression.encode(payload, self.compressor,
+                                  self.compress_threshold)
+        if data[:1] == compression.FLAG_COMPRESSED:
+            compression_saved.inc(len(payload) - len(data))
+        return pack_frame(data)
+
+    def send_result(self, result):
+        "Push a finished task's result message to the client."
+        try:
+            data = self.pack(result)
+        except SerializerError as e:
+            data = self.pack({
+                'task_id': result.get('task_id'),
+                'task_status': 'FAILURE',
+                'task_result': 'Unserializable result: {}'.format(e)
+            })
+        self.write(data)
+
+    @classmethod
+    def add_compression_dictionary(cls, dictionary):
+        "Accept clients that compress with the shared ``dictionary``."
+        dictionaries = dict(cls.compression_dictionaries)
+        dictionaries[compression.dictionary_id(dictionary)] = dictionary
+        cls.compression_dictionaries = dictionaries
+
+    def hello(self, options):
+        """Answer the handshake and switch to the negotiated serializer and
+        compressor.
+        """
+        offered = options.get('serializers') if isinstance(
+            options, dict) else None
+        if not isinstance(offered, list):
+            raise InvalidResponse("Protocol Error: hello must list "
+                                  "serializers")
+        compressors = options.get('compression') or []
+        dictionary_id = options.get('dictionary')
+        if not isinstance(compressors, list) or \
+                not isinstance(dictionary_id, (basestring, type(None))):
+            raise InvalidResponse("Protocol Error: hello compression must "
+                                  "be a list, and dictionary an id")
+        name = negotiate(offered, self.allowed_serializers)
+        compressor = compression.negotiate(compressors,
+                                           self.allowed_compressors)
+        dictionary = self.compression_dictionaries.get(dictionary_id)
+        reply = {'serializer': name, 'credit': self.next_credit()}
+        if compressor is not None:
+            self.compressor = compression.get_compressor(compressor,
+                                                         dictionary)
+            reply['compression'] = compressor
+            reply['dictionary'] = dictionary_id if \
+                self.compressor.dictionary is not None else None
+        reply = pack_frame(self.serializer.dumps({'hello': reply}))
+        self.serializer = get_serializer(name)
+        return reply
+
+    def handle_frame(self, payload):
+        """Process one task frame and return the ack frame, or None if
+        attachments are to be received first.
+        """
+        start = _time()
+        if self.compressor is not None:
+            payload = compression.decode(payload, self.compressor)
+        try:
+            task = self.serializer.loads(payload)
+        except SerializerError as e:
+            raise InvalidResponse("Protocol Error: {}".format(e))
+        if not isinstance(task, dict):
+            raise InvalidResponse("Protocol Error: task must be a mapping")
+        if not self.greeted:
+            self.greeted = True
+            if 'hello' in task:
+                return self.hello(task['hello'])
+        if 'stats' in task:
+            return self.pack({'stats': registry.snapshot()})
+        if not _finite(task.get('task_priority')):
+            raise InvalidResponse("Protocol Error: task_priority must be a "
+                                  "finite number")
+        if not _valid_key(task.get('task_key', '')):
+            raise InvalidResponse("Protocol Error: task_key must be a "
+                                  "string or an integer")
+        if not _finite(task.get('task_eta')):
+            raise InvalidResponse("Protocol Error: task_eta must be a "
+                                  "finite timestamp")
+        if 'task_attachments' in task:
+            return self._receive_attachments(task, start)
+        return self._enqueue(task, payload, start)
+
+    def _receive_attachments(self, task, start):
+        specs = task['task_attachments']
+        if not isinstance(specs, list) or not all(
+                isinstance(spec, list) and len(spec) == 2 and
+                isinstance(spec[0], basestring) and
+                isinstance(spec[1], int) and
+                0 <= spec[1] <= self.max_attachment_size
+                for spec in specs):
+            raise InvalidResponse("Protocol Error: task_attachments must "
+                                  "list [name, size] pairs")
+        spools = []
+        try:
+            for name, size in specs:
+                spools.append((name, attachments.Spool(size,
+                                                       self.spool_dir)))
+        except EnvironmentError as e:
+            for name, spool in spools:
+                spool.discard()
+            raise InvalidResponse("Can not spool attachments: {}".format(e))
+        self._incoming = (task, spools, start)
+        return self._spooled()
+
+    @property
+    def receiving(self):
+        "Whether attachment bytes are expected before the next frame."
+        return self._incoming is not None
+
+    def feed_attachment(self, read_into):
+        """Fill the attachment being received with ``read_into(spool)``
+        and return the task's ack once the last one is complete, else
+        None.
+        """
+        for name, spool in self._incoming[1]:
+            if spool.remaining:
+                attachment_bytes.inc(read_into(spool))
+                break
+        return self._spooled()
+
+    def _spooled(self):
+        task, spools, start = self._incoming
+        if any(spool.remaining for name, spool in spools):
+            return None
+        self._incoming = None
+        paths = {}
+        for name, spool in spools:
+            spool.close()
+            paths[name] = spool.path
+        task['task_attachments'] = paths
+        return self._enqueue(task, self.serializer.dumps(task), start,
+                             paths=list(paths.values()))
+
+    def _enqueue(self, task, payload, start, paths=None):
+        # Checked before building a record; formatted on the log thread.
+        if logger.isEnabledFor(logging.INFO) and task_sampler():
+            logger.info("Got Connection from: %s with task: %s",
+                        self.client_address, task)
+        ack = {
+            'task_id': task.get('task_id'),
+            'task_ack': True,
+            'msg': None
+        }
+        try:
+            if task_handler(
+                    task, timeout=0 if self.starved else self.enqueue_timeout,
+                    reply=self.send_result, raw=payload,
+                    codec=self.serializer.name):
+                ack['task_duplicate'] = True
+        except Full:
+            ack['task_ack'] = False
+            ack['msg'] = 'Task Queue Is Full!'
+        if paths and (ack.get('task_duplicate') or not ack['task_ack']):
+            # Never going to run.
+            attachments.remove(paths)
+        ack['credit'] = self.next_credit()
+        frame = self.pack(ack)
+        ack_seconds.observe(_time() - start)
+        return frame
 
 
 class QHandler(StreamRequestHandler):
+    socket_read_size = 65536
+    session_class = TaskSession
+
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self._buffer = SocketBuffer(self.request, self.socket_read_size)
+        self._write_lock = threading.Lock()
+        self.session = self.session_class(self.client_address,
+                                          write=self.write)
+
+    def write(self, data):
+        "Send ``data`` to the client; safe to call from worker threads."
+        with self._write_lock:
+            try:
+                self.request.sendall(data)
+            except (socket.error, AttributeError):
+                # The client went away; there is nobody left to tell.
+                pass
+
+    def finish(self):
+        StreamRequestHandler.finish(self)
+        self._buffer.close()
+        self.session.close()
 
     def handle(self):
+        acks = []
+        session = self.session
         while True:
-            ack = {
-                'task_id': None,
-                'task_ack': True,
-                'msg': None
-            }
-            task = json_decode(self.request.recv(1024))
-
-            if not task:
+            try:
+                ack = session.handle_frame(read_frame(self._buffer))
+                while ack is None:
+                    ack = session.feed_attachment(self._buffer.read_into)
+                acks.append(ack)
+            except ConnectionError:
+                break
+            except InvalidResponse as e:
+                protocol_errors.inc()
+                logger.warning("Bad frame from {}: {}".format(
+                    self.client_address[0], e))
+                acks.append(pack_error(str(e)))
+                self.write(SYM_EMPTY.join(acks))
                 break
 
-            addr = self.request.getpeername()
-            logger.info(
-                "Got Connection from: {} with task: {}".format(
-                    addr, task)
-            )
-            task_id = task.get('task_id')
-            ack['task_id'] = task_id
-            try:
-                task_handler(task)
-            except Full:
-                ack['task_ack'] = False
-                ack['msg'] = 'Task Queue Is Full!'
-            # ack to cilent
-            self.wfile.write(json_encode(ack))
-        logger.info("Broken connect with: {}".format(self.client_address[0]))
+            # ack to cilent, coalescing the acks of pipelined tasks that
+            # are already buffered into a single write.
+            if not self._buffer.length:
+                self.write(SYM_EMPTY.join(acks))
+                acks = []
+                session.acks_sent()
+        logger.info("Broken connect with: %s", self.client_address[0])
 
 
 # Support multi threading
 class QServer(ThreadingMixIn, TCPServer):
-    pass
+    # Let several processes bind the port, see ``pasync.prefork``.
+    allow_reuse_port = False
+
+    def server_bind(self):
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
+
+
+class EventConnection(object):
+    "A non-blocking client connection owned by ``EventQServer``."
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client_address = client_address
+        self.session = server.RequestHandlerClass.session_class(
+            client_address, enqueue_timeout=server.enqueue_timeout,
+            write=self.write_threadsafe)
+        self.decoder = FrameDecoder()
+        self.outbuf = bytearray()
+        self.closing = False
+        self.closed = False
+        # Bytes from other threads not yet in ``outbuf``, and the
+        # threads waiting for the client to catch up.
+        self._queued = 0
+        self._blocked = 0
+        self._drained = threading.Condition(threading.Lock())
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(self.server.socket_read_size)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = None
+        if not data:
+            self.close()
+            return
+
+        self.decoder.feed(data)
+        replies = []
+        session = self.session
+        try:
+            while not self.closing:
+                if session.receiving:
+                    if not len(self.decoder):
+                        break
+                    reply = session.feed_attachment(self.decoder.read_into)
+                else:
+                    payload = self.decoder.next_frame()
+                    if payload is None:
+                        break
+                    reply = session.handle_frame(payload)
+                if reply is not None:
+                    replies.append(reply)
+        except InvalidResponse as e:
+            protocol_errors.inc()
+            logger.warning("Bad frame from {}: {}".format(
+                self.client_address[0], e))
+            replies.append(pack_error(str(e)))
+            self.closing = True
+        if replies:
+            self.write(SYM_EMPTY.join(replies))
+            session.acks_sent()
+
+    def write(self, data):
+        if self.closed:
+            return
+        self.outbuf += data
+        self.handle_write()
+
+    def write_threadsafe(self, data):
+        """Queue ``data`` for the loop thread to write, from any thread.
+
+        Other threads block while more than ``server.write_high_water``
+        bytes are waiting to be sent, so a client that reads slowly holds
+        up whoever is producing its results instead of filling memory.
+        """
+        with self._drained:
+            if self.server.loop_thread is not threading.current_thread():
+                high_water = self.server.write_high_water
+                while not self.closed and \
+                        self._queued + len(self.outbuf) > high_water:
+                    self._blocked += 1
+                    try:
+                        self._drained.wait(1)
+                    finally:
+                        self._blocked -= 1
+            self._queued += len(data)
+        self.server.call_soon_threadsafe(self._write_queued, data)
+
+    def _write_queued(self, data):
+        with self._drained:
+            self._queued -= len(data)
+        self.write(data)
+
+    def _notify_drained(self):
+        with self._drained:
+            self._drained.notify_all()
+
+    def handle_write(self):
+        while self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.args[0] == errno.EINTR:
+                    continue
+                self.close()
+                return
+            del self.outbuf[:sent]
+
+        if self._blocked and \
+                len(self.outbuf) <= self.server.write_high_water:
+            self._notify_drained()
+        if self.outbuf:
+            self.server.set_events(self, POLL_READ | POLL_WRITE)
+        elif self.closing:
+            self.close()
+        else:
+            self.server.set_events(self, POLL_READ)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.remove_connection(self)
+        self.session.close()
+        self._notify_drained()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        logger.info("Broken connect with: %s", self.client_address[0])
+
+
+class EventQServer(object):
+    """Single-threaded, readiness-based QServer.
+
+    Multiplexes every client socket over one epoll/poll/select loop instead
+    of dedicating a thread to each connection. It takes the same arguments
+    as ``QServer`` and speaks the protocol of ``RequestHandlerClass``'s
+    session class. Enqueueing never blocks the loop: a full queue is acked
+    as a rejection straight away.
+    """
+
+    address_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    request_queue_size = 1024
+    allow_reuse_address = True
+    allow_reuse_port = False
+    socket_read_size = 65536
+    enqueue_timeout = 0
+    # Unsent bytes per connection before result writers block.
+    write_high_water = 1 << 20
+
+    def __init__(self, server_address, RequestHandlerClass=QHandler,
+                 bind_and_activate=True, poller=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.socket(self.address_family, self.socket_type)
+        self._poller = poller or default_poller()
+        self._connections = {}
+        self._events = {}
+        self._callbacks = deque()
+        self._waker_r, self._waker_w = os.pipe()
+        for fd in (self._waker_r, self._waker_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._running = False
+        self.loop_thread = None
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        if bind_and_activate:
+            try:
+                self.server_bind()
+                self.server_activate()
+            except Exception:
+                self.server_close()
+                raise
+
+    def server_bind(self):
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.allow_reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+        self._poller.register(self.socket.fileno(), POLL_READ)
+        self._poller.register(self._waker_r, POLL_READ)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._running = True
+        self.loop_thread = threading.current_thread()
+        self._is_shut_down.clear()
+        listen_fd = self.socket.fileno()
+        try:
+            while self._running:
+                for fd, events in self._poller.poll(poll_interval):
+                    if fd == listen_fd:
+                        self._accept()
+                        continue
+                    if fd == self._waker_r:
+                        self._run_callbacks()
+                        continue
+                    conn = self._connections.get(fd)
+                    if conn is None:
+                        continue
+                    # One client's failure must not stop the loop for all.
+                    try:
+                        if events & ~POLL_WRITE:
+                            conn.handle_read()
+                        if events & POLL_WRITE and not conn.closed:
+                            conn.handle_write()
+                    except Exception:
+                        self._drop(conn)
+        finally:
+            self._running = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        "Stop ``serve_forever`` and wait for it to return."
+        self._running = False
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        for conn in list(self._connections.values()):
+            conn.close()
+        self._poller.close()
+        self.socket.close()
+        os.close(self._waker_r)
+        os.close(self._waker_w)
+
+    def call_soon_threadsafe(self, callback, *args):
+        "Run ``callback(*args)`` on the loop thread."
+        self._callbacks.append((callback, args))
+        try:
+            os.write(self._waker_w, b'x')
+        except OSError:
+            # The pipe is full, so a wake-up is already pending.
+            pass
+
+    def _run_callbacks(self):
+        try:
+            while os.read(self._waker_r, 4096):
+                pass
+        except OSError:
+            pass
+        callbacks = self._callbacks
+        for _ in range(len(callbacks)):
+            callback, args = callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                conn = getattr(callback, '__self__', None)
+                if isinstance(conn, EventConnection):
+                    self._drop(conn)
+                else:
+                    logger.exception("Loop callback {!r} failed".format(
+                        callback))
+
+    def _drop(self, conn):
+        connection_errors.inc()
+        logger.exception("Error handling {}; closing its connection".format(
+            conn.client_address[0]))
+        try:
+            conn.close()
+        except Exception:
+            logger.exception("Error closing connection to {}".format(
+                conn.client_address[0]))
+
+    def _accept(self):
+        # Drain the accept backlog in one go.
+        while True:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.warning("Accept failed: {}".format(e))
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = EventConnection(self, sock, client_address)
+            self._connections[conn.fd] = conn
+            self._events[conn.fd] = POLL_READ
+            self._poller.register(conn.fd, POLL_READ)
+
+    def set_events(self, conn, events):
+        if self._events.get(conn.fd) != events:
+            self._events[conn.fd] = events
+            self._poller.modify(conn.fd, events)
+
+    def remove_connection(self, conn):
+        if self._connections.pop(conn.fd, None) is not None:
+            self._events.pop(conn.fd, None)
+            try:
+                self._poller.unregister(conn.fd)
+            except (KeyError, ValueError, IOError, OSError):
+                pass
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-import json
+import calendar
+import time
 
 
 #  format `print`
@@ -8,15 +9,12 @@ def printf(msg):
     pass
 
 
-def json_encode(obj):
-    try:
-        return json.dumps(obj)
-    except ValueError:
-        return obj
-
-
-def json_decode(obj):
-    try:
-        return json.loads(obj)
-    except ValueError:
-        return obj
+def to_timestamp(value):
+    "Unix timestamp of ``value``, a timestamp or a (naive = local) datetime."
+    if not hasattr(value, 'timetuple'):
+        return value
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+    return seconds + value.microsecond / 1e6
@@ -1,5 +1,227 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import types
+import logging
+import threading
+import multiprocessing
+from collections import namedtuple
+from functools import partial
+from time import time as _time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from pasync._compat import Empty
+from pasync.attachments import open_all, close_all, remove
+from pasync.hooks import task_callback_hook
+from pasync.metrics import registry
+from pasync.q import q
+from pasync.serializers import DEFAULT_SERIALIZER, get_serializer
+
+logger = logging.getLogger(__name__)
+
+TASK_SUCCESS = 'SUCCESS'
+TASK_FAILURE = 'FAILURE'
+# A piece of a generator task's output, sent before its final result.
+TASK_CHUNK = 'CHUNK'
+# Internal: the outcome of a generator task, see ``execute_task``.
+TASK_STREAM = 'STREAM'
+
+_tasks = {}
+_batch_tasks = {}
+
+BatchTask = namedtuple('BatchTask', 'func max_batch_size max_linger_ms')
+
+tasks_succeeded = registry.counter(
+    'pasync_tasks_succeeded_total', "Tasks that returned a result.")
+tasks_failed = registry.counter(
+    'pasync_tasks_failed_total', "Tasks that raised or could not run.")
+task_seconds = registry.histogram(
+    'pasync_task_seconds', "Time from dequeueing a task to its result.")
+task_batches = registry.counter(
+    'pasync_task_batches_total', "Batches handed to batch tasks.")
+
+
+def register_task(func=None, name=None):
+    """Register ``func`` as the handler for tasks whose content is ``name``.
+
+    Usable as ``register_task(func)`` or as a decorator, with or without a
+    ``name`` (defaults to the function name). Process pools fork at
+    ``TaskWorker.start``, so register tasks before starting the worker.
+    """
+    if func is None:
+        return partial(register_task, name=name)
+    _tasks[name or func.__name__] = func
+    return func
+
+
+def register_batch_task(func=None, name=None, max_batch_size=500,
+                        max_linger_ms=50):
+    """Register ``func`` to handle tasks ``name`` many at a time.
+
+    ``func`` gets a list of up to ``max_batch_size`` task params dicts and
+    returns the result of each, in the same order; an exception instance
+    in place of a result fails only that task. A worker waits up to
+    ``max_linger_ms`` for a batch to fill once its first task is in.
+    """
+    if func is None:
+        return partial(register_batch_task, name=name,
+                       max_batch_size=max_batch_size,
+                       max_linger_ms=max_linger_ms)
+    _batch_tasks[name or func.__name__] = BatchTask(func, max_batch_size,
+                                                    max_linger_ms)
+    return func
+
+
+def unregister_task(name):
+    _tasks.pop(name, None)
+    _batch_tasks.pop(name, None)
+
+
+def _open_attachments(name, params, paths):
+    """``params`` with the spooled attachments ``paths`` mapped in, or
+    None, with the files removed, if they can not be.
+    """
+    try:
+        maps = open_all(paths)
+    except EnvironmentError as e:
+        logger.error("Attachments of task {!r} are gone: {}".format(name, e))
+        remove(paths.values())
+        return None
+    params = dict(params)
+    params.update(maps)
+    return params
+
+
+def _release_attachments(params, paths):
+    close_all(dict((name, params[name]) for name in paths))
+    remove(paths.values())
+
+
+def execute_task(name, params, emit=None, attachments=None):
+    """Run the task registered as ``name`` and return ``(status, result)``.
+
+    A task that is a generator streams: each value it yields is passed to
+    ``emit`` as soon as it is produced (or collected, without ``emit``),
+    and ``(TASK_STREAM, (count, collected, (status, result)))`` is
+    returned at the end.
+
+    ``attachments`` maps parameter names to spool files, passed to the task
+    as read-only ``mmap`` objects that are only valid while it runs.
+
+    Never raises, so a failing task can not take a pool worker down with it.
+    """
+    if not attachments:
+        return _execute(name, params, emit)
+    params = _open_attachments(name, params, attachments)
+    if params is None:
+        return TASK_FAILURE, "Attachments of task {!r} are gone".format(name)
+    try:
+        return _execute(name, params, emit)
+    finally:
+        _release_attachments(params, attachments)
+
+
+def _execute(name, params, emit):
+    func = _tasks.get(name)
+    if func is None:
+        return TASK_FAILURE, "Unknown task: {!r}".format(name)
+    try:
+        result = func(**params)
+    except Exception as e:
+        logger.exception("Task {!r} failed".format(name))
+        return TASK_FAILURE, "{}: {}".format(type(e).__name__, e)
+    if not isinstance(result, types.GeneratorType):
+        return TASK_SUCCESS, result
+
+    collected = [] if emit is None else None
+    count = 0
+    try:
+        for chunk in result:
+            count += 1
+            if emit is None:
+                collected.append(chunk)
+            else:
+                emit(chunk)
+        outcome = TASK_SUCCESS, None
+    except Exception as e:
+        logger.exception("Task {!r} failed".format(name))
+        outcome = TASK_FAILURE, "{}: {}".format(type(e).__name__, e)
+    return TASK_STREAM, (count, collected, outcome)
+
+
+def execute_batch(name, params, attachments=None):
+    """Run the batch task registered as ``name`` over the list ``params``
+    and return a ``(status, result)`` for each. Never raises.
+
+    ``attachments`` holds each task's spooled attachments, as for
+    ``execute_task``, or None.
+    """
+    if not attachments or not any(attachments):
+        return _execute_batch(name, params)
+    opened = [_open_attachments(name, p, paths) if paths else p
+              for p, paths in zip(params, attachments)]
+    ready = [i for i, p in enumerate(opened) if p is not None]
+    outcomes = [(TASK_FAILURE, "Attachments of task {!r} are gone".format(
+        name))] * len(params)
+    try:
+        if ready:
+            for i, outcome in zip(ready, _execute_batch(
+                    name, [opened[i] for i in ready])):
+                outcomes[i] = outcome
+    finally:
+        for p, paths in zip(opened, attachments):
+            if p is not None and paths:
+                _release_attachments(p, paths)
+    return outcomes
+
+
+def _execute_batch(name, params):
+    batch = _batch_tasks.get(name)
+    if batch is None:
+        return [(TASK_FAILURE, "Unknown task: {!r}".format(name))] * len(
+            params)
+    try:
+        results = list(batch.func(params))
+    except Exception as e:
+        logger.exception("Batch task {!r} failed".format(name))
+        return [(TASK_FAILURE, "{}: {}".format(type(e).__name__, e))] * len(
+            params)
+    if len(results) != len(params):
+        return [(TASK_FAILURE, "Batch task {!r} returned {} results for {} "
+                 "tasks".format(name, len(results), len(params)))] * len(
+                     params)
+    return [(TASK_FAILURE, "{}: {}".format(type(r).__name__, r))
+            if isinstance(r, Exception) else (TASK_SUCCESS, r)
+            for r in results]
+
+
+class UnsentResultError(Exception):
+    "A pool worker could not send back the result of a task."
+
+
+def _checked(func, args, kwds):
+    """Run ``func`` in a Python 2 process pool, which silently drops a
+    result it can not pickle; see ``TaskWorker._apply``.
+    """
+    result = func(*args, **kwds)
+    try:
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return UnsentResultError("{}: {}".format(type(e).__name__, e))
+    return result
+
+
+def _unwrap(callback, error_callback, result):
+    if isinstance(result, UnsentResultError):
+        error_callback(result)
+    else:
+        callback(result)
+
 
 class BaseWorker(object):
 
@@ -13,3 +235,265 @@ class BaseWorker(object):
 
     def task_result(self, timeout=5):
         raise NotImplementedError
+
+
+class TaskWorker(object):
+    """Drains a priority queue and runs registered tasks on a pool.
+
+    ``pool='thread'`` suits I/O-bound tasks, ``pool='process'`` spreads
+    CPU-bound tasks over every core. At most ``concurrency`` tasks are
+    taken off the queue at a time, so anything not yet running stays in
+    priority order. Each result goes back through the item's ``reply`` and
+    is also announced on ``task_callback_hook``.
+
+    Generator tasks send each value they yield through ``reply`` as a
+    ``CHUNK`` message, then a final one with ``task_chunks``, the count.
+    On a thread pool chunks go out as they are produced, and a generator
+    is held up while its client is slow to read them; a process pool sends
+    them all when the task ends.
+
+    Tasks registered with ``register_batch_task`` are collected by a
+    thread per task name, from their own lane of the queue, and run a
+    batch per pool slot.
+    """
+
+    pool_classes = {
+        'thread': ThreadPool,
+        'process': multiprocessing.Pool,
+    }
+
+    def __init__(self, queue=q, pool='thread', concurrency=None,
+                 poll_interval=0.5):
+        if pool not in self.pool_classes:
+            raise ValueError("pool must be one of {}".format(
+                sorted(self.pool_classes)))
+        self.queue = queue
+        self.pool_type = pool
+        self.concurrency = concurrency or multiprocessing.cpu_count()
+        self.poll_interval = poll_interval
+        self._pool = None
+        self._slots = None
+        self._thread = None
+        self._batchers = []
+        self._running = False
+
+    def start(self):
+        if self._running:
+            return
+        self._pool = self.pool_classes[self.pool_type](self.concurrency)
+        self._slots = threading.Semaphore(self.concurrency)
+        self._running = True
+        self._thread = threading.Thread(target=self._dispatch_loop,
+                                        name='pasync-worker-dispatch')
+        self._thread.daemon = True
+        self._thread.start()
+        if hasattr(self.queue, 'add_lane'):
+            # Without lanes, batch tasks are run one at a time.
+            for name, batch in list(_batch_tasks.items()):
+                self.queue.add_lane(name)
+                thread = threading.Thread(
+                    target=self._batch_loop, args=(name, batch),
+                    name='pasync-worker-batch-{}'.format(name))
+                thread.daemon = True
+                thread.start()
+                self._batchers.append(thread)
+
+    def stop(self, wait=True):
+        "Stop taking tasks; with ``wait`` let the running ones finish."
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join()
+        for thread in self._batchers:
+            thread.join()
+        self._batchers = []
+        if wait:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+    def _dispatch_loop(self):
+        # Where the queue can say it has an item, only take a slot for
+        # one: an idle loop holding a slot would starve the batch ones.
+        wait = getattr(self.queue, 'wait', None)
+        while self._running:
+            if wait is not None and not wait(self.poll_interval):
+                continue
+            self._slots.acquire()
+            try:
+                item = self.queue.get(timeout=0 if wait is not None
+                                      else self.poll_interval)
+            except Empty:
+                self._slots.release()
+                continue
+            try:
+                self._submit(item)
+            except Exception:
+                # Undecodable; acked so that a journal does not replay it.
+                self._slots.release()
+                logger.exception("Failed to submit {!r}".format(item))
+                self._ack(item)
+
+    def _batch_loop(self, name, batch):
+        queue = self.queue
+        size = batch.max_batch_size
+        while self._running:
+            if not queue.wait(self.poll_interval, kind=name):
+                continue
+            self._slots.acquire()
+            try:
+                items = queue.get_batch(name, size, block=False)
+            except Empty:
+                self._slots.release()
+                continue
+            deadline = _time() + batch.max_linger_ms / 1000.0
+            while len(items) < size:
+                remaining = deadline - _time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.extend(queue.get_batch(name, size - len(items),
+                                                 timeout=remaining))
+                except Empty:
+                    break
+            try:
+                self._submit_batch(name, items)
+            except Exception:
+                self._slots.release()
+                logger.exception("Failed to submit a batch of {!r}".format(
+                    name))
+                for item in items:
+                    self._ack(item)
+
+    @staticmethod
+    def _decode(item):
+        task = item.data
+        if not isinstance(task, dict):
+            # Queued by the server as the raw frame.
+            serializer = get_serializer(item.codec or DEFAULT_SERIALIZER)
+            task = serializer.loads(task)
+        return task
+
+    def _submit_batch(self, name, items, tasks=None):
+        if tasks is None:
+            tasks = [self._decode(item) for item in items]
+        task_ids = [task.get('task_id') for task in tasks]
+        start = _time()
+        task_batches.inc()
+        self._apply(
+            execute_batch,
+            (name, [task.get('task_params') or {} for task in tasks],
+             [task.get('task_attachments') for task in tasks]), {},
+            partial(self._on_batch_done, items, task_ids, start),
+            partial(self._on_batch_error, items, task_ids, start))
+
+    def _submit(self, item):
+        task = self._decode(item)
+        name = task.get('task_content')
+        if name in _batch_tasks:
+            # Queued before its lane existed, e.g. replayed from a journal.
+            self._submit_batch(name, [item], [task])
+            return
+        task_id = task.get('task_id')
+        start = _time()
+        args = (task.get('task_content'), task.get('task_params') or {})
+        kwds = {'attachments': task.get('task_attachments')}
+        if self.pool_type == 'thread':
+            kwds['emit'] = partial(self._emit, item, task_id)
+        self._apply(execute_task, args, kwds,
+                    partial(self._on_done, item, task_id, start),
+                    partial(self._on_error, item, task_id, start))
+
+    def _apply(self, func, args, kwds, callback, error_callback):
+        """``apply_async`` that always ends in one of the callbacks, which
+        release the slot and ack the item.
+
+        Python 2 pools have no ``error_callback``, so a process pool there
+        runs ``func`` through ``_checked``.
+        """
+        try:
+            if sys.version_info[0] >= 3:
+                self._pool.apply_async(func, args, kwds, callback=callback,
+                                       error_callback=error_callback)
+                return
+            if self.pool_type == 'process':
+                func, args, kwds = _checked, (func, args, kwds), {}
+                callback = partial(_unwrap, callback, error_callback)
+            self._pool.apply_async(func, args, kwds, callback=callback)
+        except Exception as e:
+            # Never submitted, e.g. the pool is closed.
+            logger.exception("Failed to submit {!r}".format(func))
+            error_callback(e)
+
+    @staticmethod
+    def _emit(item, task_id, chunk):
+        if item.reply is not None:
+            item.reply({
+                'task_id': task_id,
+                'task_status': TASK_CHUNK,
+                'task_result': chunk
+            })
+
+    def _on_error(self, item, task_id, start, exc):
+        # Only reached when the pool itself fails, e.g. an unpicklable result
+        # or a closed pool.
+        self._on_done(item, task_id, start, (TASK_FAILURE, "{}: {}".format(
+            type(exc).__name__, exc)))
+
+    def _on_batch_error(self, items, task_ids, start, exc):
+        outcome = (TASK_FAILURE, "{}: {}".format(type(exc).__name__, exc))
+        self._on_batch_done(items, task_ids, start, [outcome] * len(items))
+
+    def _on_batch_done(self, items, task_ids, start, outcomes):
+        self._slots.release()
+        for item, task_id, outcome in zip(items, task_ids, outcomes):
+            self._finish(item, task_id, start, outcome)
+
+    def _on_done(self, item, task_id, start, outcome):
+        self._slots.release()
+        self._finish(item, task_id, start, outcome)
+
+    def _ack(self, item):
+        ack = getattr(self.queue, 'ack', None)
+        if ack is not None:
+            try:
+                ack(item)
+            except Exception:
+                logger.exception("Failed to ack {!r}".format(item))
+
+    def _finish(self, item, task_id, start, outcome):
+        task_seconds.observe(_time() - start)
+        self._ack(item)
+        status, value = outcome
+        chunks = None
+        if status == TASK_STREAM:
+            chunks, collected, (status, value) = value
+            try:
+                for chunk in collected or ():
+                    self._emit(item, task_id, chunk)
+            except Exception:
+                logger.exception("Failed to deliver result of {!r}".format(
+                    item))
+        if status == TASK_SUCCESS:
+            tasks_succeeded.inc()
+        else:
+            tasks_failed.inc()
+        result = {
+            'task_id': task_id,
+            'task_status': status,
+            'task_result': value
+        }
+        if chunks is not None:
+            result['task_chunks'] = chunks
+        if item.reply is not None:
+            try:
+                item.reply(result)
+            except Exception:
+                logger.exception("Failed to deliver result of {!r}".format(
+                    item))
+        try:
+            task_callback_hook.send(result)
+        except Exception:
+            logger.exception("Task callback hook failed")
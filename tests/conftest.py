@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from pasync.q import ShardedQ
+from pasync.server import EventQServer, QHandler, QServer, get_queue, \
+    set_queue
+from pasync.worker import TaskWorker, register_task, unregister_task
+
+
+class _QServer(QServer):
+    # Handler threads block reading their client; do not wait for them.
+    daemon_threads = True
+
+
+ENGINES = {'threaded': _QServer, 'event': EventQServer}
+
+
+def add(a, b):
+    return a + b
+
+
+def count(n):
+    for i in range(n):
+        yield i
+
+
+@pytest.fixture
+def queue():
+    "A fresh server queue, without a worker."
+    old = get_queue()
+    queue = ShardedQ()
+    set_queue(queue)
+    yield queue
+    set_queue(old)
+
+
+@pytest.fixture
+def worker(queue):
+    register_task(add)
+    register_task(count)
+    worker = TaskWorker(queue=queue, concurrency=2, poll_interval=0.05)
+    worker.start()
+    yield worker
+    worker.stop()
+    unregister_task('add')
+    unregister_task('count')
+
+
+def _serve(engine):
+    server = ENGINES[engine](('127.0.0.1', 0), QHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _close(server):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=sorted(ENGINES))
+def server(request, worker):
+    "A server on a free local port, of each engine, running tasks."
+    server = _serve(request.param)
+    yield server
+    _close(server)
+
+
+@pytest.fixture(params=sorted(ENGINES))
+def idle_server(request, queue):
+    "A server of each engine whose queue nothing takes from."
+    server = _serve(request.param)
+    yield server
+    _close(server)
+
+
+@pytest.fixture
+def port(server):
+    return server.server_address[1]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+import pytest
+
+if sys.version_info < (3, 7):
+    pytest.skip("the asyncio client needs Python 3.7", allow_module_level=True)
+
+import asyncio
+
+from pasync.aio import AsyncConnection, AsyncConnectionPool
+from pasync.exceptions import (
+    InvalidResponse, ResponseError, SerializerError
+)
+from pasync.protocol import MAX_FRAME_SIZE
+
+
+def run(port, body):
+    async def main():
+        connection = AsyncConnection(port=port)
+        await connection.connect()
+        try:
+            return await body(connection)
+        finally:
+            await connection.disconnect()
+    return asyncio.run(main())
+
+
+def test_send_and_get_result(port):
+    async def body(c):
+        ack = await c.send('add', a=1, b=2)
+        return await c.get_result(ack['task_id'])
+    result = run(port, body)
+    assert result['task_status'] == 'SUCCESS'
+    assert result['task_result'] == 3
+
+
+def test_iter_results_streams_chunks(port):
+    async def body(c):
+        ack = await c.send('count', n=5)
+        return [chunk async for chunk in c.iter_results(ack['task_id'])]
+    assert run(port, body) == [0, 1, 2, 3, 4]
+
+
+def test_iter_results_after_the_task_ended(port):
+    async def body(c):
+        ack = await c.send('count', n=3)
+        # Its chunks and final result are all in by the time it is read.
+        await asyncio.sleep(0.3)
+        return [chunk async for chunk in c.iter_results(ack['task_id'])]
+    assert run(port, body) == [0, 1, 2]
+
+
+def test_iter_results_of_a_plain_task(port):
+    async def body(c):
+        ack = await c.send('add', a=2, b=2)
+        return [chunk async for chunk in c.iter_results(ack['task_id'])]
+    assert run(port, body) == [4]
+
+
+def test_iter_results_raises_for_failures(port):
+    async def body(c):
+        ack = await c.send('add', a=1)
+        async for _ in c.iter_results(ack['task_id']):
+            pass
+    with pytest.raises(ResponseError):
+        run(port, body)
+
+
+def test_get_result_of_a_streamed_task(port):
+    async def body(c):
+        ack = await c.send('count', n=3)
+        return await c.get_result(ack['task_id'], timeout=2)
+    result = run(port, body)
+    assert result['task_status'] == 'SUCCESS'
+    assert result['task_chunks'] == 3
+
+
+def test_get_any_result_of_a_streamed_task(port):
+    async def body(c):
+        ack = await c.send('count', n=3)
+        result = await c.get_result(timeout=2)
+        return ack, result
+    ack, result = run(port, body)
+    assert result['task_id'] == ack['task_id']
+    assert result['task_chunks'] == 3
+
+
+def test_pool_made_outside_the_loop(port):
+    pool = AsyncConnectionPool(port=port)
+
+    async def main():
+        connection = await pool.get_connection()
+        try:
+            ack = await connection.send('add', a=1, b=2)
+            return await connection.get_result(ack['task_id'])
+        finally:
+            pool.release(connection)
+            await pool.disconnect()
+    assert asyncio.run(main())['task_result'] == 3
+
+
+def test_task_that_fails_to_pack_is_not_left_pending(port):
+    async def body(c):
+        with pytest.raises(SerializerError):
+            await c.send('add', a=object(), b=1)
+        return dict(c._pending)
+    assert run(port, body) == {}
+
+
+def test_oversized_frame_is_rejected():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'$%d\r\n' % (MAX_FRAME_SIZE + 1))
+        reader.feed_eof()
+        connection = AsyncConnection()
+        connection._reader = reader
+        await connection._read_frame()
+    with pytest.raises(InvalidResponse):
+        asyncio.run(main())
+
+
+def test_uninstalled_serializers_are_not_offered(port):
+    async def main():
+        connection = AsyncConnection(port=port, serializer=['nosuch'])
+        await connection.connect()
+        try:
+            ack = await connection.send('add', a=1, b=2)
+            result = await connection.get_result(ack['task_id'])
+            return connection.serializer.name, result['task_result']
+        finally:
+            await connection.disconnect()
+    assert asyncio.run(main()) == ('json', 3)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from pasync import compression
+from pasync.exceptions import InvalidResponse
+
+NAMES = ['zlib'] + [name for name in ('lz4', 'zstd')
+                    if name in compression.available_compressors()]
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_round_trip(name):
+    compressor = compression.get_compressor(name)
+    for payload in (b'small', b'{"task_id": 1}' * 500):
+        data = compression.encode(payload, compressor, threshold=64)
+        assert compression.decode(data, compressor) == payload
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_decompress_stops_at_the_limit(name):
+    compressor = compression.get_compressor(name)
+    data = compressor.compress(b'\0' * 100000)
+    assert len(compressor.decompress(data, 100000)) == 100000
+    with pytest.raises(ValueError):
+        compressor.decompress(data, 99999)
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_truncated_payload_is_rejected(name):
+    compressor = compression.get_compressor(name)
+    data = compressor.compress(b'\0' * 100000)
+    payload = compression.FLAG_COMPRESSED + data[:len(data) // 2]
+    with pytest.raises(InvalidResponse):
+        compression.decode(payload, compressor)
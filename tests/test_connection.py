@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+import pytest
+
+from pasync.connection import Connection
+from pasync.exceptions import ConnectionError
+
+
+def test_uninstalled_serializers_are_not_offered(port):
+    connection = Connection(port=port, serializer=['nosuch', 'pickle'],
+                            compression=['nosuch'])
+    connection.connect()
+    try:
+        # The server allows neither, so it falls back to JSON.
+        assert connection.serializer.name == 'json'
+        assert connection.compressor is None
+        ack = connection.send('add', a=1, b=2)
+        assert connection.get_result(ack['task_id'])['task_result'] == 3
+    finally:
+        connection.disconnect()
+
+
+def test_socket_error_during_the_hello_disconnects():
+    ours, theirs = socket.socketpair()
+    theirs.close()
+    connection = Connection(serializer='msgpack')
+    connection._connect = lambda: ours
+    with pytest.raises(ConnectionError):
+        connection.connect()
+    assert connection._sock is None
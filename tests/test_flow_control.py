@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from pasync.connection import Connection
+from pasync.exceptions import FlowTimeoutError
+
+
+@pytest.fixture
+def connection(idle_server):
+    connection = Connection(port=idle_server.server_address[1],
+                            flow_timeout=0.3)
+    connection.connect()
+    yield connection
+    connection.disconnect()
+
+
+def _drain(queue, count, delay=0.05):
+    "Take ``count`` items off ``queue`` from a thread, ``delay`` apart."
+    def run():
+        for _ in range(count):
+            time.sleep(delay)
+            queue.get(timeout=5)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_ack_credit_runs_out_with_the_queue(queue, connection):
+    queue.set_maxsize(2)
+    assert connection.send('add', a=1, b=1)['credit'] == 1
+    assert connection.send('add', a=1, b=2)['credit'] == 0
+    with pytest.raises(FlowTimeoutError) as info:
+        connection.send('add', a=1, b=3)
+    assert info.value.acks == [None]
+    assert queue.qsize() == 2
+
+
+def test_credit_is_pushed_once_there_is_room(queue, connection):
+    queue.set_maxsize(1)
+    connection.send('add', a=1, b=1)
+    assert connection.credit == 0
+    _drain(queue, 1)
+    connection.flow_timeout = 5
+    ack = connection.send('add', a=1, b=2)
+    assert ack['task_ack'] is True
+    assert queue.qsize() == 1
+
+
+def test_tasks_beyond_the_credit_wait_rather_than_fail(queue, connection):
+    queue.set_maxsize(2)
+    connection.flow_timeout = 5
+    drainer = _drain(queue, 8)
+    acks = connection.send_many(['add'] * 10)
+    drainer.join(5)
+    assert [ack['task_ack'] for ack in acks] == [True] * 10
+    assert queue.qsize() == 2
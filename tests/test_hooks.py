@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from pasync.hooks import TaskHandlerHook
+
+
+def test_each_stuck_call_is_counted_once():
+    hook = TaskHandlerHook('test_stuck')
+    release = threading.Event()
+    started = []
+    hook.register(lambda n: (started.append(n), release.wait(5)))
+    dispatcher = hook.dispatch_async(workers=1, timeout=0.1)
+    before = hook.timeouts.value
+    try:
+        # The first stuck thread is replaced; the second can not be, as
+        # one worker allows one stuck thread at a time.
+        hook.send(1)
+        hook.send(2)
+        deadline = time.time() + 5
+        while len(started) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert started == [1, 2]
+        time.sleep(0.5)
+        assert hook.timeouts.value - before == 2
+        assert len(dispatcher._threads) == 2
+    finally:
+        release.set()
+        hook.dispatch_sync()
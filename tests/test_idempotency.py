@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from pasync import server as _server
+from pasync.connection import Connection
+from pasync.exceptions import ResponseError
+from pasync.worker import register_task, unregister_task
+
+calls = []
+_calls_lock = threading.Lock()
+
+
+def tally(n, wait=0):
+    with _calls_lock:
+        calls.append(n)
+    time.sleep(wait)
+    return n * 10
+
+
+@pytest.fixture
+def connection(port):
+    register_task(tally)
+    del calls[:]
+    _server.idempotency_cache.clear()
+    connection = Connection(port=port)
+    connection.connect()
+    yield connection
+    connection.disconnect()
+    unregister_task('tally')
+    _server.idempotency_cache.clear()
+
+
+def test_resend_after_it_ran_gets_the_same_result(connection):
+    first = connection.send('tally', n=1, idempotency_key='k')
+    assert connection.get_result(first['task_id'])['task_result'] == 10
+    second = connection.send('tally', n=1, idempotency_key='k')
+    assert second['task_duplicate'] is True
+    result = connection.get_result(second['task_id'])
+    assert result['task_id'] == second['task_id']
+    assert result['task_result'] == 10
+    assert calls == [1]
+
+
+def test_resend_while_it_runs_waits_for_it(connection):
+    first = connection.send('tally', n=2, wait=0.3, idempotency_key='k')
+    second = connection.send('tally', n=2, wait=0.3, idempotency_key='k')
+    assert second['task_duplicate'] is True
+    results = [connection.get_result(ack['task_id'], timeout=5)
+               for ack in (first, second)]
+    assert [r['task_result'] for r in results] == [20, 20]
+    assert calls == [2]
+
+
+def test_other_keys_run_apart(connection):
+    acks = [connection.send('tally', n=n, idempotency_key=str(n))
+            for n in range(3)]
+    for ack in acks:
+        connection.get_result(ack['task_id'], timeout=5)
+    assert sorted(calls) == [0, 1, 2]
+
+
+def test_failed_task_is_not_remembered(connection):
+    first = connection.send('tally', idempotency_key='k')
+    assert connection.get_result(first['task_id'])['task_status'] == \
+        'FAILURE'
+    second = connection.send('tally', n=3, idempotency_key='k')
+    assert not second.get('task_duplicate')
+    assert connection.get_result(second['task_id'])['task_result'] == 30
+
+
+@pytest.mark.parametrize('key', [True, 1.5, ['k']])
+def test_keys_must_be_strings_or_integers(connection, key):
+    with pytest.raises(ResponseError):
+        connection.send('tally', n=1, idempotency_key=key)
+
+
+def test_large_integer_keys_are_accepted(connection):
+    ack = connection.send('tally', n=4, idempotency_key=2 ** 70)
+    assert connection.get_result(ack['task_id'])['task_result'] == 40
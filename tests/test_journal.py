@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+from pasync._compat import Empty
+from pasync.journal import DurableQ
+from pasync.q import Item
+
+
+def _drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get(block=False))
+        except Empty:
+            return items
+
+
+def _numbers(items):
+    return [json.loads(item.data.decode('utf-8'))['n'] for item in items]
+
+
+def test_unacked_items_come_back_in_order(tmpdir):
+    path = str(tmpdir)
+    queue = DurableQ(path, fsync='none')
+    for n in range(30):
+        queue.put(Item({'n': n}, priority=n % 3))
+    for item in _drain(queue):
+        if item.data['n'] % 2 == 0:
+            queue.ack(item)
+    queue.close()
+
+    queue = DurableQ(path, fsync='none')
+    expected = sorted((n for n in range(30) if n % 2),
+                      key=lambda n: (-(n % 3), n))
+    assert _numbers(_drain(queue)) == expected
+    queue.close()
+
+
+def test_replay_across_segments_and_restarts(tmpdir):
+    path = str(tmpdir)
+    options = {'fsync': 'none', 'segment_size': 4096}
+    queue = DurableQ(path, **options)
+    for n in range(200):
+        queue.put(Item({'n': n, 'pad': 'x' * 64}))
+    for item in _drain(queue)[:150]:
+        queue.ack(item)
+    assert len(queue.log._segments) > 1
+    queue.close()
+
+    queue = DurableQ(path, **options)
+    for n in range(200, 210):
+        queue.put(Item({'n': n, 'pad': 'x' * 64}))
+    queue.close()
+
+    # Neither the replayed items nor the later ones were acked.
+    queue = DurableQ(path, **options)
+    assert _numbers(_drain(queue)) == list(range(150, 210))
+    assert queue.log.pending() == 60
+    queue.close()
+
+
+def test_delayed_items_wait_again_after_a_restart(tmpdir):
+    path = str(tmpdir)
+    queue = DurableQ(path, fsync='none')
+    eta = time.time() + 60
+    queue.put_delayed(Item({'n': 1}), eta)
+    queue.put_delayed(Item({'n': 2}), time.time() - 1)
+    queue.close()
+
+    queue = DurableQ(path, fsync='none')
+    delayed = queue.take_delayed()
+    assert [round(e, 3) for e, _ in delayed] == [round(eta, 3)]
+    assert _numbers([item for _, item in delayed]) == [1]
+    assert queue.take_delayed() == []
+    # The overdue one is queued straight away.
+    assert _numbers(_drain(queue)) == [2]
+    queue.close()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+import pytest
+
+from pasync._compat import b
+from pasync.connection import SocketBuffer
+from pasync.exceptions import InvalidResponse
+from pasync.protocol import MAX_FRAME_SIZE, FrameDecoder, pack_frame, \
+    read_frame
+
+PAYLOADS = [b(''), b('x'), b('{"task_id": 1}'), b('a\r\nb\r\n'),
+            b('\x00\xff') * 40000]
+
+
+def test_frame_decoder_round_trip():
+    decoder = FrameDecoder()
+    decoder.feed(b('').join(pack_frame(p) for p in PAYLOADS))
+    frames = []
+    while True:
+        frame = decoder.next_frame()
+        if frame is None:
+            break
+        frames.append(frame)
+    assert frames == PAYLOADS
+    assert len(decoder) == 0
+
+
+def test_frame_decoder_byte_at_a_time():
+    data = b('').join(pack_frame(p) for p in PAYLOADS[:4])
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        frame = decoder.next_frame()
+        if frame is not None:
+            frames.append(frame)
+    assert frames == PAYLOADS[:4]
+
+
+def test_read_frame_round_trip():
+    left, right = socket.socketpair()
+    try:
+        left.sendall(b('').join(pack_frame(p) for p in PAYLOADS[:4]))
+        buf = SocketBuffer(right, 7)
+        assert [read_frame(buf) for _ in range(4)] == PAYLOADS[:4]
+    finally:
+        left.close()
+        right.close()
+
+
+@pytest.mark.parametrize('data', [
+    b('+OK\r\n'),
+    b('$abc\r\n'),
+    b('$-1\r\n'),
+    b('$%d\r\n' % (MAX_FRAME_SIZE + 1)),
+    b('$3\r\nabcXY'),
+    b('$') + b('1') * 64,
+])
+def test_frame_decoder_rejects(data):
+    decoder = FrameDecoder()
+    decoder.feed(data)
+    with pytest.raises(InvalidResponse):
+        decoder.next_frame()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+import pytest
+
+from pasync.scheduler import Scheduler, TimingWheel
+
+
+@pytest.mark.parametrize('start', [0, 5, 1000])
+def test_wheel_fires_each_timer_on_its_tick(start):
+    # 2 levels of 4 slots: 16 ticks in range, the rest overflow.
+    wheel = TimingWheel(now=start, bits=2, levels=2)
+    rng = random.Random(start)
+    expires = [start + rng.randint(1, 60) for _ in range(200)]
+    for i, expire in enumerate(expires):
+        assert wheel.add(expire, i)
+    fired = {}
+    for tick in range(start + 1, start + 62):
+        for i in wheel.advance(tick):
+            fired[i] = tick
+    assert fired == dict(enumerate(expires))
+    assert len(wheel) == 0
+
+
+def test_wheel_jump_fires_everything_due():
+    wheel = TimingWheel(bits=2, levels=2)
+    for expire in range(1, 41):
+        wheel.add(expire, expire)
+    assert sorted(wheel.advance(25)) == list(range(1, 26))
+    assert len(wheel) == 15
+    assert wheel.advance(25) == []
+    assert sorted(wheel.advance(100)) == list(range(26, 41))
+
+
+def test_wheel_refuses_due_timers():
+    wheel = TimingWheel(now=10)
+    assert not wheel.add(10, 'now')
+    assert not wheel.add(3, 'past')
+    assert len(wheel) == 0
+
+
+def test_scheduler_never_runs_early():
+    fired = {}
+    done = threading.Event()
+
+    def put(value):
+        fired[value] = time.time()
+        if len(fired) == 3:
+            done.set()
+
+    scheduler = Scheduler(put, tick=0.01)
+    start = time.time()
+    whens = {'a': start + 0.05, 'b': start + 0.15, 'c': start + 0.1}
+    for value, when in whens.items():
+        assert scheduler.schedule(when, value)
+    assert done.wait(5)
+    for value, when in whens.items():
+        assert when <= fired[value] < when + 0.5
+    assert not scheduler.schedule(time.time() - 1, 'late')
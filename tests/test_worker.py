@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from pasync.q import Item, ShardedQ
+from pasync.worker import (
+    TaskWorker, register_batch_task, register_task, unregister_task
+)
+
+
+@pytest.fixture
+def tasks():
+    register_task(lambda x: x * 2, name='double')
+    register_batch_task(lambda batch: [p['x'] + 1 for p in batch],
+                        name='incr', max_linger_ms=5)
+    yield
+    unregister_task('double')
+    unregister_task('incr')
+
+
+class Replies(object):
+    "Collects result messages, letting a test wait for a number of them."
+
+    def __init__(self):
+        self.results = []
+        self._cond = threading.Condition()
+
+    def __call__(self, result):
+        with self._cond:
+            self.results.append(result)
+            self._cond.notify_all()
+
+    def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        with self._cond:
+            while len(self.results) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return self.results
+
+
+def _task(task_id, name, x):
+    return {'task_id': task_id, 'task_content': name,
+            'task_params': {'x': x}}
+
+
+def test_idle_batch_lane_does_not_starve_a_single_slot(tasks):
+    queue = ShardedQ()
+    worker = TaskWorker(queue=queue, concurrency=1, poll_interval=0.05)
+    worker.start()
+    try:
+        # Let the batch collector go idle first.
+        time.sleep(0.2)
+        replies = Replies()
+        queue.put(Item(_task(1, 'double', 21), reply=replies))
+        results = replies.wait(1, timeout=2)
+        assert [r['task_result'] for r in results] == [42]
+
+        queue.put(Item(_task(2, 'incr', 1), reply=replies))
+        queue.put(Item(_task(3, 'double', 2), reply=replies))
+        results = replies.wait(3, timeout=2)
+        assert sorted((r['task_id'], r['task_result'])
+                      for r in results) == [(1, 42), (2, 2), (3, 4)]
+    finally:
+        worker.stop()
+
+
+def test_batch_task_gets_queued_tasks_together(tasks):
+    queue = ShardedQ()
+    worker = TaskWorker(queue=queue, concurrency=2, poll_interval=0.05)
+    replies = Replies()
+    for i in range(10):
+        queue.put(Item(_task(i, 'incr', i), reply=replies))
+    worker.start()
+    try:
+        results = replies.wait(10)
+    finally:
+        worker.stop()
+    assert sorted((r['task_id'], r['task_result']) for r in results) == \
+        [(i, i + 1) for i in range(10)]
+
+
+class AckedQ(ShardedQ):
+    "A queue that records what the worker acks, as DurableQ would log."
+
+    def __init__(self):
+        ShardedQ.__init__(self)
+        self.acked = []
+
+    def ack(self, item):
+        self.acked.append(item)
+
+
+def lock():
+    return threading.Lock()
+
+
+def test_unsendable_result_fails_the_task_and_frees_its_slot(tasks):
+    register_task(lock)
+    queue = AckedQ()
+    worker = TaskWorker(queue=queue, pool='process', concurrency=1,
+                        poll_interval=0.05)
+    worker.start()
+    try:
+        replies = Replies()
+        queue.put(Item({'task_id': 1, 'task_content': 'lock'},
+                       reply=replies))
+        queue.put(Item(_task(2, 'double', 4), reply=replies))
+        results = replies.wait(2)
+    finally:
+        worker.stop()
+        unregister_task('lock')
+    assert [(r['task_id'], r['task_status']) for r in results] == \
+        [(1, 'FAILURE'), (2, 'SUCCESS')]
+    assert len(queue.acked) == 2
+
+
+def test_task_the_pool_refuses_fails_and_is_acked(tasks):
+    queue = AckedQ()
+    worker = TaskWorker(queue=queue, concurrency=1, poll_interval=0.05)
+    worker.start()
+    worker._pool.close()
+    try:
+        replies = Replies()
+        queue.put(Item(_task(1, 'double', 1), reply=replies))
+        queue.put(Item(_task(2, 'incr', 1), reply=replies))
+        queue.put(Item(_task(3, 'double', 2), reply=replies))
+        results = replies.wait(3)
+    finally:
+        worker.stop()
+    assert sorted((r['task_id'], r['task_status']) for r in results) == \
+        [(1, 'FAILURE'), (2, 'FAILURE'), (3, 'FAILURE')]
+    assert len(queue.acked) == 3